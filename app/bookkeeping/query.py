@@ -29,6 +29,39 @@ router = decoRouter()
 logger = config.get_logger()
 tz_conversion_sql = ""
 tz_conversion_params: Dict = {}
+# Names of the DICOM tags stored in the columns of the dicom_series table
+series_tag_names = {
+    "series_uid": "SeriesUID",
+    "study_uid": "StudyUID",
+    "tag_patientname": "PatientName",
+    "tag_patientid": "PatientID",
+    "tag_accessionnumber": "AccessionNumber",
+    "tag_seriesnumber": "SeriesNumber",
+    "tag_studyid": "StudyID",
+    "tag_patientbirthdate": "PatientBirthDate",
+    "tag_patientsex": "PatientSex",
+    "tag_acquisitiondate": "AcquisitionDate",
+    "tag_acquisitiontime": "AcquisitionTime",
+    "tag_modality": "Modality",
+    "tag_bodypartexamined": "BodyPartExamined",
+    "tag_studydescription": "StudyDescription",
+    "tag_seriesdescription": "SeriesDescription",
+    "tag_protocolname": "ProtocolName",
+    "tag_codevalue": "CodeValue",
+    "tag_codemeaning": "CodeMeaning",
+    "tag_sequencename": "SequenceName",
+    "tag_scanningsequence": "ScanningSequence",
+    "tag_sequencevariant": "SequenceVariant",
+    "tag_slicethickness": "SliceThickness",
+    "tag_contrastbolusagent": "ContrastBolusAgent",
+    "tag_referringphysicianname": "ReferringPhysicianName",
+    "tag_manufacturer": "Manufacturer",
+    "tag_manufacturermodelname": "ManufacturerModelName",
+    "tag_magneticfieldstrength": "MagneticFieldStrength",
+    "tag_deviceserialnumber": "DeviceSerialNumber",
+    "tag_softwareversions": "SoftwareVersions",
+    "tag_stationname": "StationName",
+}
 
 
 def set_timezone_conversion() -> None:
@@ -66,6 +99,29 @@ async def get_series(request) -> JSONResponse:
     return CustomJSONResponse(series)
 
 
+def get_series_tags(row: Dict) -> Dict[str, str]:
+    """Converts a row of the dicom_series table into the tags that the routing rules are evaluated on."""
+    tags = {"SeriesInstanceUID": row.get("series_uid") or "", "StudyInstanceUID": row.get("study_uid") or ""}
+    for column, name in series_tag_names.items():
+        if column.startswith("tag_") and row.get(column) is not None:
+            tags[name] = row[column]
+    return tags
+
+
+@router.get("/series_tags")
+@requires("authenticated")
+async def get_recent_series_tags(request) -> JSONResponse:
+    """Endpoint for retrieving the tags of the most recently received series, e.g., for testing changed routing
+    rules against them. The number of series can be passed as parameter 'limit'."""
+    try:
+        limit = int(request.query_params.get("limit", 10000))
+    except ValueError:
+        return JSONResponse({"error": "Invalid limit"}, status_code=400)
+    query = db.dicom_series.select().order_by(db.dicom_series.c.time.desc()).limit(max(limit, 0))
+    result = await db.database.fetch_all(query)
+    return CustomJSONResponse([get_series_tags(dict(row)) for row in result])
+
+
 @router.get("/tasks")
 @requires("authenticated")
 async def get_tasks(request) -> JSONResponse:
@@ -418,41 +474,9 @@ async def get_task_info(request) -> JSONResponse:
     # info_rows = await db.database.fetch_all(info_query)
     if result:
         result_dict = dict(result)
-        rename = {
-            "series_uid": "SeriesUID",
-            "study_uid": "StudyUID",
-            "tag_patientname": "PatientName",
-            "tag_patientid": "PatientID",
-            "tag_accessionnumber": "AccessionNumber",
-            "tag_seriesnumber": "SeriesNumber",
-            "tag_studyid": "StudyID",
-            "tag_patientbirthdate": "PatientBirthDate",
-            "tag_patientsex": "PatientSex",
-            "tag_acquisitiondate": "AcquisitionDate",
-            "tag_acquisitiontime": "AcquisitionTime",
-            "tag_modality": "Modality",
-            "tag_bodypartexamined": "BodyPartExamined",
-            "tag_studydescription": "StudyDescription",
-            "tag_seriesdescription": "SeriesDescription",
-            "tag_protocolname": "ProtocolName",
-            "tag_codevalue": "CodeValue",
-            "tag_codemeaning": "CodeMeaning",
-            "tag_sequencename": "SequenceName",
-            "tag_scanningsequence": "ScanningSequence",
-            "tag_sequencevariant": "SequenceVariant",
-            "tag_slicethickness": "SliceThickness",
-            "tag_contrastbolusagent": "ContrastBolusAgent",
-            "tag_referringphysicianname": "ReferringPhysicianName",
-            "tag_manufacturer": "Manufacturer",
-            "tag_manufacturermodelname": "ManufacturerModelName",
-            "tag_magneticfieldstrength": "MagneticFieldStrength",
-            "tag_deviceserialnumber": "DeviceSerialNumber",
-            "tag_softwareversions": "SoftwareVersions",
-            "tag_stationname": "StationName",
-        }
 
         response["information"] = {
-            rename.get(x, x): result_dict.get(x)
+            series_tag_names.get(x, x): result_dict.get(x)
             for x in result_dict.keys() if x not in ('id', 'time', 'data')
         }
         try:
@@ -0,0 +1,198 @@
+"""
+completion_series.py
+====================
+Compiled form of the study completion conditions that define which series are required (e.g., "'SAG' or ('COR' and
+'AX')"). The condition is parsed once into a boolean expression tree, and the quoted series names are searched in the
+received series descriptions with a single multi-pattern matcher. The matches are remembered per study, so that only
+the series that have been added since the last check need to be searched.
+"""
+
+# Standard python includes
+import ast
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Set, Tuple, Union
+
+# App-specific includes
+import common.rule_evaluation as rule_evaluation
+
+# Upper limits for the number of cached conditions and studies (the oldest entries are dropped first)
+MAX_CONDITIONS = 1000
+MAX_STUDIES = 10000
+
+# Node of the expression tree: ("and"|"or", [nodes]), ("not", node), ("series", index), or ("const", value)
+Node = Tuple[str, Union[List, Tuple, int, bool]]
+
+
+class SeriesMatcher:
+    """
+    Aho-Corasick automaton that finds which of the given patterns occur in a text, with a single pass over the text.
+    """
+
+    def __init__(self, patterns: List[str]) -> None:
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[Set[int]] = [set()]
+        # Empty patterns occur in every text
+        self.always: Set[int] = set()
+        for index, pattern in enumerate(patterns):
+            if not pattern:
+                self.always.add(index)
+                continue
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                state = next_state
+            self.output[state].add(index)
+
+        queue: Deque[int] = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.output[next_state] |= self.output[self.fail[next_state]]
+
+    def find(self, text: str) -> Set[int]:
+        """Returns the indices of the patterns that occur in the text."""
+        found = set(self.always)
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            found |= self.output[state]
+        return found
+
+
+class CompletionCondition:
+    """
+    Completion condition of a study rule, compiled into an expression tree over the quoted series names. Conditions
+    that cannot be compiled (invalid conditions or unusual expressions) are evaluated by parse_completion_series.
+    """
+
+    def __init__(self, condition: str) -> None:
+        self.condition = condition
+        # Same extraction of the series names as in parse_completion_series
+        parsed_str = condition.lower()
+        self.patterns: List[str] = []
+        i = 0
+        while i < len(parsed_str):
+            opening = parsed_str.find("'", i)
+            if opening < 0:
+                break
+            closing = parsed_str.find("'", opening + 1)
+            if closing < 0:
+                break
+            series_string = parsed_str[opening + 1:closing]
+            if series_string not in self.patterns:
+                self.patterns.append(series_string)
+            i = closing + 1
+
+        for index, pattern in enumerate(self.patterns):
+            parsed_str = parsed_str.replace("'" + pattern + "'", f" _series_{index} ")
+        self.matcher = SeriesMatcher(self.patterns)
+        self.tree: Optional[Node] = None
+        try:
+            self.tree = self._compile(ast.parse(parsed_str.strip(), mode="eval").body)
+        except (SyntaxError, ValueError):
+            pass
+
+    def _compile(self, node: ast.AST) -> Node:
+        if isinstance(node, ast.BoolOp):
+            return ("and" if isinstance(node.op, ast.And) else "or", [self._compile(value) for value in node.values])
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return ("not", self._compile(node.operand))
+        if isinstance(node, ast.Name) and node.id.startswith("_series_"):
+            return ("series", int(node.id[len("_series_"):]))
+        if isinstance(node, ast.Name) and node.id in ("True", "False"):
+            return ("const", node.id == "True")
+        if isinstance(node, ast.Constant) and isinstance(node.value, bool):
+            return ("const", node.value)
+        raise ValueError(f"Unsupported expression in completion condition: {ast.dump(node)}")
+
+    def evaluate(self, found: Set[int]) -> bool:
+        assert self.tree is not None
+        return self._evaluate(self.tree, found)
+
+    def _evaluate(self, node: Node, found: Set[int]) -> bool:
+        kind, value = node
+        if kind == "and":
+            return all(self._evaluate(child, found) for child in value)  # type: ignore
+        if kind == "or":
+            return any(self._evaluate(child, found) for child in value)  # type: ignore
+        if kind == "not":
+            return not self._evaluate(value, found)  # type: ignore
+        if kind == "series":
+            return value in found
+        return bool(value)
+
+
+class StudyMatches:
+    """Series names of a condition that have been found in the first received series of a study."""
+
+    def __init__(self, condition: CompletionCondition) -> None:
+        self.condition = condition
+        self.series_count = 0
+        self.found: Set[int] = set()
+
+
+_conditions: "OrderedDict[str, CompletionCondition]" = OrderedDict()
+_studies: "OrderedDict[str, StudyMatches]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_condition(condition: str) -> CompletionCondition:
+    with _lock:
+        compiled = _conditions.get(condition)
+        if compiled is None:
+            compiled = CompletionCondition(condition)
+            _conditions[condition] = compiled
+            if len(_conditions) > MAX_CONDITIONS:
+                _conditions.popitem(last=False)
+        return compiled
+
+
+def check_completion_series(task_id: str, study_key: str, completion_str: str, received_series: List[str]) -> bool:
+    """
+    Returns True if the series required by the completion condition have been received, with the same result as
+    parse_completion_series. The received series of the study are expected to only grow between the calls, so that
+    only the new series are searched.
+    """
+    if len(received_series) == 0:
+        return False
+    if len(completion_str) == 0:
+        return True
+
+    condition = get_condition(completion_str)
+    if condition.tree is None:
+        return rule_evaluation.parse_completion_series(task_id, completion_str, received_series)
+
+    with _lock:
+        matches = _studies.get(study_key)
+        if matches is None or matches.condition is not condition or matches.series_count > len(received_series):
+            matches = StudyMatches(condition)
+        _studies[study_key] = matches
+        _studies.move_to_end(study_key)
+        if len(_studies) > MAX_STUDIES:
+            _studies.popitem(last=False)
+
+        for series in received_series[matches.series_count:]:
+            matches.found |= condition.matcher.find(series.lower())
+        matches.series_count = len(received_series)
+        return condition.evaluate(matches.found)
+
+
+def discard_study(study_key: str) -> None:
+    with _lock:
+        _studies.pop(study_key, None)
@@ -5,12 +5,12 @@ mercure's configuration management, used by various mercure modules
 """
 
 # Standard python includes
-import json
 import os
 from pathlib import Path
 from typing import Dict, cast
 
 import common.helper as helper
+import common.json_codec as json_codec
 # App-specific includes
 import common.monitor as monitor
 import common.tagslist as tagslist
@@ -50,6 +50,18 @@ mercure_defaults = {
     "jobs_folder": "/opt/mercure/data/jobs",
     "persistence_folder": "/opt/mercure/persistence",
     "router_scan_interval": 1,  # in seconds
+    "router_watch_incoming": False,
+    "router_reconcile_interval": 60,  # in seconds
+    "router_workers": 1,
+    "router_fanout_mode": "copy",
+    "router_speculative_routing": False,
+    "router_adaptive_completion": False,
+    "router_adaptive_percentile": 99,
+    "router_adaptive_min_trigger": 5,  # in seconds
+    "router_count_completion": False,
+    "router_takeover_timeout": 60,  # in seconds
+    "router_duplicate_window": 0,  # in seconds
+    "router_backpressure": {"outgoing": {}, "processing": {}},
     "dispatcher_scan_interval": 1,  # in seconds
     "cleaner_scan_interval": 60,  # in seconds
     "retention": 259200,  # in seconds (3 days)
@@ -117,7 +129,7 @@ def read_config() -> Config:
     logger.info(f"Reading configuration from: {configuration_filename}")
 
     with open(configuration_file, "r") as json_file:
-        loaded_config = json.load(json_file)
+        loaded_config = json_codec.load(json_file)
         # Reset configuration to default values (to ensure all needed
         # keys are present in the configuration)
         merged: Dict = {**mercure_defaults, **loaded_config}
@@ -141,6 +153,7 @@ def read_config() -> Config:
             logger.info("Unable to parse list of additional tags. Check configuration file.")
 
         configuration_timestamp = timestamp
+        compile_rules(mercure)
         monitor.send_event(monitor.m_events.CONFIG_UPDATE, monitor.severity.INFO, "Configuration updated")
         return mercure
 
@@ -162,8 +175,9 @@ def save_config() -> None:
     except Exception:
         raise ResourceWarning(f"Unable to lock configuration file: {lock_file}")
 
+    update_rule_tags(mercure)
     with open(configuration_file, "w") as json_file:
-        json.dump(mercure.dict(), json_file, indent=4)
+        json_codec.dump(mercure.dict(), json_file, indent=4)
 
     try:
         stat = os.stat(configuration_file)
@@ -199,7 +213,7 @@ def write_configfile(json_content) -> None:
         raise ResourceWarning(f"Unable to lock configuration file: {lock_file}")
 
     with open(configuration_file, "w") as json_file:
-        json.dump(json_content, json_file, indent=4)
+        json_codec.dump(json_content, json_file, indent=4)
 
     monitor.send_event(monitor.m_events.CONFIG_UPDATE, monitor.severity.INFO, "Wrote configuration file.")
     logger.info(f"Wrote configuration into: {configuration_file}")
@@ -254,3 +268,28 @@ def read_tagslist() -> None:
     global mercure
     tagslist.alltags = {**tagslist.default_tags, **mercure.dicom_receiver.additional_tags}
     tagslist.sortedtags = sorted(tagslist.alltags)
+
+
+def compile_rules(config: Config) -> None:
+    """Compiles the routing rules of the given configuration and reports the rules that cannot be evaluated."""
+    # Imported here because the rule evaluation depends on this module
+    import common.rule_evaluation as rule_evaluation
+    try:
+        invalid = rule_evaluation.compile_rules(config.rules)
+    except Exception as e:
+        logger.info(e)
+        logger.info("Unable to compile the rules.")
+        return
+    for rule_name, problem in invalid.items():
+        logger.error(f"Invalid rule {rule_name}: {problem}", None, event_type=monitor.m_events.CONFIG_UPDATE)  # handle_error
+
+
+def update_rule_tags(config: Config) -> None:
+    """Updates the list of tags that the receiver extracts for the rules (in addition to the default tags)."""
+    # Imported here because the rule evaluation depends on this module
+    import common.required_tags as required_tags
+    try:
+        config.dicom_receiver.rule_tags = required_tags.analyze_config(config).receiver_tags
+    except Exception as e:
+        logger.info(e)
+        logger.info("Unable to determine the tags used by the rules.")
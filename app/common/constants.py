@@ -27,6 +27,9 @@ class mercure_names:
     DCM = ".dcm"
     DCMFILTER = "*.dcm"
     FORCE_COMPLETE = ".force-complete"
+    STUDY_JOURNAL = "study_journal.jsonl"
+    SPECULATIVE = ".speculative"
+    EXPECTED = ".expected"
 
 
 class mercure_sections:
@@ -69,6 +72,7 @@ class mercure_rule:
     ACTION_TRIGGER = "action_trigger"
     STUDY_TRIGGER_CONDITION = "study_trigger_condition"
     STUDY_FORCE_COMPLETION_ACTION = "study_force_completion_action"
+    STUDY_INCREMENTAL_DISPATCH = "study_incremental_dispatch"
     STUDY_TRIGGER_CONDITION_TIMEOUT = "timeout"
     STUDY_TRIGGER_CONDITION_RECEIVED_SERIES = "received_series"
     STUDY_TRIGGER = "study_trigger"
@@ -90,6 +94,8 @@ class mercure_study:
     CREATION_TIME = "creation_time"
     LAST_RECEIVE_TIME = "last_receive_time"
     RECEIVED_SERIES = "received_series"
+    RECEIVED_SERIES_UID = "received_series_uid"
+    FORWARDED_SERIES_UID = "forwarded_series_uid"
     COMPLETE_TRIGGER = "complete_trigger"
     COMPLETE_REQUIRED_SERIES = "complete_required_series"
     COMPLETE_FORCE = "complete_force"
@@ -0,0 +1,79 @@
+"""
+json_codec.py
+=============
+Reading and writing of the JSON files that mercure passes between its modules (task files, tags files,
+configuration) and of the payloads sent to the bookkeeper. Parsing uses orjson if it is installed and falls
+back to the json module of the standard library otherwise. The backend can be selected with the environment
+variable MERCURE_JSON_BACKEND ("orjson" or "stdlib").
+
+Serialization always goes through the standard library, so that the files written by mercure stay
+byte-for-byte identical regardless of the installed backend (orjson neither supports the separators nor the
+ASCII escaping of the json module).
+"""
+
+# Standard python includes
+import json
+import os
+from typing import IO, Any, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+BACKEND_STDLIB = "stdlib"
+BACKEND_ORJSON = "orjson"
+BACKENDS = (BACKEND_STDLIB, BACKEND_ORJSON)
+
+
+def _default_backend() -> str:
+    requested = os.getenv("MERCURE_JSON_BACKEND", "").strip().lower()
+    if requested == BACKEND_STDLIB or orjson is None:
+        return BACKEND_STDLIB
+    return BACKEND_ORJSON
+
+
+backend: str = _default_backend()
+
+
+def get_backend() -> str:
+    """Returns the name of the backend that is currently used for parsing."""
+    return backend
+
+
+def set_backend(name: str) -> None:
+    """Selects the backend used for parsing. Raises ValueError if the backend is unknown or not installed."""
+    global backend
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown JSON backend {name}")
+    if name == BACKEND_ORJSON and orjson is None:
+        raise ValueError("JSON backend orjson is not installed")
+    backend = name
+
+
+def loads(content: Union[str, bytes]) -> Any:
+    """Parses a JSON document. Documents that orjson rejects but the json module accepts (NaN, lone surrogates
+    from files read with errors="surrogateescape") are handed to the json module, so that the result does not
+    depend on the backend."""
+    if backend == BACKEND_ORJSON:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(content)
+
+
+def load(fp: IO) -> Any:
+    """Parses the JSON document in the given file object."""
+    return loads(fp.read())
+
+
+def dumps(obj: Any, indent: Optional[int] = None) -> str:
+    """Serializes obj with the same output as json.dumps."""
+    return json.dumps(obj, indent=indent)
+
+
+def dump(obj: Any, fp: IO, indent: Optional[int] = None) -> None:
+    """Writes obj to the given file object with the same output as json.dump. The document is encoded in one
+    piece, which allows the C encoder of the json module to be used instead of the chunked encoder of json.dump."""
+    fp.write(dumps(obj, indent=indent))
@@ -3,6 +3,7 @@ import logging
 import os
 import re
 import sys
+import threading
 import typing
 from typing import Tuple
 
@@ -62,10 +63,15 @@ class ExceptionsKeywordArgumentAdapter(daiquiri.KeywordArgumentAdapter):
     def __init__(self, logger: logging.Logger, extra: dict) -> None:
         super().__init__(logger, extra)
         self.logger.addHandler(BookkeeperHandler())
+        # The active task is stored per thread, so that tasks processed in parallel are logged correctly
+        self._context = threading.local()
 
     def process(self, msg, kwargs) -> Tuple[str, "collections.abc.MutableMapping[str, typing.Any]"]:
         if sys.exc_info()[0] is not None and "exc_info" not in kwargs:
             kwargs["exc_info"] = True
+        context_task = getattr(self._context, "task", None)
+        if context_task is not None:
+            kwargs.setdefault("context_task", context_task)
         msg, kwargs = super().process(msg, kwargs)
 
         extra = kwargs["extra"]
@@ -78,13 +84,13 @@ class ExceptionsKeywordArgumentAdapter(daiquiri.KeywordArgumentAdapter):
         return msg, kwargs  # {"extra": {"_daiquiri_extra_keys": set()}}
 
     def setTask(self, task_id: str) -> None:
-        self.extra["context_task"] = task_id  # type: ignore
+        self._context.task = task_id
         logger.debug("Setting task")
 
     def clearTask(self) -> None:
-        if self.extra and "context_task" in self.extra:
+        if getattr(self._context, "task", None) is not None:
             logger.debug("Clearing task")
-            del self.extra["context_task"]  # type: ignore
+            self._context.task = None
 
 
 def clear_task_decorator(func):
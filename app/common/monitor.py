@@ -14,6 +14,7 @@ from json import JSONDecodeError
 from typing import Any, Dict, Optional
 
 import aiohttp
+import common.json_codec as json_codec
 import daiquiri
 from common.event_types import m_events, severity, task_event, w_events
 # App-specific includes
@@ -56,6 +57,7 @@ async def do_post(endpoint, kwargs, catch_errors=False) -> None:
     logger.debug(f"Posting to {endpoint}: {kwargs}")
     try:
         async with aiohttp.ClientSession(headers={"Authorization": f"Token {api_key}"},
+                                         json_serialize=json_codec.dumps,
                                          timeout=aiohttp.ClientTimeout(total=None, connect=120,
                                                                        sock_connect=120, sock_read=120)
                                          ) as session:
@@ -82,10 +84,22 @@ def post(endpoint: str, **kwargs) -> None:
     if not bookkeeper_address:
         return None
 
+    # Calls from worker threads (e.g., parallel routing in the router) need to hand over the request to the loop
+    if loop is not None and loop.is_running() and not _in_loop_thread():
+        asyncio.run_coroutine_threadsafe(do_post(endpoint, kwargs, True), loop)
+        return None
+
     # create_task requires a running event loop; during boot there might not be one running yet.
     asyncio.ensure_future(do_post(endpoint, kwargs, True), loop=loop)
 
 
+def _in_loop_thread() -> bool:
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
 async def async_post(endpoint: str, **kwargs):
     if api_key is None:
         return None
@@ -110,7 +124,7 @@ async def get(endpoint: str, payload: Any = {}) -> Any:
                 logger.error(f"Failed GET request to bookkeeper endpoint {endpoint}: status: {resp.status}")
                 if resp.content_type == "application/json":
                     try:
-                        err_json = await resp.json()
+                        err_json = await resp.json(loads=json_codec.loads)
                     except JSONDecodeError:
                         raise MonitorHTTPError(resp.status, await resp.text())
                 else:
@@ -120,7 +134,7 @@ async def get(endpoint: str, payload: Any = {}) -> Any:
                 except KeyError:
                     raise MonitorHTTPError(resp.status, "Unknown error")
 
-            return await resp.json()
+            return await resp.json(loads=json_codec.loads)
 
 
 def configure(module, instance, address) -> None:
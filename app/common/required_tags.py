@@ -0,0 +1,179 @@
+"""
+required_tags.py
+================
+Static analysis of the configuration to determine which DICOM tags are used by the routing rules, notification
+templates, and completion settings. Tags that are not extracted by default are written into the configuration
+as the receiver's rule_tags, so that the receiver extracts them (and can still stop parsing the headers as early as
+possible). The tag names are resolved with DCMTK's data dictionary, which is the dictionary used by getdcmtags. Tags
+that the receiver cannot extract at all (e.g., misspelled tag names or sequences) are reported by the router.
+"""
+
+# Standard python includes
+import ast
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+# App-specific includes
+import common.config as config
+import common.rule_evaluation as rule_evaluation
+import common.tagslist as tagslist
+from common.constants import mercure_options
+from common.tags_rule_interface import Tags
+from common.types import Config, Rule
+from jinja2 import meta
+from jinja2.sandbox import SandboxedEnvironment
+
+# Variables of the notification templates that are filled from the tags of the series
+template_variables = {
+    "DeviceSerialNumber": "DeviceSerialNumber",
+    "acc": "AccessionNumber",
+    "mrn": "PatientID",
+    "patient_name": "PatientName",
+}
+
+notification_templates = ["notification_payload", "notification_payload_body", "notification_email_body"]
+
+# Value representation of sequences, which getdcmtags cannot read as string
+VR_SEQUENCE = "SQ"
+
+_dictionary: Optional[Dict[str, str]] = None
+_dictionary_keywords: Dict[str, str] = {}
+
+logger = config.get_logger()
+
+
+@dataclass
+class RequiredTags:
+    # Tags that are needed for routing, together with the rules or settings that need them
+    tags: Dict[str, Set[str]] = field(default_factory=dict)
+    # Tags that the receiver needs to extract in addition to the default and additional tags
+    receiver_tags: List[str] = field(default_factory=list)
+    # Tags that are used but never extracted by the receiver, together with the rules that use them
+    unavailable: Dict[str, Set[str]] = field(default_factory=dict)
+
+    def add(self, tag: str, user: str) -> None:
+        self.tags.setdefault(tag, set()).add(user)
+
+
+def read_dictionary(path: Path) -> Dict[str, str]:
+    """
+    Reads a DCMTK data dictionary and returns the value representations of the tags by keyword.
+    """
+    dictionary: Dict[str, str] = {}
+    with open(path, "r", encoding="utf-8", errors="replace") as dictionary_file:
+        for line in dictionary_file:
+            if line.startswith("#"):
+                continue
+            # Format: (gggg,eeee) <tab> VR <tab> Keyword <tab> VM <tab> Version
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 3 and fields[2]:
+                dictionary.setdefault(fields[2], fields[1])
+    return dictionary
+
+
+def get_dictionary() -> Dict[str, str]:
+    """
+    Returns the data dictionary of getdcmtags (app/bin/dicom.dic). If the dictionary cannot be read, no tag can be
+    resolved, so that no unknown tags are handed to the receiver. A failed read is not retried.
+    """
+    global _dictionary, _dictionary_keywords
+    if _dictionary is None:
+        dictionary_path = config.app_basepath / "bin" / "dicom.dic"
+        try:
+            _dictionary = read_dictionary(dictionary_path)
+        except OSError as e:
+            logger.warning(f"Unable to read the data dictionary {dictionary_path}: {e}")
+            _dictionary = {}
+        _dictionary_keywords = {keyword.lower(): keyword for keyword in _dictionary}
+    return _dictionary
+
+
+def find_rule_tags(rule: str) -> Set[str]:
+    """
+    Returns the names of the tags that are referenced in the rule, either as @Tag@, tags["Tag"], or tags.Tag.
+    """
+    tag_names = set(rule_evaluation.find_tag_names(rule))
+    text = rule
+    for tag in tag_names:
+        text = text.replace("@" + tag + "@", f"tags[{tag!r}]")
+    try:
+        tree = ast.parse(text.strip())
+    except (SyntaxError, ValueError):
+        return tag_names
+
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.Subscript, ast.Attribute)):
+            continue
+        if not isinstance(node.value, ast.Name) or node.value.id != "tags":
+            continue
+        if isinstance(node, ast.Subscript):
+            if isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+                tag_names.add(node.slice.value)
+        elif not hasattr(Tags, node.attr) and not node.attr.startswith("_"):
+            tag_names.add(node.attr)
+    return tag_names
+
+
+def find_template_tags(template: str) -> Set[str]:
+    if not template:
+        return set()
+    try:
+        variables = meta.find_undeclared_variables(SandboxedEnvironment().parse(template))  # type: ignore
+    except Exception:
+        # Invalid templates are reported when the notification is sent
+        return set()
+    return {template_variables[variable] for variable in variables if variable in template_variables}
+
+
+def get_rule_tags(rule: Rule) -> Set[str]:
+    """
+    Returns the tags that are needed for evaluating the rule and for the notifications and completion of the rule.
+    """
+    tag_names = find_rule_tags(rule.rule)
+    for template in notification_templates:
+        tag_names |= find_template_tags(rule.get(template, ""))
+    if rule.action_trigger == mercure_options.STUDY:
+        tag_names |= {"StudyInstanceUID", "SeriesInstanceUID", "SeriesDescription"}
+    return tag_names
+
+
+def resolve_tag(tag: str, extracted: Dict[str, str]) -> str:
+    """
+    Returns the name of the tag as extracted by the receiver. Tags accessed as attributes are matched
+    case-insensitively by the rules, so the names are resolved in the same way.
+    """
+    if tag in extracted or tag in get_dictionary():
+        return tag
+    lowered_name = tag.lower()
+    for name in extracted:
+        if name.lower() == lowered_name:
+            return name
+    return _dictionary_keywords.get(lowered_name, tag)
+
+
+def analyze_config(mercure: Config) -> RequiredTags:
+    """
+    Determines the tags that are needed for routing with the given configuration. Only tags that getdcmtags can
+    resolve and read as string are passed to the receiver.
+    """
+    result = RequiredTags()
+    dictionary = get_dictionary()
+    extracted = {**tagslist.default_tags, **mercure.dicom_receiver.additional_tags}
+    for rule_name, rule in mercure.rules.items():
+        if rule.disabled:
+            continue
+        for tag in get_rule_tags(rule):
+            result.add(resolve_tag(tag, extracted), rule_name)
+    if mercure.router_adaptive_completion:
+        result.add("SenderAET", "router_adaptive_completion")
+        result.add("Modality", "router_adaptive_completion")
+
+    for tag, users in sorted(result.tags.items()):
+        if tag in extracted or tag.startswith("mercure"):
+            continue
+        if dictionary.get(tag, VR_SEQUENCE) != VR_SEQUENCE:
+            result.receiver_tags.append(tag)
+        else:
+            result.unavailable[tag] = users
+    return result
@@ -5,14 +5,23 @@ Helper functions for evaluating routing rules and study-completion conditions.
 """
 
 # Standard python includes
+import ast
+import itertools
 import os
-from typing import Any, Dict, Optional, Tuple
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Type
 
 from asteval import Interpreter
 
 # App-specific includes
+import common.json_codec as json_codec
 import common.monitor as monitor
+import common.rule_index as rule_index
 from common import config
+from common.constants import mercure_defs, mercure_names
 from common.tags_rule_interface import TagNotFoundException, Tags
 
 # Create local logger instance
@@ -20,15 +29,27 @@ logger = config.get_logger()
 
 UNSAFE_RULE_EVALUATION = os.environ.get("MERCURE_UNSAFE_RULE_EVALUATION", "").lower() in ("1", "true", "yes")
 
-
-def replace_tags(rule: str, tags: Dict[str, str]) -> Any:
-    """Replaces all tags with format @tagname@ in the given rule string with
-    the corresponding values from the currently processed series (stored
-    in the second argument)."""
-    # Run the substitute operation manually instead of using
-    # the standard string function to enforce that the values
-    # read from the tags are treated as strings by default
-    tags_found = []
+# Upper limit for the number of cached compiled rules (the cache is cleared when it is exceeded)
+MAX_COMPILED_RULES = 10000
+# Number of evaluations after which the interpreter of a thread is replaced (asteval keeps a reference to every
+# evaluated expression)
+MAX_INTERPRETER_EVALUATIONS = 10000
+
+_tag_names_cache: Dict[str, List[str]] = {}
+_compiled_rules: Dict[str, "CompiledRule"] = {}
+# Timestamp of the configuration for which the rules have been compiled
+_compiled_rules_timestamp: float = -1
+# Interpreter of the current thread that is reused for evaluating compiled rules
+_thread_interpreter = threading.local()
+
+
+def find_tag_names(rule: str) -> List[str]:
+    """Returns the names enclosed by @...@ in the given rule string, in the order of their occurrence. The result
+    only depends on the rule string, so it is cached."""
+    tag_names = _tag_names_cache.get(rule)
+    if tag_names is not None:
+        return tag_names
+    tag_names = []
     i = 0
     while i < len(rule):
         opening = rule.find("@", i)
@@ -37,10 +58,20 @@ def replace_tags(rule: str, tags: Dict[str, str]) -> Any:
         closing = rule.find("@", opening + 1)
         if closing < 0:
             break
-        tagstring = rule[opening + 1:closing]
-        if tagstring in tags:
-            tags_found.append(tagstring)
+        tag_names.append(rule[opening + 1:closing])
         i = closing + 1
+    _tag_names_cache[rule] = tag_names
+    return tag_names
+
+
+def replace_tags(rule: str, tags: Dict[str, str]) -> Any:
+    """Replaces all tags with format @tagname@ in the given rule string with
+    the corresponding values from the currently processed series (stored
+    in the second argument)."""
+    # Run the substitute operation manually instead of using
+    # the standard string function to enforce that the values
+    # read from the tags are treated as strings by default
+    tags_found = [tagstring for tagstring in find_tag_names(rule) if tagstring in tags]
 
     for tag in tags_found:
         rule = rule.replace("@" + tag + "@", f"tags[\"{tag}\"]")
@@ -91,6 +122,18 @@ def _make_interpreter(**extra_syms: Any) -> Interpreter:
     return aeval
 
 
+def _get_thread_interpreter() -> Interpreter:
+    """Returns the interpreter of the current thread, which is replaced after MAX_INTERPRETER_EVALUATIONS."""
+    aeval: Optional[Interpreter] = getattr(_thread_interpreter, "aeval", None)
+    evaluations: int = getattr(_thread_interpreter, "evaluations", 0)
+    if aeval is None or evaluations >= MAX_INTERPRETER_EVALUATIONS:
+        aeval = _make_interpreter(tags=None)
+        _thread_interpreter.aeval = aeval
+        evaluations = 0
+    _thread_interpreter.evaluations = evaluations + 1
+    return aeval
+
+
 def _eval_safe(rule: str, tags_obj: Tags) -> Any:
     """Evaluate a rule using asteval's sandboxed interpreter."""
     aeval = _make_interpreter(tags=tags_obj)
@@ -101,23 +144,127 @@ def _eval_safe(rule: str, tags_obj: Tags) -> Any:
     return result
 
 
+class CompiledRule:
+    """A rule (with the tag variables already replaced) that has been parsed once and can be evaluated repeatedly.
+    The evaluation gives the same results and raises the same exceptions as _eval_safe (or _eval_unsafe), but the
+    syntax tree is reused instead of parsing the rule for every evaluation. Rules that only consist of expressions
+    (i.e., all valid rules) are evaluated by the interpreter of the current thread, for which only the tags are
+    rebound. Expressions cannot change the state of the interpreter, so the result does not depend on previous
+    evaluations. Other rules are evaluated by a new interpreter. Only the public API of asteval is used."""
+
+    def __init__(self, rule: str) -> None:
+        self.rule = rule
+        self._code: Any = None
+        self._node: Any = None
+        self._reusable = False
+        self._parse_error: Optional[Tuple[Type[BaseException], Any]] = None
+        if UNSAFE_RULE_EVALUATION:
+            # Syntax errors are raised again on every evaluation
+            try:
+                self._code = compile(rule, "<rule>", "eval")
+            except SyntaxError:
+                pass
+            return
+        interpreter = _make_interpreter()
+        try:
+            self._node = interpreter.parse(rule)
+        except Exception:
+            if not interpreter.error:
+                raise
+            err = interpreter.error[0]
+            self._parse_error = (err.exc, err.msg)
+            return
+        self._reusable = all(isinstance(statement, ast.Expr) for statement in self._node.body)
+
+    def evaluate(self, tags_obj: Tags) -> Any:
+        if UNSAFE_RULE_EVALUATION:
+            return eval(self._code or self.rule, {"__builtins__": {}}, {**safe_eval_cmds, "tags": tags_obj})
+        if self._parse_error is not None:
+            raise self._parse_error[0](self._parse_error[1])
+
+        if self._reusable:
+            aeval = _get_thread_interpreter()
+            aeval.symtable["tags"] = tags_obj
+        else:
+            aeval = _make_interpreter(tags=tags_obj)
+        try:
+            result = aeval.eval(self._node, show_errors=False)
+        finally:
+            # Don't keep the tags of the series alive until the next evaluation
+            aeval.symtable["tags"] = None
+        if aeval.error:
+            err = aeval.error[0]
+            raise err.exc(err.msg)
+        return result
+
+    def check(self) -> Optional[str]:
+        """Returns a description of the problem if the rule cannot be evaluated, i.e., if it has invalid syntax or
+        uses names that are neither the tags nor one of the safe_eval_cmds. Returns None otherwise."""
+        try:
+            tree = ast.parse(self.rule.strip())
+        except SyntaxError as e:
+            return f"Invalid syntax: {e.msg}"
+        known = {"tags", "True", "False", "None", *safe_eval_cmds}
+        unknown = sorted({node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and node.id not in known})
+        if unknown:
+            return f"Unknown names: {', '.join(unknown)}"
+        return None
+
+
+def get_compiled_rule(rule: str, tags: Dict[str, str]) -> CompiledRule:
+    """Returns the compiled form of the rule for the given tags (the replacement of the tag variables depends on
+    which of the tags exist). Compiled rules are cached by their text until a new configuration is loaded."""
+    global _compiled_rules_timestamp
+    if _compiled_rules_timestamp != config.configuration_timestamp or len(_compiled_rules) > MAX_COMPILED_RULES:
+        _compiled_rules.clear()
+        _tag_names_cache.clear()
+        _compiled_rules_timestamp = config.configuration_timestamp
+
+    replaced = replace_tags(rule, tags)
+    compiled = _compiled_rules.get(replaced)
+    if compiled is None:
+        compiled = CompiledRule(replaced)
+        _compiled_rules[replaced] = compiled
+    return compiled
+
+
+def compile_rules(rules: Dict[str, Any]) -> Dict[str, str]:
+    """Compiles the given rules (Rule objects of the configuration) for series that have all tags used by the rules,
+    so that the rules are not parsed when the first series arrives. Returns the enabled rules that cannot be
+    evaluated, together with a description of the problem."""
+    invalid: Dict[str, str] = {}
+    for name, rule in rules.items():
+        rule_text = str(rule.get("rule", "False"))
+        compiled = get_compiled_rule(rule_text, {tag: "" for tag in find_tag_names(rule_text)})
+        problem = compiled.check()
+        if problem is not None and not rule.get("disabled", False):
+            invalid[name] = problem
+    return invalid
+
+
+def _find_missing_tag(rule: str) -> Optional[str]:
+    """Returns the first tag variable that has not been replaced in the rule (because the tag does not exist)."""
+    opening = rule.find("@")
+    closing = rule.find("@", opening + 1)
+    if opening > -1 and closing > 1:
+        return rule[opening + 1:closing]
+    return None
+
+
 def eval_rule(rule: str, tags_dict: Dict[str, str]) -> Any:
     """Parses the given rule, replaces all tag variables with values from the given tags dictionary, and
     evaluates the rule. If the rule is invalid, an exception will be raised."""
     logger.info(f"Rule: {rule}")
-    rule = replace_tags(rule, tags_dict)
+    compiled = get_compiled_rule(rule, tags_dict)
+    rule = compiled.rule
     logger.info(f"Evaluated: {rule}")
     tags_obj = Tags(tags_dict)
     try:
-        if UNSAFE_RULE_EVALUATION:
-            result = _eval_unsafe(rule, tags_obj)
-        else:
-            result = _eval_safe(rule, tags_obj)
+        result = compiled.evaluate(tags_obj)
     except SyntaxError:
-        opening = rule.find("@")
-        closing = rule.find("@", opening + 1)
-        if opening > -1 and closing > 1:
-            raise TagNotFoundException(f"No such tag '{rule[opening+1:closing]}' in tags list.")
+        missing_tag = _find_missing_tag(rule)
+        if missing_tag is not None:
+            raise TagNotFoundException(f"No such tag '{missing_tag}' in tags list.")
         raise
     logger.info(", ".join([f"{tag} = \"{tags_dict[tag]}\"" for tag in tags_obj.tags_accessed()]))
     logger.info(f"Result: {result}")
@@ -137,6 +284,198 @@ def parse_rule(rule: str, tags: Dict[str, str]) -> Tuple[bool, Optional[str], Op
         return False, None, str(e)
 
 
+class BatchRule(NamedTuple):
+    """Settings of a routing rule that are needed for determining the rules that a series triggers."""
+    rule: str
+    disabled: bool
+    fallback: bool
+    discard: bool
+
+
+@dataclass
+class RoutingDiff:
+    series: str
+    before: List[str]
+    after: List[str]
+
+
+@dataclass
+class BatchEvaluation:
+    """Result of evaluating the routing rules for a batch of tag sets. The hits are the number of tag sets for which
+    a rule is triggered (taking into account disabled, fallback, and discard rules, as the router does). If baseline
+    rules are given, the tag sets for which the triggered rules differ are listed in the diffs."""
+    series: int = 0
+    hits: Dict[str, int] = field(default_factory=dict)
+    errors: Dict[str, int] = field(default_factory=dict)
+    baseline_hits: Dict[str, int] = field(default_factory=dict)
+    changed: int = 0
+    diffs: List[RoutingDiff] = field(default_factory=list)
+
+    def merge(self, other: "BatchEvaluation", max_diffs: int) -> None:
+        self.series += other.series
+        self.changed += other.changed
+        for totals, counts in ((self.hits, other.hits), (self.errors, other.errors),
+                               (self.baseline_hits, other.baseline_hits)):
+            for rule_name, count in counts.items():
+                totals[rule_name] = totals.get(rule_name, 0) + count
+        self.diffs.extend(other.diffs[:max(max_diffs - len(self.diffs), 0)])
+
+
+def get_batch_rules(rules: Dict[str, Any]) -> Dict[str, BatchRule]:
+    """Converts the given rules (Rule objects of the configuration) into the form used for batch evaluation."""
+    return {
+        name: BatchRule(str(rule.get("rule", "False")), bool(rule.get("disabled", False)),
+                        bool(rule.get("fallback", False)), rule.get("action", "") == "discard")
+        for name, rule in rules.items()
+    }
+
+
+def evaluate_batch(rules: Dict[str, Any], tag_sets: Iterable[Dict[str, str]],
+                   baseline_rules: Optional[Dict[str, Any]] = None, workers: int = 1, chunk_size: int = 1000,
+                   max_diffs: int = 1000) -> BatchEvaluation:
+    """Evaluates the rules for all given tag sets (e.g., the tags of previously received series) and returns the
+    hit counts per rule. If baseline rules are given (e.g., the current rules when testing changed rules), the
+    series for which the triggered rules would change are reported. The tag sets are evaluated in chunks, which are
+    distributed over a pool of worker processes if more than one worker is requested."""
+    batch_rules = get_batch_rules(rules)
+    batch_baseline = get_batch_rules(baseline_rules) if baseline_rules is not None else None
+    result = BatchEvaluation()
+    chunks = _get_chunks(tag_sets, chunk_size)
+
+    if workers <= 1:
+        for chunk in chunks:
+            result.merge(_evaluate_chunk(batch_rules, batch_baseline, chunk, max_diffs), max_diffs)
+        return result
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Limit the number of submitted chunks, so that the tag sets are not all read into memory at once
+        pending: Deque[Future] = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_evaluate_chunk, batch_rules, batch_baseline, chunk, max_diffs))
+            if len(pending) >= 2 * workers:
+                result.merge(pending.popleft().result(), max_diffs)
+        while pending:
+            result.merge(pending.popleft().result(), max_diffs)
+    return result
+
+
+def read_series_tags(folder: str) -> Iterator[Dict[str, str]]:
+    """Yields the tags of the first instance of every series found in the given folder (or its subfolders)."""
+    series_found = set()
+    for root, _, files in os.walk(folder):
+        for name in sorted(files):
+            if not name.endswith(mercure_names.TAGS):
+                continue
+            series_uid = name.split(mercure_defs.SEPARATOR)[0]
+            if series_uid in series_found:
+                continue
+            try:
+                with open(os.path.join(root, name), "r", encoding="utf-8", errors="surrogateescape") as json_file:
+                    tags: Dict[str, str] = json_codec.load(json_file)
+            except (OSError, ValueError):
+                continue
+            series_found.add(series_uid)
+            yield tags
+
+
+def _get_chunks(tag_sets: Iterable[Dict[str, str]], chunk_size: int) -> Iterator[List[Dict[str, str]]]:
+    iterator = iter(tag_sets)
+    while chunk := list(itertools.islice(iterator, max(chunk_size, 1))):
+        yield chunk
+
+
+def _evaluate_chunk(rules: Dict[str, BatchRule], baseline_rules: Optional[Dict[str, BatchRule]],
+                    chunk: List[Dict[str, str]], max_diffs: int) -> BatchEvaluation:
+    result = BatchEvaluation(series=len(chunk))
+    triggered = _route_chunk(rules, chunk, result.hits, result.errors)
+    if baseline_rules is None:
+        return result
+
+    baseline_triggered = _route_chunk(baseline_rules, chunk, result.baseline_hits, {})
+    for index, (before, after) in enumerate(zip(baseline_triggered, triggered)):
+        if set(before) == set(after):
+            continue
+        result.changed += 1
+        if len(result.diffs) < max_diffs:
+            result.diffs.append(RoutingDiff(str(chunk[index].get("SeriesInstanceUID", index)), before, after))
+    return result
+
+
+def _route_chunk(rules: Dict[str, BatchRule], chunk: List[Dict[str, str]], hits: Dict[str, int],
+                 errors: Dict[str, int]) -> List[List[str]]:
+    """Determines the triggered rules for every tag set of the chunk, in the same way as the router. The leading tag
+    conditions of the rules are first checked column-wise for the whole chunk, so that the rules are only evaluated
+    for the tag sets that can trigger them."""
+    columns: Dict[Tuple[str, bool], List[Any]] = {}
+    candidates: Dict[str, List[bool]] = {}
+    # Tag sets for which the result of a rule is known from its tag conditions alone
+    decided: Dict[str, List[bool]] = {}
+    for name, rule in rules.items():
+        predicates, complete = rule_index.analyze_rule(rule.rule)
+        mask = [True] * len(chunk)
+        strings = [complete] * len(chunk)
+        for predicate in predicates:
+            key = (predicate.tag, predicate.by_attribute)
+            if key not in columns:
+                columns[key] = [rule_index.get_tag_value(tags, predicate.tag, predicate.by_attribute) for tags in chunk]
+            column = columns[key]
+            mask = [
+                selected and value is not None and (not isinstance(value, str) or value in predicate.values)
+                for selected, value in zip(mask, column)
+            ]
+            strings = [string and isinstance(value, str) for string, value in zip(strings, column)]
+        candidates[name] = mask
+        decided[name] = strings
+
+    def is_triggered(name: str, index: int) -> bool:
+        if not candidates[name][index]:
+            return False
+        if decided[name][index]:
+            return True
+        triggered = evaluate_silently(rules[name].rule, chunk[index])
+        if triggered is None:
+            errors[name] = errors.get(name, 0) + 1
+        return bool(triggered)
+
+    results: List[List[str]] = []
+    for index, tags in enumerate(chunk):
+        triggered_rules: List[str] = []
+        if "mercureForceRule" in tags:
+            if tags["mercureForceRule"] in rules:
+                triggered_rules.append(tags["mercureForceRule"])
+        else:
+            fallback_rule = ""
+            for name, rule in rules.items():
+                if rule.disabled:
+                    continue
+                if rule.fallback:
+                    fallback_rule = name
+                    continue
+                if is_triggered(name, index):
+                    triggered_rules.append(name)
+                    if rule.discard:
+                        break
+            if not triggered_rules and fallback_rule and is_triggered(fallback_rule, index):
+                triggered_rules.append(fallback_rule)
+        for name in triggered_rules:
+            hits[name] = hits.get(name, 0) + 1
+        results.append(triggered_rules)
+    return results
+
+
+def evaluate_silently(rule: str, tags: Dict[str, str]) -> Optional[bool]:
+    """Evaluates the rule like parse_rule, but without logging. Returns None if the rule is invalid."""
+    compiled = get_compiled_rule(rule, tags)
+    try:
+        return bool(compiled.evaluate(Tags(tags)))
+    except TagNotFoundException:
+        return False
+    except SyntaxError:
+        return False if _find_missing_tag(compiled.rule) is not None else None
+    except Exception:
+        return None
+
+
 def test_completion_series(value: str) -> str:
     """Tests if the given string with the list of series required for study completion has valid format. If so, True
     is returned as string, otherwise the error description is returned."""
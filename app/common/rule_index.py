@@ -0,0 +1,180 @@
+"""
+rule_index.py
+=============
+Pre-filter for the routing rules. Many rules start with selective conditions like @Modality@ == 'MR'. These leading
+equality (or membership) conditions are extracted from the rules, and the rules are indexed by the tag values that
+they require, so that only the candidate rules need to be evaluated for a series. Rules without such conditions are
+always evaluated.
+"""
+
+# Standard python includes
+import ast
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
+
+# App-specific includes
+import common.rule_evaluation as rule_evaluation
+from common import config
+from common.tags_rule_interface import Tags, get_lowercase_index
+
+
+@dataclass(frozen=True)
+class TagPredicate:
+    """Condition that a tag has one of the given values. If by_attribute is set, the tag has been accessed as
+    tags.Name, which is resolved case-insensitively if there is no exact match."""
+    tag: str
+    by_attribute: bool
+    values: FrozenSet[str]
+
+
+def _get_tag_access(node: ast.AST) -> Optional[Tuple[str, bool]]:
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == "tags":
+        key = node.slice
+        if isinstance(key, ast.Constant) and isinstance(key.value, str):
+            return key.value, False
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "tags":
+        # Attributes of the Tags class itself are not tags
+        if hasattr(Tags, node.attr) or node.attr.startswith("_"):
+            return None
+        return node.attr, True
+    return None
+
+
+def _get_string_values(node: ast.AST) -> Optional[FrozenSet[str]]:
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return frozenset([node.value])
+    return None
+
+
+def _get_predicate(node: ast.AST) -> Optional[TagPredicate]:
+    if not isinstance(node, ast.Compare) or len(node.ops) != 1:
+        return None
+    left, op, right = node.left, node.ops[0], node.comparators[0]
+    if isinstance(op, ast.Eq):
+        access, values = _get_tag_access(left), _get_string_values(right)
+        if access is None:
+            access, values = _get_tag_access(right), _get_string_values(left)
+    elif isinstance(op, ast.In) and isinstance(right, (ast.Tuple, ast.List, ast.Set)):
+        access = _get_tag_access(left)
+        items = [_get_string_values(element) for element in right.elts]
+        values = None if any(item is None for item in items) else frozenset().union(*items)  # type: ignore
+    else:
+        return None
+    if access is None or values is None:
+        return None
+    return TagPredicate(access[0], access[1], values)
+
+
+def extract_predicates(rule: str) -> List[TagPredicate]:
+    """
+    Returns the tag conditions at the beginning of the top-level conjunction of the rule. Conditions after the
+    first term that is not a tag condition are not used, so that the evaluation of the rule is only skipped if it
+    would stop at one of the extracted conditions anyway.
+    """
+    return analyze_rule(rule)[0]
+
+
+def analyze_rule(rule: str) -> Tuple[List[TagPredicate], bool]:
+    """
+    Returns the leading tag conditions of the rule (see extract_predicates) and whether the rule consists of these
+    conditions only, so that its result is determined by the conditions (if the tag values are strings).
+    """
+    text = rule
+    for tag in rule_evaluation.find_tag_names(rule):
+        text = text.replace("@" + tag + "@", f"tags[{tag!r}]")
+    try:
+        tree = ast.parse(text.strip(), mode="eval")
+    except (SyntaxError, ValueError):
+        return [], False
+
+    body = tree.body
+    terms = body.values if isinstance(body, ast.BoolOp) and isinstance(body.op, ast.And) else [body]
+    predicates = []
+    for term in terms:
+        predicate = _get_predicate(term)
+        if predicate is None:
+            break
+        predicates.append(predicate)
+    return predicates, len(predicates) == len(terms)
+
+
+def get_tag_value(tags: Dict[str, str], tag: str, by_attribute: bool) -> Optional[Any]:
+    if tag in tags:
+        return tags[tag]
+    if by_attribute:
+        key = get_lowercase_index(tags).get(tag.lower())
+        if key is not None:
+            return tags[key]
+    return None
+
+
+class RuleIndex:
+    """
+    Index of the rules by the (tag, value) pairs of their first condition. The index is rebuilt whenever a new
+    configuration has been loaded.
+    """
+
+    def __init__(self) -> None:
+        self.evaluated = 0
+        self.skipped = 0
+        self._rules: Any = None
+        self._predicates: Dict[str, List[TagPredicate]] = {}
+        self._unindexed: Set[str] = set()
+        self._by_value: Dict[Tuple[str, bool], Dict[str, Set[str]]] = {}
+        self._lock = threading.Lock()
+
+    def build(self, rules: Dict[str, Any]) -> None:
+        predicates: Dict[str, List[TagPredicate]] = {}
+        unindexed: Set[str] = set()
+        by_value: Dict[Tuple[str, bool], Dict[str, Set[str]]] = {}
+        for rule_name, rule in rules.items():
+            rule_predicates = extract_predicates(str(rule.get("rule", "False")))
+            if not rule_predicates:
+                unindexed.add(rule_name)
+                continue
+            predicates[rule_name] = rule_predicates
+            first = rule_predicates[0]
+            index = by_value.setdefault((first.tag, first.by_attribute), {})
+            for value in first.values:
+                index.setdefault(value, set()).add(rule_name)
+        self._predicates = predicates
+        self._unindexed = unindexed
+        self._by_value = by_value
+        self._rules = rules
+
+    def get_candidates(self, tags: Dict[str, str]) -> Set[str]:
+        """
+        Returns the rules that can be triggered by the given tags. All other rules would evaluate to False.
+        """
+        with self._lock:
+            if config.mercure.rules is not self._rules:
+                self.build(config.mercure.rules)
+            candidates = set(self._unindexed)
+            for (tag, by_attribute), rules_by_value in self._by_value.items():
+                value = get_tag_value(tags, tag, by_attribute)
+                if not isinstance(value, str):
+                    if value is not None:
+                        # Unusual value, let the rule evaluation decide
+                        for rule_names in rules_by_value.values():
+                            candidates.update(rule_names)
+                    continue
+                for rule_name in rules_by_value.get(value, ()):
+                    if self._matches(rule_name, tags):
+                        candidates.add(rule_name)
+            return candidates
+
+    def count(self, evaluated: int, skipped: int) -> None:
+        with self._lock:
+            self.evaluated += evaluated
+            self.skipped += skipped
+
+    def _matches(self, rule_name: str, tags: Dict[str, str]) -> bool:
+        for predicate in self._predicates[rule_name][1:]:
+            value = get_tag_value(tags, predicate.tag, predicate.by_attribute)
+            if value is None or (isinstance(value, str) and value not in predicate.values):
+                return False
+        return True
+
+
+rule_index = RuleIndex()
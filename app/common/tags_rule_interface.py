@@ -1,30 +1,67 @@
-from typing import Any, Dict, Iterator, Set, Union
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, Optional, Set, Tuple, Union
+
+# Number of tags dictionaries for which the lowercase index is kept (usually, the same dictionary is evaluated
+# against all rules before the next one is used)
+MAX_LOWERCASE_INDEXES = 16
+
+_lowercase_indexes: "OrderedDict[int, Tuple[Dict[str, str], int, Dict[str, str]]]" = OrderedDict()
+_lowercase_indexes_lock = threading.Lock()
+
+
+def get_lowercase_index(tags_dict: Dict[str, str]) -> Dict[str, str]:
+    """Returns a mapping from the lowercase tag names to the tag names of the dictionary. If several tag names only
+    differ by case, the first one is used. The index is created on first use and shared by all users of the same
+    dictionary (as long as no tags have been added to it)."""
+    with _lowercase_indexes_lock:
+        entry = _lowercase_indexes.get(id(tags_dict))
+        if entry is not None and entry[0] is tags_dict and entry[1] == len(tags_dict):
+            _lowercase_indexes.move_to_end(id(tags_dict))
+            return entry[2]
+
+    index: Dict[str, str] = {}
+    for key in tags_dict:
+        index.setdefault(key.lower(), key)
+    with _lowercase_indexes_lock:
+        # The dictionary itself is kept in the entry, so that its id cannot be reused while the entry exists
+        _lowercase_indexes[id(tags_dict)] = (tags_dict, len(tags_dict), index)
+        _lowercase_indexes.move_to_end(id(tags_dict))
+        while len(_lowercase_indexes) > MAX_LOWERCASE_INDEXES:
+            _lowercase_indexes.popitem(last=False)
+    return index
 
 
 class Tags:
+    __slots__ = ("_tags_dict", "_tags_accessed", "_lowercase_index")
+
     _tags_dict: Dict[str, str]
     _tags_accessed: Set[str]
+    _lowercase_index: Optional[Dict[str, str]]
 
     def __init__(self, input_dict: Dict[str, str]) -> None:
         self._tags_dict = input_dict
         self._tags_accessed = set()
+        self._lowercase_index = None
 
     def tags_accessed(self) -> Set[str]:
         return self._tags_accessed
 
     def __getattr__(self, name) -> Union[str, Any]:
-        if name in self.__dict__:
-            return self.__dict__[name]
+        if name in Tags.__slots__:
+            # Only happens before the instance has been initialized
+            raise AttributeError(name)
 
         if name in self._tags_dict:
             self._tags_accessed.add(name)
             return self._tags_dict[name]
         else:
-            lowered_name = name.lower()
-            for k in self._tags_dict:
-                if k.lower() == lowered_name:
-                    self._tags_accessed.add(k)
-                    return self._tags_dict[k]
+            if self._lowercase_index is None:
+                self._lowercase_index = get_lowercase_index(self._tags_dict)
+            k = self._lowercase_index.get(name.lower())
+            if k is not None:
+                self._tags_accessed.add(k)
+                return self._tags_dict[k]
             raise TagNotFoundException(f"No such tag '{name}' in tags list.")
 
     def __getitem__(self, name) -> str:
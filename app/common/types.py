@@ -4,14 +4,19 @@ types.py
 Definitions for using TypedDicts throughout mercure.
 """
 
-import json
+import os
 import re
+import threading
+import time
 import typing
+from collections import OrderedDict
 from io import TextIOWrapper
 from os import PathLike
+from pathlib import Path
 # Standard python includes
-from typing import Any, Dict, List, Optional, Type, Union, cast
+from typing import Any, ClassVar, Dict, List, Optional, Tuple, Type, Union, cast
 
+import common.json_codec as json_codec
 from common.event_types import FailStage
 from pydantic import BaseModel, validator
 from typing_extensions import Literal, TypedDict
@@ -33,6 +38,8 @@ class Target(BaseModel, Compat):
     contact: Optional[str] = ""
     comment: str = ""
     direction: Optional[Literal["pull", "push", "both"]] = "push"
+    # Whether the target accepts the series of a study one at a time (e.g., DICOM targets that assemble the study)
+    incremental_dispatch: ClassVar[bool] = False
 
     @property
     def short_description(self) -> str:
@@ -66,6 +73,7 @@ class Target(BaseModel, Compat):
 
 class DicomTarget(Target):
     target_type: Literal["dicom"] = "dicom"
+    incremental_dispatch: ClassVar[bool] = True
     ip: str
     port: str
     aet_target: str
@@ -95,6 +103,7 @@ class DicomTarget(Target):
 
 class DicomTLSTarget(Target):
     target_type: Literal["dicomtls"] = "dicomtls"
+    incremental_dispatch: ClassVar[bool] = True
     ip: str
     port: str
     aet_target: str
@@ -118,6 +127,7 @@ class DicomTLSTarget(Target):
 
 class DicomWebTarget(Target):
     target_type: Literal["dicomweb"] = "dicomweb"
+    incremental_dispatch: ClassVar[bool] = True
     url: str
     qido_url_prefix: Optional[str] = None
     wado_url_prefix: Optional[str] = None
@@ -234,6 +244,7 @@ class Rule(BaseModel, Compat):
     study_trigger_condition: StudyTriggerCondition = "timeout"
     study_force_completion_action: StudyForceCompletionAction = "discard"
     study_trigger_series: str = ""
+    study_incremental_dispatch: bool = False
     priority: Literal["normal", "urgent", "offpeak"] = "normal"
     processing_module: Union[str, List[str]] = ""
     processing_settings: Union[List[Dict[str, Any]], Dict[str, Any]] = {}
@@ -260,6 +271,22 @@ class ProcessingLogsConfig(BaseModel):
 
 class DicomReceiverConfig(BaseModel):
     additional_tags: Dict[str, str] = {}
+    # Tags used by the rules that are not extracted by default (updated whenever the configuration is saved)
+    rule_tags: List[str] = []
+
+
+class QueueWatermarks(BaseModel):
+    # Limits for the number of task folders and their total size (0 = no limit). Routing is resumed once the
+    # queue has dropped to the low watermarks (which default to the high watermarks)
+    high_tasks: int = 0
+    low_tasks: Optional[int] = None
+    high_bytes: int = 0
+    low_bytes: Optional[int] = None
+
+
+class RouterBackpressureConfig(BaseModel):
+    outgoing: QueueWatermarks = QueueWatermarks()
+    processing: QueueWatermarks = QueueWatermarks()
 
 
 class DicomNodeBase(BaseModel):
@@ -313,6 +340,18 @@ class Config(BaseModel, Compat):
     jobs_folder: str
     persistence_folder: str
     router_scan_interval: int       # in seconds
+    router_watch_incoming: bool = False
+    router_reconcile_interval: int = 60  # in seconds
+    router_workers: int = 1
+    router_fanout_mode: Literal["copy", "reflink", "link"] = "copy"
+    router_speculative_routing: bool = False
+    router_adaptive_completion: bool = False
+    router_adaptive_percentile: float = 99
+    router_adaptive_min_trigger: int = 5  # in seconds
+    router_count_completion: bool = False
+    router_takeover_timeout: int = 60  # in seconds
+    router_duplicate_window: int = 0  # in seconds
+    router_backpressure: RouterBackpressureConfig = RouterBackpressureConfig()
     dispatcher_scan_interval: int   # in seconds
     cleaner_scan_interval: int      # in seconds
     retention: int                  # in seconds (3 days)
@@ -390,6 +429,8 @@ class TaskStudy(BaseModel, Compat):
     last_receive_time: str
     received_series: Optional[List[str]]
     received_series_uid: Optional[List[str]]
+    # Series that have already been dispatched while the study was received (incremental dispatch)
+    forwarded_series_uid: Optional[List[str]] = None
     complete_force: bool = False
     complete_force_action: Optional[StudyForceCompletionAction] = "discard"
 
@@ -440,20 +481,78 @@ class Task(BaseModel, Compat):
 
     @classmethod
     def from_file(cls, file_or_path: Union[PathLike, TextIOWrapper]) -> 'Task':
+        content: Union[str, bytes]
         if isinstance(file_or_path, TextIOWrapper):
             content = file_or_path.read()
         else:
-            with open(file_or_path, "r") as f:
+            with open(file_or_path, "rb") as f:
                 content = f.read()
-        return cls(**json.loads(content))
+        return cls(**json_codec.loads(content))
 
     def to_file(self,  file_or_path: Union[PathLike, TextIOWrapper]) -> None:
         if isinstance(file_or_path, TextIOWrapper):
-            json.dump(self.dict(), file_or_path)
+            json_codec.dump(self.dict(), file_or_path)
         else:
             with open(file_or_path, "w") as f:
-                json.dump(self.dict(), f)
+                json_codec.dump(self.dict(), f)
 
 
 class TaskHasStudy(Task): 
     study: TaskStudy
+
+
+# Task files modified within this time before they have been parsed are parsed again on the next access, as further
+# changes within the timestamp granularity of the file system would not be noticed
+TASK_CACHE_RACY_SECONDS = 1
+
+
+class TaskCache:
+    """
+    Process-local cache of parsed task files, so that the polling loops of the services only parse a task file when
+    it has changed. The entries are validated with the inode, modification time, and size of the file. The returned
+    tasks are shared by all callers and must not be modified (use copy(deep=True) to obtain a task for modification).
+    """
+
+    def __init__(self, max_entries: int = 10000) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[str, type], Tuple[Tuple[int, int, int], float, Task]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: Union[str, PathLike], task_type: Type[Task] = Task) -> Task:
+        """
+        Returns the parsed task file. Raises the same exceptions as Task.from_file if the file cannot be read or is
+        invalid (invalid files are not cached).
+        """
+        key = (os.fspath(path), task_type)
+        read_time = time.time()
+        stat = os.stat(path)
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature and entry[1] - stat.st_mtime_ns / 1e9 > TASK_CACHE_RACY_SECONDS:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[2]
+            self.misses += 1
+
+        task = task_type.from_file(Path(path))
+        with self._lock:
+            self._entries[key] = (signature, read_time, task)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return task
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+task_cache = TaskCache()
@@ -24,7 +24,7 @@ import common.notification as notification
 import graphyte
 import hupper
 from common.constants import mercure_defs, mercure_names
-from common.types import Task
+from common.types import task_cache
 from dispatch.send import execute
 from dispatch.status import is_ready_for_sending
 
@@ -57,6 +57,8 @@ def dispatch() -> None:
         return
 
     helper.g_log("events.run", 1)
+    helper.g_log("task_cache.hits", task_cache.hits)
+    helper.g_log("task_cache.misses", task_cache.misses)
 
     try:
         config.read_config()
@@ -76,7 +78,7 @@ def dispatch() -> None:
 
     def get_priority(task_folder: Path) -> Literal['normal', 'urgent', 'offpeak']:
         try:
-            task_instance = Task.from_file(task_folder / mercure_names.TASKFILE)
+            task_instance = task_cache.get(task_folder / mercure_names.TASKFILE)
             applied_rule = config.mercure.rules.get(task_instance.info.get("applied_rule"))
             if applied_rule is not None:
                 return applied_rule.priority
@@ -6,7 +6,6 @@ to target destinations.
 """
 
 # Standard python includes
-import json
 import shutil
 import time
 from datetime import datetime
@@ -14,6 +13,7 @@ from pathlib import Path
 from typing import Dict, cast
 
 import common.config as config
+import common.json_codec as json_codec
 import common.log_helpers as log_helpers
 import common.monitor as monitor
 import common.notification as notification
@@ -116,6 +116,11 @@ def execute(
     if time.time() < dispatch_info.get("next_retry_at", 0):
         return
 
+    # The task from the task cache is shared, so work on a copy
+    task_content = task_content.copy(deep=True)
+    dispatch_info = cast(TaskDispatch, task_content.dispatch)
+    task_info = task_content.info
+
     uid = task_info.get("uid", "uid-missing")
     if (uid == "uid-missing"):
         logger.warning(f"Missing information for folder {source_folder}", task_content.id)
@@ -320,13 +325,13 @@ def update_fail_stage(source_folder: Path, fail_stage: FailStage) -> bool:
     target_json_path: Path = source_folder / in_string / mercure_names.TASKFILE
     try:
         with open(target_json_path, "r") as file:
-            task: Task = Task(**json.load(file))
+            task: Task = Task(**json_codec.load(file))
 
         task_info = task.info
         task_info.fail_stage = str(fail_stage)  # type: ignore
 
         with open(target_json_path, "w") as file:
-            json.dump(task.dict(), file)
+            json_codec.dump(task.dict(), file)
     except Exception:
         return False
 
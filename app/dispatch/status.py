@@ -12,7 +12,7 @@ from typing import Optional
 from common import config
 # App-specific includes
 from common.constants import mercure_names
-from common.types import Task
+from common.types import Task, task_cache
 
 logger = config.get_logger()
 
@@ -41,13 +41,14 @@ def is_ready_for_sending(folder) -> Optional[Task]:
 def is_target_json_valid(folder) -> Optional[Task]:
     """
     Checks if the task.json file exists and is valid. Returns the content
-    of the file (or None if the file is invalid)
+    of the file (or None if the file is invalid). The returned task is shared
+    via the task cache and must not be modified
     """
     path = Path(folder) / mercure_names.TASKFILE
     if not path.exists():
         return None
     try:
-        target = Task.from_file(path)
+        target = task_cache.get(path)
     except Exception:
         logger.exception("task.json has invalid format", "unknown")
         return None
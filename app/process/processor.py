@@ -26,7 +26,7 @@ import common.notification as notification
 import graphyte
 import hupper
 from common.constants import mercure_defs, mercure_events, mercure_names
-from common.types import Task, TaskProcessing
+from common.types import Task, TaskProcessing, task_cache
 from process.process_series import (handle_processor_output, move_results, process_series, push_input_images, push_input_task,
                                     trigger_notification)
 from process.status import is_ready_for_processing
@@ -72,6 +72,8 @@ async def search_folder(counter) -> bool:
     global processor_is_locked
     global nomad_connection
     helper.g_log("events.run", 1)
+    helper.g_log("task_cache.hits", task_cache.hits)
+    helper.g_log("task_cache.misses", task_cache.misses)
 
     tasks: Dict[str, float] = {}
 
@@ -241,8 +243,7 @@ def prioritize_tasks(sorted_tasks: list, counter: int) -> Optional[Path]:
     for task in sorted_tasks:
         task_folder = Path(task)
         taskfile_path = task_folder / mercure_names.TASKFILE
-        with open(taskfile_path, "r") as f:
-            task_instance = Task(**json.load(f))
+        task_instance = task_cache.get(taskfile_path)
         applied_rule = config.mercure.rules.get(task_instance.info.get("applied_rule"))
         if applied_rule is None:
             continue
@@ -100,7 +100,9 @@ port=$(jq '.port' $config)
 bookkeeper=$(jq -r '.bookkeeper' $config)
 accept_compressed=$(jq -r '.accept_compressed_images' $config)
 bookkeeper_api_key=$(jq -r '.bookkeeper_api_key' $config)
-jq -r ".dicom_receiver.additional_tags // {} | keys_unsorted[]" $config > "./dcm_extra_tags" || (echo "Failed to parse and configure extra DICOM tags to read." && exit 1)
+# Additional tags configured by the user and tags needed by the rules (without duplicates)
+extra_tags=$(jq -r "(.dicom_receiver.additional_tags // {} | keys_unsorted[]), (.dicom_receiver.rule_tags // [] | .[])" $config) || (echo "Failed to parse and configure extra DICOM tags to read." && exit 1)
+echo "$extra_tags" | awk '!seen[$0]++' > "./dcm_extra_tags"
 
 # Check if incoming folder exists
 if [ ! -d "$incoming" ]; then
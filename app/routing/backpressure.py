@@ -0,0 +1,135 @@
+"""
+backpressure.py
+===============
+Monitors the depth of the downstream queues (the task folders in the outgoing and processing folder). If a queue
+exceeds its high watermark, the router defers series that would add to the queue, except for urgent series, until
+the queue has dropped below the low watermark again.
+"""
+
+# Standard python includes
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Set, Tuple
+
+# App-specific includes
+import common.config as config
+import common.helper as helper
+from common.constants import mercure_actions, mercure_options
+from common.types import QueueWatermarks
+
+# Create local logger instance
+logger = config.get_logger()
+
+OUTGOING = "outgoing"
+PROCESSING = "processing"
+
+
+@dataclass
+class QueueState:
+    throttled: bool = False
+    tasks: int = 0
+    size: int = 0
+    # Size of the task folders, together with the modification time of the folder when it was measured
+    folder_sizes: Dict[str, Tuple[float, int]] = field(default_factory=dict)
+
+
+queues: Dict[str, QueueState] = {OUTGOING: QueueState(), PROCESSING: QueueState()}
+
+
+def get_watermarks(queue: str) -> QueueWatermarks:
+    watermarks: QueueWatermarks = getattr(config.mercure.router_backpressure, queue)
+    return watermarks
+
+
+def is_enabled() -> bool:
+    return any(get_watermarks(queue).high_tasks > 0 or get_watermarks(queue).high_bytes > 0 for queue in queues)
+
+
+def get_queues(rule_names: Iterable[str]) -> Set[str]:
+    """
+    Returns the queues that the series is added to if it is routed with the given rules.
+    """
+    result = set()
+    for rule_name in rule_names:
+        rule = config.mercure.rules.get(rule_name)
+        if rule is None or rule.get("action_trigger", mercure_options.SERIES) != mercure_options.SERIES:
+            # Study-level rules add to the studies folder first
+            continue
+        action = rule.get("action", "")
+        if action == mercure_actions.ROUTE:
+            result.add(OUTGOING)
+        elif action in (mercure_actions.PROCESS, mercure_actions.BOTH):
+            result.add(PROCESSING)
+    return result
+
+
+def update_queues() -> Set[str]:
+    """
+    Measures the depth of all queues with watermarks and returns the queues that are currently throttled.
+    """
+    throttled = set()
+    for queue, state in queues.items():
+        watermarks = get_watermarks(queue)
+        if watermarks.high_tasks <= 0 and watermarks.high_bytes <= 0:
+            state.throttled = False
+            continue
+        measure_queue(getattr(config.mercure, f"{queue}_folder"), state, watermarks.high_bytes > 0)
+
+        low_tasks = watermarks.high_tasks if watermarks.low_tasks is None else watermarks.low_tasks
+        low_bytes = watermarks.high_bytes if watermarks.low_bytes is None else watermarks.low_bytes
+        above_high = ((watermarks.high_tasks > 0 and state.tasks >= watermarks.high_tasks)
+                      or (watermarks.high_bytes > 0 and state.size >= watermarks.high_bytes))
+        above_low = ((watermarks.high_tasks > 0 and state.tasks > low_tasks)
+                     or (watermarks.high_bytes > 0 and state.size > low_bytes))
+        if not state.throttled and above_high:
+            logger.warning(f"Queue {queue} has reached its high watermark ({state.tasks} tasks, {state.size} bytes). "
+                           "Deferring non-urgent series.")
+            state.throttled = True
+        elif state.throttled and not above_low:
+            logger.info(f"Queue {queue} has dropped to its low watermark. Resuming routing.")
+            state.throttled = False
+
+        helper.g_log(f"backpressure.{queue}.tasks", state.tasks)
+        helper.g_log(f"backpressure.{queue}.bytes", state.size)
+        helper.g_log(f"backpressure.{queue}.throttled", int(state.throttled))
+        if state.throttled:
+            throttled.add(queue)
+    return throttled
+
+
+def measure_queue(folder: str, state: QueueState, measure_size: bool) -> None:
+    """
+    Counts the task folders in the queue and, if needed, their total size. The size of a task folder is only
+    measured again if the folder has been modified.
+    """
+    tasks = 0
+    sizes: Dict[str, Tuple[float, int]] = {}
+    try:
+        for entry in os.scandir(folder):
+            if not entry.is_dir():
+                continue
+            tasks += 1
+            if not measure_size:
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            cached = state.folder_sizes.get(entry.name)
+            sizes[entry.name] = cached if cached is not None and cached[0] == mtime else (mtime, get_folder_size(entry.path))
+    except FileNotFoundError:
+        pass
+    state.tasks = tasks
+    state.folder_sizes = sizes
+    state.size = sum(size for _, size in sizes.values())
+
+
+def get_folder_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.stat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                continue
+    return size
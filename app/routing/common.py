@@ -1,15 +1,56 @@
+import dataclasses
 import typing
 import uuid
 from dataclasses import dataclass, field
 from pathlib import Path
 
+import common.config as config
+import common.json_codec as json_codec
+from common.constants import mercure_actions
+from common.types import Rule
+
 
 def generate_task_id() -> str:
     new_uuid = str(uuid.uuid1())
     return new_uuid
 
 
+def get_incremental_targets(rule: Rule) -> typing.Tuple[typing.List[str], typing.List[str]]:
+    """
+    Returns the targets of a study-level routing rule that receive the series one at a time while the study is
+    received (if incremental dispatch is enabled for the rule), and the targets that receive the complete study.
+    """
+    targets = [rule.target] if isinstance(rule.target, str) else list(rule.target)
+    targets = [target for target in targets if target]
+    if not rule.study_incremental_dispatch or rule.action != mercure_actions.ROUTE:
+        return [], targets
+    incremental = [target for target in targets
+                   if target in config.mercure.targets and config.mercure.targets[target].incremental_dispatch]
+    return incremental, [target for target in targets if target not in incremental]
+
+
 @dataclass
 class SeriesItem:
     modification_time: float = 0
     files: typing.Set[Path] = field(default_factory=set)
+
+
+@dataclass
+class SpeculativeClaim:
+    """
+    Destination that has been prepared for a series while it is still being received (speculative routing). The
+    claim is stored in the incoming folder of the series, so that any router instance can complete the series.
+    """
+    task_id: str
+    target_folder: str
+    applied_rule: str
+    triggered_rules: typing.Dict[str, bool] = field(default_factory=dict)
+
+    @classmethod
+    def from_file(cls, path: Path) -> "SpeculativeClaim":
+        with open(path, "r") as claim_file:
+            return cls(**json_codec.load(claim_file))
+
+    def to_file(self, path: Path) -> None:
+        with open(path, "w") as claim_file:
+            json_codec.dump(dataclasses.asdict(self), claim_file)
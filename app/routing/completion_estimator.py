@@ -0,0 +1,114 @@
+"""
+completion_estimator.py
+=======================
+Learns how long the gaps between the arrival of instances of a series typically are, separately for each sender AET
+and modality, so that series can be considered complete before the configured series completion trigger has passed.
+"""
+
+# Standard python includes
+import math
+import os
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Optional, Tuple
+
+# App-specific includes
+import common.json_codec as json_codec
+from common.constants import mercure_defs, mercure_names, mercure_options
+
+# Number of observed gaps that are needed before the learned value is used
+MIN_SAMPLES = 20
+# Number of most recent gaps that are kept for every sender and modality
+MAX_SAMPLES = 500
+
+SeriesKey = Tuple[str, str]
+
+
+@dataclass
+class SeriesArrival:
+    key: SeriesKey
+    last_arrival: float
+
+
+class CompletionEstimator:
+    """
+    Tracks the time between consecutive modifications of the series folders (i.e., the arrival of new instances)
+    and estimates the completion trigger as a high percentile of the observed gaps. The sender AET and modality of
+    a series are read from its first tags file when the series is observed for the first time.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.percentile: float = 99
+        self.min_trigger: float = 0
+        self.folder = ""
+        self._series: Dict[str, SeriesArrival] = {}
+        self._gaps: Dict[SeriesKey, Deque[float]] = {}
+        self._estimates: Dict[SeriesKey, Optional[float]] = {}
+
+    def configure(self, enabled: bool, percentile: float, min_trigger: float, folder: str) -> None:
+        if percentile != self.percentile or min_trigger != self.min_trigger:
+            self._estimates = {}
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_trigger = min_trigger
+        self.folder = folder
+
+    def observe(self, series_uid: str, modification_time: float) -> Optional[float]:
+        """
+        Records the modification of the series folder and returns the learned completion trigger for the series,
+        or None if not enough gaps have been observed for its sender and modality yet.
+        """
+        series = self._series.get(series_uid)
+        if series is None:
+            key = self._read_key(series_uid)
+            if key is None:
+                return None
+            self._series[series_uid] = SeriesArrival(key, modification_time)
+            return self.get_trigger(key)
+
+        gap = modification_time - series.last_arrival
+        if gap > 0:
+            self._gaps.setdefault(series.key, deque(maxlen=MAX_SAMPLES)).append(gap)
+            self._estimates.pop(series.key, None)
+            series.last_arrival = modification_time
+        return self.get_trigger(series.key)
+
+    def discard(self, series_uid: str) -> None:
+        self._series.pop(series_uid, None)
+
+    def get_trigger(self, key: SeriesKey) -> Optional[float]:
+        if key not in self._estimates:
+            samples = self._gaps.get(key)
+            if samples is None or len(samples) < MIN_SAMPLES:
+                self._estimates[key] = None
+            else:
+                ordered = sorted(samples)
+                index = min(len(ordered) - 1, max(0, math.ceil(self.percentile / 100 * len(ordered)) - 1))
+                self._estimates[key] = max(self.min_trigger, ordered[index])
+        return self._estimates[key]
+
+    def get_estimates(self) -> Dict[SeriesKey, float]:
+        """
+        Returns the learned completion triggers for all senders and modalities with enough observations.
+        """
+        estimates = {}
+        for key in self._gaps:
+            trigger = self.get_trigger(key)
+            if trigger is not None:
+                estimates[key] = trigger
+        return estimates
+
+    def _read_key(self, series_uid: str) -> Optional[SeriesKey]:
+        series_prefix = series_uid + mercure_defs.SEPARATOR
+        try:
+            for entry in os.scandir(os.path.join(self.folder, series_uid)):
+                if entry.name.endswith(mercure_names.TAGS) and entry.name.startswith(series_prefix):
+                    with open(entry.path, "r", encoding="utf-8", errors="surrogateescape") as json_file:
+                        tags = json_codec.load(json_file)
+                    return (str(tags.get("SenderAET", mercure_options.MISSING)),
+                            str(tags.get("Modality", mercure_options.MISSING)))
+        except (OSError, ValueError):
+            # Folder has been removed or the tags file is still being written
+            pass
+        return None
@@ -0,0 +1,124 @@
+"""
+completion_scheduler.py
+=======================
+Keeps track of the completion deadlines of the series in the incoming folder, so that the router only needs to
+look at series whose deadline has passed instead of checking the age of every series on every run.
+"""
+
+# Standard python includes
+import heapq
+from typing import Dict, List, Optional, Set, Tuple
+
+# App-specific includes
+from routing.completion_estimator import CompletionEstimator
+from routing.expected_instances import SETTLE_TIME, ExpectedInstances
+
+
+class CompletionScheduler:
+    """
+    Min-heap of series completion deadlines (time of last modification plus the series completion trigger).
+    Deadlines are updated lazily: if a series receives new instances, a new heap entry is pushed and the
+    outdated entry is skipped when it reaches the top of the heap. If a completion estimator is attached and
+    enabled, the deadline of a series is based on the learned trigger for its sender and modality, but never
+    later than with the configured trigger. If an instance counter is attached and enabled, series that have
+    received all expected instances are completed right away.
+    """
+
+    def __init__(self, estimator: Optional[CompletionEstimator] = None,
+                 counter: Optional[ExpectedInstances] = None) -> None:
+        # Series that have not timed out yet, with their modification time (as needed by route_studies)
+        self.pending: Dict[str, float] = {}
+        # Series that have timed out but have not been routed yet
+        self.complete: Set[str] = set()
+        self.trigger: float = 0
+        self.estimator = estimator
+        self.counter = counter
+        # Total time by which series have been completed earlier than with the configured trigger (in seconds)
+        self.saved_time: float = 0
+        self._triggers: Dict[str, float] = {}
+        self._deadlines: Dict[str, float] = {}
+        self._heap: List[Tuple[float, str]] = []
+
+    def set_trigger(self, trigger: float) -> None:
+        """
+        Sets the series completion trigger (in seconds). If the value has changed, the deadlines of all pending
+        series are recalculated.
+        """
+        if trigger == self.trigger:
+            return
+        self.trigger = trigger
+        self._deadlines = {series_uid: mtime + self._get_trigger(series_uid) for series_uid, mtime in self.pending.items()}
+        self._heap = [(deadline, series_uid) for series_uid, deadline in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+    def schedule(self, series_uid: str, modification_time: float) -> None:
+        """
+        Adds the series or updates its deadline after new instances have been received.
+        """
+        self.complete.discard(series_uid)
+        self.pending[series_uid] = modification_time
+        learned = None
+        if self.estimator is not None and self.estimator.enabled:
+            learned = self.estimator.observe(series_uid, modification_time)
+        if self.counter is not None and self.counter.enabled and self.counter.is_complete(series_uid):
+            learned = SETTLE_TIME if learned is None else min(learned, SETTLE_TIME)
+        if learned is None:
+            self._triggers.pop(series_uid, None)
+        else:
+            self._triggers[series_uid] = learned
+        deadline = modification_time + self._get_trigger(series_uid)
+        if self._deadlines.get(series_uid) == deadline:
+            return
+        self._deadlines[series_uid] = deadline
+        heapq.heappush(self._heap, (deadline, series_uid))
+
+        # Drop outdated entries if they make up the majority of the heap
+        if len(self._heap) > 2 * len(self._deadlines) + 100:
+            self._heap = [(d, s) for d, s in self._heap if self._deadlines.get(s) == d]
+            heapq.heapify(self._heap)
+
+    def track(self, series_uid: str, modification_time: float) -> None:
+        """
+        Adds the series as pending without scheduling its completion (e.g., if it is routed by another router
+        instance). A scheduled deadline of the series is dropped.
+        """
+        self.complete.discard(series_uid)
+        self._deadlines.pop(series_uid, None)
+        self.pending[series_uid] = modification_time
+
+    def is_scheduled(self, series_uid: str) -> bool:
+        return series_uid in self._deadlines or series_uid in self.complete
+
+    def discard(self, series_uid: str) -> None:
+        """
+        Removes the series from the scheduler (e.g., after it has been routed). The heap entry is removed lazily.
+        """
+        self.pending.pop(series_uid, None)
+        self._deadlines.pop(series_uid, None)
+        self._triggers.pop(series_uid, None)
+        self.complete.discard(series_uid)
+        if self.estimator is not None:
+            self.estimator.discard(series_uid)
+        if self.counter is not None:
+            self.counter.discard(series_uid)
+
+    def update(self, now: float) -> Set[str]:
+        """
+        Moves all series whose deadline has passed from the pending to the complete series. Returns the series
+        that have become complete during this call.
+        """
+        completed = set()
+        while self._heap and self._heap[0][0] < now:
+            deadline, series_uid = heapq.heappop(self._heap)
+            if self._deadlines.get(series_uid) != deadline:
+                # Outdated entry, the series has been modified or removed in the meantime
+                continue
+            del self._deadlines[series_uid]
+            self.pending.pop(series_uid, None)
+            self.complete.add(series_uid)
+            completed.add(series_uid)
+            self.saved_time += self.trigger - self._get_trigger(series_uid)
+        return completed
+
+    def _get_trigger(self, series_uid: str) -> float:
+        return min(self.trigger, self._triggers.get(series_uid, self.trigger))
@@ -0,0 +1,158 @@
+"""
+duplicate_filter.py
+===================
+Suppression of duplicate DICOM instances. The router remembers the SOPInstanceUIDs and content hashes of the
+instances that it has routed recently, so that instances that are received again with identical content (e.g., if
+a modality re-sends a series or overlapping accessions are retrieved) are not routed and sent again.
+"""
+
+# Standard python includes
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# App-specific includes
+import common.config as config
+import common.json_codec as json_codec
+import common.helper as helper
+import common.monitor as monitor
+from common.constants import mercure_names
+
+# Create local logger instance
+logger = config.get_logger()
+
+# Maximum number of instances that are remembered, independent of the time window
+MAX_ENTRIES = 1000000
+CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass
+class RoutedInstance:
+    digest: bytes
+    routed_time: float
+
+
+class RecentInstances:
+    """
+    Bounded index of the recently routed instances, ordered by the time when they have been routed. The index is
+    shared between the routing threads.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES) -> None:
+        self.max_entries = max_entries
+        # Number of instances and bytes that have been suppressed since the router has been started
+        self.suppressed_instances = 0
+        self.suppressed_bytes = 0
+        self._entries: "OrderedDict[str, RoutedInstance]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_duplicate(self, sop_instance_uid: str, digest: bytes, now: float, window: float) -> bool:
+        """
+        Returns True if an instance with the same SOPInstanceUID and content has been routed within the time window.
+        """
+        with self._lock:
+            self._prune(now, window)
+            entry = self._entries.get(sop_instance_uid)
+            return entry is not None and entry.digest == digest
+
+    def record_routed(self, sop_instance_uid: str, digest: bytes, now: float) -> None:
+        """
+        Remembers the instance as routed. A different content for the same SOPInstanceUID (e.g., a corrected
+        instance) replaces the previous entry.
+        """
+        with self._lock:
+            self._entries[sop_instance_uid] = RoutedInstance(digest, now)
+            self._entries.move_to_end(sop_instance_uid)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def add_suppressed(self, instances: int, size: int) -> None:
+        with self._lock:
+            self.suppressed_instances += instances
+            self.suppressed_bytes += size
+
+    def _prune(self, now: float, window: float) -> None:
+        while self._entries:
+            oldest = next(iter(self._entries.values()))
+            if now - oldest.routed_time <= window:
+                break
+            self._entries.popitem(last=False)
+
+
+recent_instances = RecentInstances()
+
+
+def get_instance_key(folder: Path, file_stem: str) -> Optional[Tuple[str, bytes, int]]:
+    """
+    Returns the SOPInstanceUID, the content hash, and the size of the given instance, or None if the instance
+    cannot be identified.
+    """
+    try:
+        with open(folder / (file_stem + mercure_names.TAGS), "r", encoding="utf-8", errors="surrogateescape") as json_file:
+            sop_instance_uid = json_codec.load(json_file).get("SOPInstanceUID")
+        if not sop_instance_uid:
+            return None
+        digest = hashlib.blake2b(digest_size=16)
+        size = 0
+        with open(folder / (file_stem + mercure_names.DCM), "rb") as dcm_file:
+            while chunk := dcm_file.read(CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+        return str(sop_instance_uid), digest.digest(), size
+    except (OSError, ValueError):
+        return None
+
+
+def remove_duplicates(
+    task_id: str, series_uid: str, file_list: List[str], now: float
+) -> Tuple[List[str], Dict[str, Tuple[str, bytes]]]:
+    """
+    Deletes the instances of the series that are exact duplicates of instances routed within the configured time
+    window. Returns the remaining files and the SOPInstanceUIDs and content hashes of the remaining instances, which
+    are passed to record_routed() once the series has been routed. Instances that cannot be identified are always
+    kept.
+    """
+    folder = Path(config.mercure.incoming_folder) / series_uid
+    window = config.mercure.router_duplicate_window
+    remaining: List[str] = []
+    instance_keys: Dict[str, Tuple[str, bytes]] = {}
+    duplicates = 0
+    duplicate_size = 0
+    for file_stem in file_list:
+        key = get_instance_key(folder, file_stem)
+        if key is None or not recent_instances.is_duplicate(key[0], key[1], now, window):
+            remaining.append(file_stem)
+            if key is not None:
+                instance_keys[file_stem] = (key[0], key[1])
+            continue
+        try:
+            (folder / (file_stem + mercure_names.TAGS)).unlink()
+            (folder / (file_stem + mercure_names.DCM)).unlink()
+        except Exception:
+            logger.error(f"Error while removing duplicate file {file_stem}", task_id)  # handle_error
+            continue
+        duplicates += 1
+        duplicate_size += key[2]
+
+    if duplicates:
+        logger.info(f"Removed {duplicates} duplicate instances of series {series_uid}")
+        recent_instances.add_suppressed(duplicates, duplicate_size)
+        monitor.send_task_event(monitor.task_event.REMOVE, task_id, duplicates, "", "Removed duplicate instances")
+        helper.g_log("events.duplicate_instances", duplicates)
+        helper.g_log("events.duplicate_bytes", duplicate_size)
+    return remaining, instance_keys
+
+
+def record_routed(series_uid: str, instance_keys: Dict[str, Tuple[str, bytes]], now: float) -> None:
+    """
+    Remembers the instances of the series that have been handed to their destination, i.e., that are no longer in
+    the incoming folder. Instances that are still there (e.g., because routing has failed) are not remembered, so
+    that they are routed again if they are re-sent.
+    """
+    folder = Path(config.mercure.incoming_folder) / series_uid
+    for file_stem, (sop_instance_uid, digest) in instance_keys.items():
+        if not (folder / (file_stem + mercure_names.DCM)).exists():
+            recent_instances.record_routed(sop_instance_uid, digest, now)
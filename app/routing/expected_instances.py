@@ -0,0 +1,153 @@
+"""
+expected_instances.py
+=====================
+Tracks the number of received instances of the series in the incoming folder, so that a series can be considered
+complete as soon as the expected number of instances has arrived, instead of waiting for the series completion
+trigger. The expected number is recorded when a series is retrieved by the query tool (in a file named
+<SeriesInstanceUID>.expected in the incoming folder). Tags such as ImagesInAcquisition are not used, as they only
+count the instances of a single acquisition and not of the series.
+"""
+
+# Standard python includes
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Set
+
+# App-specific includes
+from common.constants import mercure_defs, mercure_names
+from routing.common import SpeculativeClaim
+
+# Delay before a series with the expected number of instances is routed, so that getdcmtags can finish writing
+# the tags file of the last instance (in seconds)
+SETTLE_TIME = 1
+
+# Marker for series whose expected number of instances is not known
+UNKNOWN = 0
+
+# Age after which the recorded expected number of a series that has not arrived is removed (in seconds)
+EXPECTED_MAX_AGE = 24 * 60 * 60
+# Interval between the checks for expected numbers of series that have not arrived (in seconds)
+PRUNE_INTERVAL = 60
+
+
+def write_expected_instances(folder: str, series_uid: str, count: int) -> None:
+    """
+    Records the expected number of instances of a series in the given incoming folder. The file is written
+    under a temporary name first, so that the router never reads an incomplete file.
+    """
+    target = Path(folder) / (series_uid + mercure_names.EXPECTED)
+    temp_file = Path(folder) / f".{series_uid}{mercure_names.EXPECTED}"
+    temp_file.write_text(str(count))
+    temp_file.rename(target)
+
+
+class ExpectedInstances:
+    """
+    Compares the number of received instances of a series with the expected number of instances. The expected
+    number is read once per series. The received instances are counted once by listing the series folder (and the
+    prepared task folder, if the series is routed speculatively). Afterwards, the count is kept up to date from the
+    tags files reported by the watcher of the incoming folder (see incoming_watcher), or, if the folder is scanned
+    instead of watched, by listing the folders again on every modification of the series.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.folder = ""
+        # True while the received tags files are reported through record_received()
+        self.counting = False
+        self._expected: Dict[str, int] = {}
+        # Names of the received tags files of the series with a known expected number
+        self._received: Dict[str, Set[str]] = {}
+        self._last_prune: float = 0
+
+    def configure(self, enabled: bool, folder: str) -> None:
+        self.enabled = enabled
+        self.folder = folder
+
+    def is_complete(self, series_uid: str) -> bool:
+        """
+        Returns True if all expected instances of the series have been received.
+        """
+        expected = self._expected.get(series_uid)
+        if expected is None:
+            expected = self._read_expected(series_uid)
+            self._expected[series_uid] = expected
+        if expected == UNKNOWN:
+            return False
+        if not self.counting or series_uid not in self._received:
+            self._received[series_uid] = self._list_received(series_uid)
+        return len(self._received[series_uid]) >= expected
+
+    def record_received(self, series_uid: str, names: Iterable[str]) -> None:
+        """
+        Adds the names of newly received tags files to the count of the series. Series whose received instances
+        have not been listed yet are skipped, as the files are included once the folder is listed.
+        """
+        received = self._received.get(series_uid)
+        if received is not None:
+            received.update(names)
+
+    def discard(self, series_uid: str) -> None:
+        """
+        Forgets the series and removes the recorded expected number, if any (e.g., after the series has been routed).
+        """
+        self._expected.pop(series_uid, None)
+        self._received.pop(series_uid, None)
+        if not self.folder:
+            return
+        try:
+            os.unlink(os.path.join(self.folder, series_uid + mercure_names.EXPECTED))
+        except OSError:
+            pass
+
+    def prune(self, now: float) -> None:
+        """
+        Removes the recorded expected numbers of series that have not arrived within EXPECTED_MAX_AGE (e.g., if the
+        retrieval has failed), as they are otherwise only removed once the series has been routed. The incoming
+        folder is checked at most every PRUNE_INTERVAL seconds.
+        """
+        if not self.folder or now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        try:
+            entries = [entry for entry in os.scandir(self.folder) if entry.name.endswith(mercure_names.EXPECTED)]
+        except OSError:
+            return
+        for entry in entries:
+            # Temporary files (starting with a dot) are left behind if the query tool has been interrupted
+            series_uid = entry.name[: -len(mercure_names.EXPECTED)].lstrip(".")
+            if series_uid in self._expected or os.path.isdir(os.path.join(self.folder, series_uid)):
+                continue
+            try:
+                if now - entry.stat().st_mtime > EXPECTED_MAX_AGE:
+                    os.unlink(entry.path)
+            except OSError:
+                continue
+
+    def _read_expected(self, series_uid: str) -> int:
+        try:
+            with open(os.path.join(self.folder, series_uid + mercure_names.EXPECTED), "r") as expected_file:
+                return max(UNKNOWN, int(expected_file.read().strip()))
+        except (OSError, ValueError):
+            return UNKNOWN
+
+    def _list_received(self, series_uid: str) -> Set[str]:
+        folder = os.path.join(self.folder, series_uid)
+        received = self._list_tags(folder, series_uid)
+        claim_file = Path(folder) / mercure_names.SPECULATIVE
+        if claim_file.exists():
+            # Instances that have already been moved into the prepared task folder
+            try:
+                received |= self._list_tags(SpeculativeClaim.from_file(claim_file).target_folder, series_uid)
+            except (OSError, ValueError, TypeError):
+                return set()
+        return received
+
+    @staticmethod
+    def _list_tags(folder: str, series_uid: str) -> Set[str]:
+        series_prefix = series_uid + mercure_defs.SEPARATOR
+        try:
+            return {entry.name for entry in os.scandir(folder)
+                    if entry.name.endswith(mercure_names.TAGS) and entry.name.startswith(series_prefix)}
+        except FileNotFoundError:
+            return set()
@@ -6,19 +6,25 @@ which describe the job to be done and maintain a journal of the executed actions
 """
 
 # Standard python includes
-import json
+import os
 import pprint
 import socket
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple, Union, cast
 
 # App-specific includes
 import common.config as config
+import common.json_codec as json_codec
 import common.monitor as monitor
-from common.constants import mercure_actions, mercure_defs, mercure_names, mercure_options, mercure_rule
+from common.constants import mercure_actions, mercure_defs, mercure_names, mercure_options, mercure_rule, mercure_study
 from common.helper import get_now_str
-from common.types import EmptyDict, Rule, Task, TaskDispatch, TaskDispatchStatus, TaskInfo, TaskProcessing, TaskStudy
+from common.types import (TASK_CACHE_RACY_SECONDS, EmptyDict, Rule, Task, TaskDispatch, TaskDispatchStatus, TaskHasStudy,
+                          TaskInfo, TaskProcessing, TaskStudy)
 from typing_extensions import Literal
 
 # Create local logger instance
@@ -32,7 +38,7 @@ def compose_task(
     triggered_rules: Dict[str, Literal[True]],
     applied_rule: str,
     tags_list: Dict[str, str],
-    target: str,
+    target: Union[str, List[str]],
 ) -> Task:
     """
     Composes the JSON content that is written into a task file when submitting a job (for processing, dispatching, or both)
@@ -252,7 +258,7 @@ def create_series_task(
     applied_rule: str,
     series_UID: str,
     tags_list: Dict[str, str],
-    target: str,
+    target: Union[str, List[str]],
 ) -> bool:
     """
     Writes a task file for the received series, containing all information needed by the processor and dispatcher.
@@ -265,7 +271,7 @@ def create_series_task(
     task_filename = folder_name / mercure_names.TASKFILE
     try:
         with open(task_filename, "w") as task_file:
-            json.dump(task.dict(), task_file)
+            json_codec.dump(task.dict(), task_file)
     except Exception:
         logger.error(
             f"Unable to create series task file {task_filename} with contents {task.dict()}", task.id
@@ -309,48 +315,182 @@ def update_study_task(
     tags_list: Dict[str, str],
 ) -> Tuple[bool, str]:
     """
-    Update the study task file with information from the latest received series
+    Update the study task with information from the latest received series. The series is appended to the study
+    journal, so that the task file itself is not rewritten for every series.
     """
     series_description = tags_list.get("SeriesDescription", mercure_options.INVALID)
     series_uid = tags_list.get("SeriesInstanceUID", mercure_options.INVALID)
     task_filename = folder / mercure_names.TASKFILE
 
-    # Load existing task file. Raise error if it does not exist
+    # Load existing task. Raise error if it does not exist
     try:
-        task = Task.from_file(task_filename)
+        study_task_cache.get(folder)
     except Exception:
         logger.error(f"Unable to open study task file {task_filename}", task_id)  # handle_error
         return False, ""
 
-    # Ensure that the task file contains the study information
-    if not task.study:
-        logger.error(f"Study information missing in task file {task_filename}", task_id)  # handle_error
+    # Remember the time when the last series was received (as needed to determine completion on timeout), and
+    # the received series descriptions (as needed to determine completion on received series) and SeriesUIDs
+    entry = {
+        mercure_study.LAST_RECEIVE_TIME: datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        mercure_study.RECEIVED_SERIES: series_description,
+        mercure_study.RECEIVED_SERIES_UID: series_uid,
+    }
+    try:
+        append_study_journal(folder, entry)
+    except Exception:
+        logger.exception(f"Unable to write study journal {folder / mercure_names.STUDY_JOURNAL}", task_id)  # handle_error
         return False, ""
 
-    study = cast(TaskStudy, task.study)
+    # Only the new journal lines (including the series of other router instances) are applied to the cached task
+    try:
+        task = study_task_cache.get(folder)
+    except Exception:
+        logger.error(f"Unable to open study task file {task_filename}", task_id)  # handle_error
+        return False, ""
+    monitor.send_update_task(task)
 
-    # Remember the time when the last series was received, as needed to determine completion on timeout
-    study.last_receive_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return True, task.id
 
-    # Remember all received series descriptions, as needed to determine completion on received series
-    if study.received_series and (isinstance(study.received_series, list)):
-        study.received_series.append(series_description)
-    else:
-        study.received_series = [series_description]
 
-    # Also remember the received SeriesUIDs for information purpose
-    if study.received_series_uid and (isinstance(study.received_series_uid, list)):
-        study.received_series_uid.append(series_uid)
-    else:
-        study.received_series_uid = [series_uid]
+def append_study_journal(folder: Path, entry: Dict[str, str]) -> None:
+    """
+    Appends an entry to the study journal. The line is written with a single call in append mode, so that readers
+    see either the complete line or an incomplete last line (which is ignored).
+    """
+    line = (json_codec.dumps(entry) + "\n").encode("utf-8")
+    fd = os.open(folder / mercure_names.STUDY_JOURNAL, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
 
-    # Safe the updated file back to disk
+
+def read_study_journal(folder: Path) -> List[Dict[str, str]]:
+    """
+    Returns the entries of the study journal (if any). An incomplete last line is still being written and skipped.
+    """
     try:
-        task.to_file(task_filename)
-    except Exception:
-        logger.exception(f"Unable to write task file {task_filename}", task.id)  # handle_error
-        return False, ""
+        with open(folder / mercure_names.STUDY_JOURNAL, "rb") as journal_file:
+            content = journal_file.read()
+    except FileNotFoundError:
+        return []
+    return [json_codec.loads(line) for line in content.split(b"\n")[:-1] if line]
+
+
+def apply_study_journal(study: TaskStudy, entries: List[Dict[str, str]]) -> None:
+    for entry in entries:
+        if mercure_study.FORWARDED_SERIES_UID in entry:
+            # Series that has been dispatched already (see route_series.forward_series_incrementally)
+            if study.forwarded_series_uid is None:
+                study.forwarded_series_uid = []
+            study.forwarded_series_uid.append(entry[mercure_study.FORWARDED_SERIES_UID])
+            continue
+        study.last_receive_time = entry[mercure_study.LAST_RECEIVE_TIME]
+        if study.received_series and (isinstance(study.received_series, list)):
+            study.received_series.append(entry[mercure_study.RECEIVED_SERIES])
+        else:
+            study.received_series = [entry[mercure_study.RECEIVED_SERIES]]
+        if study.received_series_uid and (isinstance(study.received_series_uid, list)):
+            study.received_series_uid.append(entry[mercure_study.RECEIVED_SERIES_UID])
+        else:
+            study.received_series_uid = [entry[mercure_study.RECEIVED_SERIES_UID]]
 
-    monitor.send_update_task(task)
 
-    return True, task.id
+def read_study_task(folder: Path) -> TaskHasStudy:
+    """
+    Reads the study task of the study folder, including the series from the study journal
+    """
+    with open(folder / mercure_names.TASKFILE, "r") as json_file:
+        task = TaskHasStudy(**json_codec.load(json_file))
+    apply_study_journal(task.study, read_study_journal(folder))
+    return task
+
+
+@dataclass
+class StudyTaskEntry:
+    signature: Tuple[int, int, int]
+    read_time: float
+    task: TaskHasStudy
+    # Number of bytes of the study journal that have been applied to the task
+    journal_offset: int = 0
+
+
+class StudyTaskCache:
+    """
+    Process-local cache of the study tasks that are updated for every received series. The task file of a study is
+    parsed once, and afterwards only the journal lines that have been appended since the last call are applied, so
+    that the journal is not replayed for every series of the study. The entries are validated with the inode,
+    modification time, and size of the task file (which changes when the journal is compacted). The returned task is
+    shared with later calls and must not be modified by the caller.
+    """
+
+    def __init__(self, max_entries: int = 1000) -> None:
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, StudyTaskEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, folder: Path) -> TaskHasStudy:
+        """
+        Returns the study task of the folder, including all series of the study journal. Must be called while the
+        study folder is locked.
+        """
+        key = os.fspath(folder)
+        read_time = time.time()
+        stat = os.stat(folder / mercure_names.TASKFILE)
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        # A task file that was read right after it was written might have changed without changing the signature
+        if (entry is None or entry.signature != signature
+                or entry.read_time - stat.st_mtime_ns / 1e9 <= TASK_CACHE_RACY_SECONDS):
+            with open(folder / mercure_names.TASKFILE, "r") as json_file:
+                entry = StudyTaskEntry(signature, read_time, TaskHasStudy(**json_codec.load(json_file)))
+            with self._lock:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        try:
+            with open(folder / mercure_names.STUDY_JOURNAL, "rb") as journal_file:
+                journal_file.seek(entry.journal_offset)
+                content = journal_file.read()
+        except FileNotFoundError:
+            return entry.task
+        # An incomplete last line is still being written and applied with the next call
+        end = content.rfind(b"\n") + 1
+        apply_study_journal(entry.task.study, [json_codec.loads(line) for line in content[:end].split(b"\n") if line])
+        entry.journal_offset += end
+        return entry.task
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+study_task_cache = StudyTaskCache()
+
+
+def compact_study_task(task_id: Optional[str], folder: Path) -> bool:
+    """
+    Merges the study journal into the task file and removes the journal (called when the study is complete, so
+    that the task file contains all series when the folder is handed over).
+    """
+    journal_file = folder / mercure_names.STUDY_JOURNAL
+    if not journal_file.exists():
+        return True
+    task_filename = folder / mercure_names.TASKFILE
+    try:
+        task = read_study_task(folder)
+        # Replace the task file atomically, so that it is never seen half-written
+        temp_filename = folder / (mercure_names.TASKFILE + ".tmp")
+        task.to_file(temp_filename)
+        os.replace(temp_filename, task_filename)
+        journal_file.unlink()
+    except Exception:
+        logger.exception(f"Unable to compact study journal into task file {task_filename}", task_id)  # handle_error
+        return False
+    return True
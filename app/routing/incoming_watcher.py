@@ -0,0 +1,342 @@
+"""
+incoming_watcher.py
+===================
+Long-lived index of the series in the incoming folder. The index is either rebuilt by scanning the folder or kept
+up to date from inotify events, so that the router only needs to look at series that have actually changed.
+"""
+
+# Standard python includes
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+
+# App-specific includes
+import common.config as config
+from common.constants import mercure_defs, mercure_names
+from routing.common import SeriesItem
+from routing.completion_estimator import CompletionEstimator
+from routing.completion_scheduler import CompletionScheduler
+from routing.expected_instances import ExpectedInstances
+from routing.routing_order import read_first_tags
+
+# Create local logger instance
+logger = config.get_logger()
+
+try:
+    from watchdog.events import FileSystemEvent, FileSystemEventHandler
+    from watchdog.observers.inotify import InotifyObserver
+    watcher_available = True
+except ImportError:
+    FileSystemEventHandler = object  # type: ignore
+    watcher_available = False
+
+
+class SeriesIndex:
+    """
+    Index of the series folders in the incoming folder and their modification times. Changes reported by the
+    watcher are collected (possibly from another thread) and only applied when the router calls apply_changes().
+    The completion deadlines of the indexed series are tracked by the attached completion scheduler. Series that
+    are not owned by this router instance (see sharding) are indexed without being stat'ed or scheduled. The
+    studies of the series are cached for the study completion checks. The modification times of the series folders
+    are passed through get_modification_time, which allows the router to discount its own changes of the folders
+    (see speculative_routing). The tags files reported by the watcher are passed to the instance counter.
+    """
+
+    def __init__(self) -> None:
+        self.series: Dict[str, SeriesItem] = {}
+        # StudyInstanceUIDs of the indexed series (read once from the first tags file of the series)
+        self.study_uids: Dict[str, str] = {}
+        # Modification times of the series folders in which no tags file was found when the study was looked up
+        self.unknown_studies: Dict[str, float] = {}
+        self.is_owned: Callable[[str], bool] = lambda series_uid: True
+        self.get_modification_time: Callable[[str, float], float] = lambda series_uid, mtime: mtime
+        self.estimator = CompletionEstimator()
+        self.counter = ExpectedInstances()
+        self.completion = CompletionScheduler(self.estimator, self.counter)
+        self.error_files_found = False
+        self.last_scan: float = 0
+        self._changed: Set[str] = set()
+        self._removed: Set[str] = set()
+        self._instances: Dict[str, Set[str]] = {}
+        self._error_files = False
+        self._lock = threading.Lock()
+
+    def mark_changed(self, series_uid: str) -> None:
+        with self._lock:
+            self._changed.add(series_uid)
+            self._removed.discard(series_uid)
+
+    def mark_instance(self, series_uid: str, name: str) -> None:
+        """
+        Records a received tags file of the series for the instance counter.
+        """
+        if not self.counter.enabled:
+            return
+        with self._lock:
+            self._instances.setdefault(series_uid, set()).add(name)
+
+    def mark_removed(self, series_uid: str) -> None:
+        with self._lock:
+            self._removed.add(series_uid)
+            self._changed.discard(series_uid)
+
+    def mark_error_files(self) -> None:
+        with self._lock:
+            self._error_files = True
+
+    def rescan(self, folder: str) -> None:
+        """
+        Rebuilds the index from a full scan of the incoming folder (one stat call per series folder).
+        """
+        # Pending changes are covered by the scan, so they can be dropped (except for the received instances)
+        with self._lock:
+            self._changed = set()
+            self._removed = set()
+            instances, self._instances = self._instances, {}
+            self._error_files = False
+        for series_uid, names in instances.items():
+            self.counter.record_received(series_uid, names)
+
+        found: Dict[str, float] = {}
+        error_files_found = False
+        for entry in os.scandir(folder):
+            if entry.name.endswith(mercure_names.ERROR):
+                error_files_found = True
+                continue
+            if not entry.is_dir():
+                continue
+            if entry.name == "error":
+                error_files_found = True
+                continue
+            found[entry.name] = entry.stat().st_mtime if self.is_owned(entry.name) else 0
+
+        for series_uid in list(self.series.keys()):
+            if series_uid not in found:
+                self.remove(series_uid)
+        for series_uid, mtime in found.items():
+            self._update(series_uid, mtime)
+
+        self.error_files_found = error_files_found
+        self.last_scan = time.monotonic()
+
+    def apply_changes(self, folder: str) -> None:
+        """
+        Applies the changes collected since the last call. Only the series folders that were reported as
+        changed are stat'ed, so the cost is proportional to the number of changes.
+        """
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            removed, self._removed = self._removed, set()
+            instances, self._instances = self._instances, {}
+            if self._error_files:
+                self.error_files_found = True
+                self._error_files = False
+
+        for series_uid in removed:
+            self.remove(series_uid)
+        # Count the instances before the series are scheduled, which checks whether all instances have arrived
+        for series_uid, names in instances.items():
+            self.counter.record_received(series_uid, names)
+
+        for series_uid in changed:
+            if not self.is_owned(series_uid):
+                self._update(series_uid, 0)
+                continue
+            try:
+                mtime = os.stat(os.path.join(folder, series_uid)).st_mtime
+            except FileNotFoundError:
+                # Folder has been removed in the meantime (e.g., routed by another router instance)
+                self.remove(series_uid)
+                continue
+            self._update(series_uid, mtime)
+
+    def reassign(self, folder: str) -> None:
+        """
+        Schedules the series that are now owned by this router instance and stops scheduling the series that
+        are now owned by other instances (e.g., after a router instance has gone down or come back).
+        """
+        for series_uid, item in list(self.series.items()):
+            owned = self.is_owned(series_uid)
+            if owned and not self.completion.is_scheduled(series_uid):
+                try:
+                    mtime = os.stat(os.path.join(folder, series_uid)).st_mtime
+                except FileNotFoundError:
+                    self.remove(series_uid)
+                    continue
+                item.modification_time = self.get_modification_time(series_uid, mtime)
+                self.completion.schedule(series_uid, item.modification_time)
+            elif not owned and self.completion.is_scheduled(series_uid):
+                self.completion.track(series_uid, item.modification_time)
+
+    def remove(self, series_uid: str) -> None:
+        self.series.pop(series_uid, None)
+        self.study_uids.pop(series_uid, None)
+        self.unknown_studies.pop(series_uid, None)
+        self.completion.discard(series_uid)
+
+    def get_study_uid(self, series_uid: str) -> Optional[str]:
+        """
+        Returns the StudyInstanceUID of the series, or None if no tags file of the series has been found yet. If no
+        tags file has been found, the folder is only searched again after its modification time has changed.
+        """
+        study_uid = self.study_uids.get(series_uid)
+        if study_uid is not None:
+            return study_uid
+        try:
+            mtime = os.stat(os.path.join(config.mercure.incoming_folder, series_uid)).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime is not None and self.unknown_studies.get(series_uid) == mtime:
+            return None
+
+        tags = read_first_tags(series_uid)
+        if tags is None or "StudyInstanceUID" not in tags:
+            if mtime is not None and series_uid in self.series:
+                self.unknown_studies[series_uid] = mtime
+            return None
+        study_uid = str(tags["StudyInstanceUID"])
+        if series_uid in self.series:
+            self.study_uids[series_uid] = study_uid
+            self.unknown_studies.pop(series_uid, None)
+        return study_uid
+
+    def get_pending_studies(self, pending_series: Iterable[str]) -> Set[str]:
+        """
+        Returns the studies of the given pending series. Series whose study is not known yet are left out, so that
+        a series folder without tags file does not hold back the completion of all studies.
+        """
+        pending_studies = set()
+        for series_uid in pending_series:
+            study_uid = self.get_study_uid(series_uid)
+            if study_uid is None:
+                logger.debug(f"Study of pending series {series_uid} is not known yet")
+                continue
+            pending_studies.add(study_uid)
+        return pending_studies
+
+    def _update(self, series_uid: str, mtime: float) -> None:
+        if mtime:
+            mtime = self.get_modification_time(series_uid, mtime)
+        if series_uid not in self.series:
+            self.series[series_uid] = SeriesItem(mtime)
+        elif mtime > self.series[series_uid].modification_time:
+            self.series[series_uid].modification_time = mtime
+        else:
+            return
+        if self.is_owned(series_uid):
+            self.completion.schedule(series_uid, mtime)
+        else:
+            self.completion.track(series_uid, mtime)
+
+
+class IncomingEventHandler(FileSystemEventHandler):  # type: ignore
+    """
+    Translates file system events from the incoming folder into updates of the series index. Only creation,
+    close-after-write, and move events are considered, as these are the events caused by the receiver.
+    """
+
+    def __init__(self, folder: str, index: SeriesIndex) -> None:
+        super().__init__()
+        self.folder = Path(folder)
+        self.index = index
+
+    def _relative_parts(self, path) -> Optional[tuple]:
+        if isinstance(path, bytes):
+            path = os.fsdecode(path)
+        try:
+            return Path(path).relative_to(self.folder).parts
+        except ValueError:
+            return None
+
+    def _register(self, path, is_directory: bool) -> None:
+        parts = self._relative_parts(path)
+        if not parts:
+            return
+        name = parts[-1]
+        if parts[0] == "error" or name.endswith(mercure_names.ERROR):
+            self.index.mark_error_files()
+            return
+        if len(parts) == 1 and not is_directory:
+            # Files placed directly into the incoming folder have not been processed by getdcmtags yet
+            return
+        if len(parts) > 2 or name.endswith(mercure_names.LOCK) or name.startswith(mercure_names.SPECULATIVE):
+            # Lock and claim files are created by the router itself and should not delay the series completion
+            return
+        if len(parts) == 2 and name.endswith(mercure_names.TAGS) and name.startswith(parts[0] + mercure_defs.SEPARATOR):
+            self.index.mark_instance(parts[0], name)
+        self.index.mark_changed(parts[0])
+
+    def _unregister(self, path, is_directory: bool) -> None:
+        parts = self._relative_parts(path)
+        if parts and len(parts) == 1 and is_directory:
+            self.index.mark_removed(parts[0])
+
+    def on_created(self, event: "FileSystemEvent") -> None:
+        self._register(event.src_path, event.is_directory)
+
+    def on_closed(self, event: "FileSystemEvent") -> None:
+        self._register(event.src_path, event.is_directory)
+
+    def on_moved(self, event: "FileSystemEvent") -> None:
+        self._unregister(event.src_path, event.is_directory)
+        self._register(event.dest_path, event.is_directory)
+
+    def on_deleted(self, event: "FileSystemEvent") -> None:
+        self._unregister(event.src_path, event.is_directory)
+
+
+class IncomingWatcher:
+    """
+    Keeps the series index up to date using inotify events for the incoming folder. A full scan is performed
+    when the watcher is started and periodically afterwards to reconcile the index with the folder content
+    (e.g., if events have been lost due to an overflow of the inotify queue).
+    """
+
+    def __init__(self, folder: str, index: SeriesIndex) -> None:
+        self.folder = folder
+        self.index = index
+        self._observer: Any = None
+
+    def start(self) -> bool:
+        if not watcher_available:
+            logger.warning("Inotify support not available. Scanning incoming folder instead.")
+            return False
+        try:
+            observer: Any = InotifyObserver()  # type: ignore
+            observer.schedule(IncomingEventHandler(self.folder, self.index), self.folder, recursive=True)
+            observer.start()
+        except Exception:
+            logger.exception("Unable to start watcher for incoming folder. Scanning incoming folder instead.")
+            return False
+        self._observer = observer
+        self.index.counter.counting = True
+        logger.info(f"Watching incoming folder {self.folder} for changes")
+        # Initial scan to pick up all series that have been received before the watcher was started
+        self.index.rescan(self.folder)
+        return True
+
+    def stop(self) -> None:
+        if self._observer is None:
+            return
+        self.index.counter.counting = False
+        try:
+            self._observer.stop()
+            self._observer.join(timeout=5)
+        except Exception:
+            logger.exception("Error while stopping watcher for incoming folder")
+        self._observer = None
+
+    @property
+    def is_alive(self) -> bool:
+        return self._observer is not None and self._observer.is_alive()
+
+    def update(self, reconcile_interval: float) -> None:
+        """
+        Applies the collected events to the index, or rescans the folder if the reconciliation is due.
+        """
+        if reconcile_interval > 0 and time.monotonic() - self.index.last_scan > reconcile_interval:
+            self.index.rescan(self.folder)
+        else:
+            self.index.apply_changes(self.folder)
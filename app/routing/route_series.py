@@ -4,31 +4,72 @@ route_series.py
 Provides functions for routing/processing of series. For study-level processing, series will be pushed into study folders.
 """
 
-import json
 # Standard python includes
 import os
 import shutil
+import threading
+import time
 import typing
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 # App-specific includes
 import common.config as config
 import common.helper as helper
+import common.json_codec as json_codec
 import common.log_helpers as log_helpers
 import common.monitor as monitor
 import common.notification as notification
 import common.rule_evaluation as rule_evaluation
-from common.constants import mercure_actions, mercure_defs, mercure_events, mercure_names, mercure_options, mercure_rule
+from common.constants import (mercure_actions, mercure_defs, mercure_events, mercure_names, mercure_options, mercure_rule,
+                              mercure_study)
+from common.rule_index import rule_index
 from common.types import Rule
 from pydicom import dcmread
-from routing.common import generate_task_id
-from routing.generate_taskfile import create_series_task, create_study_task, update_study_task
+from routing import duplicate_filter
+from routing.common import SpeculativeClaim, generate_task_id, get_incremental_targets
+from routing.generate_taskfile import append_study_journal, create_series_task, create_study_task, update_study_task
 from typing_extensions import Literal
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # type: ignore
+
 # Create local logger instance
 logger = config.get_logger()
 
+# ioctl request for cloning a file on copy-on-write file systems (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Locks for the study folders that are currently being updated by one of the routing threads
+study_folder_locks: Dict[str, List[Any]] = {}
+study_folder_locks_guard = threading.Lock()
+
+# Rules triggered by the series that have been determined before the series is routed (see routing_order), together
+# with the configuration and the tags that they have been determined for
+classified_rules: Dict[str, Tuple[float, Dict[str, str], Tuple[Dict[str, Literal[True]], str]]] = {}
+
+
+@contextmanager
+def study_folder_guard(folder: str) -> Iterator[None]:
+    """
+    Serializes updates of the same study folder by threads of this router instance. Other router instances are
+    kept out by the lock file in the study folder.
+    """
+    with study_folder_locks_guard:
+        entry = study_folder_locks.setdefault(folder, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with study_folder_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del study_folder_locks[folder]
+
 
 @log_helpers.clear_task_decorator
 def route_series(task_id: str, series_UID: str, files: typing.List[Path] = []) -> None:
@@ -59,6 +100,14 @@ def route_series(task_id: str, series_UID: str, files: typing.List[Path] = []) -
         logger.error(f"Unable to create lock file {lock_file}", task_id)  # handle_error
         return
 
+    if (base_dir / mercure_names.SPECULATIVE).exists():
+        # The task folder has already been prepared while the series was received (speculative routing)
+        prepared = push_series_prepared(task_id, series_UID)
+        lock.free()
+        if prepared:
+            shutil.rmtree(base_dir)
+        return
+
     logger.info(f"Evaluating series {series_UID}")
     fileList = []
     seriesPrefix = series_UID + mercure_defs.SEPARATOR
@@ -103,10 +152,10 @@ def route_series(task_id: str, series_UID: str, files: typing.List[Path] = []) -
         tagsList: Dict[str, str] = {}
         try:
             with open(tagsMasterFile, "r", encoding="utf-8", errors="strict") as json_file:
-                tagsList = json.load(json_file)
+                tagsList = json_codec.load(json_file)
         except UnicodeDecodeError:
             with open(tagsMasterFile, "r", encoding="utf-8", errors="surrogateescape") as json_file:
-                tagsList = json.load(json_file)
+                tagsList = json_codec.load(json_file)
                 tagsList_encoding_error = True
 
     except Exception:
@@ -114,12 +163,28 @@ def route_series(task_id: str, series_UID: str, files: typing.List[Path] = []) -
         lock.free()
         return
 
+    # Drop instances that have been routed already, before they are copied to the destinations
+    instance_keys: Dict[str, Tuple[str, bytes]] = {}
+    if config.mercure.router_duplicate_window > 0:
+        fileList, instance_keys = duplicate_filter.remove_duplicates(task_id, series_UID, fileList, time.time())
+        if not fileList:
+            logger.info(f"All instances of series {series_UID} are duplicates")
+            lock.free()
+            shutil.rmtree(base_dir)
+            return
+
     monitor.send_register_series(tagsList)
 
     # Now test the routing rules and evaluate which rules have been triggered. If one of the triggered
     # rules enforces discarding, discard_series will be True.
     discard_series = ""
-    triggered_rules, discard_series = get_triggered_rules(task_id, tagsList)
+    classified = classified_rules.pop(series_UID, None)
+    if classified is not None and classified[0] == config.configuration_timestamp and classified[1] == tagsList:
+        triggered_rules, discard_series = classified[2]
+        logger.info("Triggered rules:")
+        logger.info(triggered_rules)
+    else:
+        triggered_rules, discard_series = get_triggered_rules(task_id, tagsList)
 
     monitor.send_task_event(
         monitor.task_event.REGISTER, task_id, len(fileList), ", ".join(triggered_rules), "Registered series"
@@ -140,6 +205,16 @@ def route_series(task_id: str, series_UID: str, files: typing.List[Path] = []) -
         if len(triggered_rules) > 1:
             remove_series(task_id, fileList, series_UID)
 
+    # The instances only count as routed (for the duplicate filter) once they have left the incoming folder
+    if instance_keys:
+        duplicate_filter.record_routed(series_UID, instance_keys, time.time())
+
+    if not lock_file.exists():
+        # The incoming folder (including the lock file) has been handed over as a whole to its destination.
+        # A folder with the same name might have been created for late instances, so it must not be removed.
+        lock.lockCreated = False
+        return
+
     try:
         lock.free()
     except Exception:
@@ -148,12 +223,28 @@ def route_series(task_id: str, series_UID: str, files: typing.List[Path] = []) -
     shutil.rmtree(base_dir)
 
 
+def classify_rules(series_uid: str, tagList: Dict[str, str]) -> Tuple[Dict[str, Literal[True]], str]:
+    """
+    Evaluates the routing rules for a complete series without logging (e.g., to determine the routing order) and
+    remembers the result, so that route_series does not need to evaluate the rules again.
+    """
+    result = get_triggered_rules(None, tagList, quiet=True)
+    classified_rules[series_uid] = (config.configuration_timestamp, tagList, result)
+    return result
+
+
 def get_triggered_rules(
-    task_id: str, tagList: Dict[str, str]
+    task_id: Optional[str], tagList: Dict[str, str], quiet: bool = False
 ) -> Tuple[Dict[str, Literal[True]], Union[Any, Literal[""]]]:
     """
-    Evaluates the routing rules and returns a list with triggered rules.
+    Evaluates the routing rules and returns a list with triggered rules. If quiet is set, the rules are evaluated
+    without logging the evaluations, and invalid rules are treated as not triggered.
     """
+    def is_triggered(rule: str) -> bool:
+        if quiet:
+            return bool(rule_evaluation.evaluate_silently(rule, tagList))
+        return rule_evaluation.parse_rule(rule, tagList)[0]
+
     triggered_rules: Dict[str, Literal[True]] = {}
     discard_rule = ""
     fallback_rule = ""
@@ -161,10 +252,15 @@ def get_triggered_rules(
     if "mercureForceRule" in tagList:
         force_rule = tagList["mercureForceRule"]
         if force_rule not in config.mercure.rules:
-            logger.error(f"Invalid force rule {force_rule} for task {task_id}", task_id)
+            if not quiet:
+                logger.error(f"Invalid force rule {force_rule} for task {task_id}", task_id)
             return {}, ""
         triggered_rules[force_rule] = True
     else:
+        # Rules that cannot be triggered by the tags (according to their leading tag conditions) are not evaluated
+        candidates = rule_index.get_candidates(tagList)
+        evaluated = 0
+        skipped = 0
         # Iterate over all defined processing rules
         for current_rule in config.mercure.rules:
             try:
@@ -180,8 +276,13 @@ def get_triggered_rules(
                     fallback_rule = current_rule
                     continue
 
+                if current_rule not in candidates:
+                    skipped += 1
+                    continue
+
+                evaluated += 1
                 # Check if the current rule is triggered for the provided tag set
-                if rule_evaluation.parse_rule(rule.get("rule", "False"), tagList)[0]:
+                if is_triggered(rule.get("rule", "False")):
                     triggered_rules[current_rule] = True
                     if rule.get(mercure_rule.ACTION, "") == mercure_actions.DISCARD:
                         discard_rule = current_rule
@@ -192,18 +293,28 @@ def get_triggered_rules(
                 logger.error(f"Invalid rule found: {current_rule}", task_id)  # handle_error
                 continue
 
+        # The fallback rule is not evaluated either if it cannot be triggered
+        if (len(triggered_rules) == 0) and (fallback_rule):
+            if fallback_rule in candidates:
+                evaluated += 1
+            else:
+                skipped += 1
+                fallback_rule = ""
+        rule_index.count(evaluated, skipped)
+
     # If no rule has triggered but a fallback rule exists, then evaluate and apply this rule
     if (len(triggered_rules) == 0) and (fallback_rule):
         try:
-            if rule_evaluation.parse_rule(config.mercure.rules[fallback_rule].get("rule", "False"), tagList)[0]:
+            if is_triggered(config.mercure.rules[fallback_rule].get("rule", "False")):
                 triggered_rules[fallback_rule] = True
                 if config.mercure.rules[fallback_rule].get(mercure_rule.ACTION, "") == mercure_actions.DISCARD:
                     discard_rule = fallback_rule
         except Exception:
             logger.error(f"Invalid fallback rule: {fallback_rule}", task_id)  # handle_error
 
-    logger.info("Triggered rules:")
-    logger.info(triggered_rules)
+    if not quiet:
+        logger.info("Triggered rules:")
+        logger.info(triggered_rules)
     return triggered_rules, discard_rule
 
 
@@ -221,26 +332,31 @@ def push_series_complete(
     else:
         destination_path = Path(config.mercure.success_folder) / task_id
 
-    # Create subfolder in the discard directory and validate that is has been created
-    try:
-        destination_path.mkdir()
-    except Exception:
-        logger.error(f"Unable to create outgoing folder {destination_path}", task_id)  # handle_error
-        return
+    # If the files are moved, try to hand over the complete incoming folder. The lock file of the incoming
+    # folder is moved along and keeps the cleaner module away until it is removed below.
+    folder_moved = not copy_files and move_series_folder(task_id, series_UID, file_list, destination_path)
+    lock_file = destination_path / mercure_names.LOCK
 
-    if not destination_path.exists():
-        logger.error(f"Creating discard folder not possible {destination_path}", task_id)  # handle_error
-        return
+    if not folder_moved:
+        # Create subfolder in the discard directory and validate that is has been created
+        try:
+            destination_path.mkdir()
+        except Exception:
+            logger.error(f"Unable to create outgoing folder {destination_path}", task_id)  # handle_error
+            return
 
-    # Create lock file in destination folder (to prevent the cleaner module to work on the folder). Note that
-    # the DICOM series in the incoming folder has already been locked in the parent function.
-    lock_file = destination_path / mercure_names.LOCK
-    try:
-        lock = helper.FileLock(lock_file)
-    except Exception:
-        # Can't create lock file, so something must be seriously wrong
-        logger.error(f"Unable to create lock file {destination_path}/{mercure_names.LOCK}", task_id)  # handle_error
-        return
+        if not destination_path.exists():
+            logger.error(f"Creating discard folder not possible {destination_path}", task_id)  # handle_error
+            return
+
+        # Create lock file in destination folder (to prevent the cleaner module to work on the folder). Note that
+        # the DICOM series in the incoming folder has already been locked in the parent function.
+        try:
+            lock = helper.FileLock(lock_file)
+        except Exception:
+            # Can't create lock file, so something must be seriously wrong
+            logger.error(f"Unable to create lock file {destination_path}/{mercure_names.LOCK}", task_id)  # handle_error
+            return
 
     if destination == "DISCARD":
         if discard_rule:
@@ -254,6 +370,11 @@ def push_series_complete(
                 logger.warning(info_text)
         monitor.send_task_event(monitor.task_event.DISCARD, task_id, len(file_list), discard_rule or "", info_text)
 
+    if folder_moved:
+        monitor.send_task_event(monitor.task_event.MOVE, task_id, len(file_list), str(destination_path), "Moved files")
+        unlock_moved_folder(task_id, destination_path)
+        return
+
     if not push_files(task_id, series_UID, file_list, destination_path, copy_files):
         logger.error("Problem while moving completed files", task_id)  # handle_error
 
@@ -270,6 +391,70 @@ def push_series_complete(
         return
 
 
+def push_series_prepared(task_id: str, series_UID: str) -> bool:
+    """
+    Completes a series whose task folder has been prepared while the series was received (speculative routing).
+    The remaining files are moved into the task folder, which is then unlocked for processing or dispatching.
+    """
+    source_folder = Path(config.mercure.incoming_folder) / series_UID
+    try:
+        claim = SpeculativeClaim.from_file(source_folder / mercure_names.SPECULATIVE)
+    except Exception:
+        logger.exception(f"Unable to read prepared task of series {series_UID}", task_id)  # handle_error
+        return False
+    target_folder = Path(claim.target_folder)
+
+    series_prefix = series_UID + mercure_defs.SEPARATOR
+    for entry in list(os.scandir(source_folder)):
+        if not entry.name.endswith(mercure_names.TAGS) or not entry.name.startswith(series_prefix):
+            continue
+        stem = entry.name[: -len(mercure_names.TAGS)]
+        try:
+            if (source_folder / (stem + mercure_names.DCM)).exists():
+                shutil.move(str(source_folder / (stem + mercure_names.DCM)), target_folder / (stem + mercure_names.DCM))
+            shutil.move(entry.path, target_folder / entry.name)
+        except Exception:
+            logger.error(  # handle_error
+                f"Problem while pushing file to task folder {stem}\n"
+                f"Source folder {source_folder}\nTarget folder {target_folder}",
+                task_id,
+            )
+            return False
+
+    file_list = sorted(entry.name[: -len(mercure_names.TAGS)] for entry in os.scandir(target_folder)
+                       if entry.name.endswith(mercure_names.TAGS))
+    logger.info("DICOM files found: " + str(len(file_list)))
+    if not file_list:
+        logger.error(f"No tags files found for series {series_UID}", task_id)  # handle_error
+        return False
+
+    try:
+        with open(target_folder / (file_list[0] + mercure_names.TAGS), "r", encoding="utf-8",
+                  errors="surrogateescape") as json_file:
+            tags_list: Dict[str, str] = json_codec.load(json_file)
+    except Exception:
+        logger.exception(f"Invalid tag for series {series_UID}", task_id)  # handle_error
+        return False
+
+    if config.mercure.store_sample_dicom_tags:
+        try:
+            monitor.send_update_task_tags(task_id, dcmread(target_folder / (file_list[0] + mercure_names.DCM),
+                                                           stop_before_pixels=True).to_json_dict())
+        except Exception:
+            logger.exception("Error reading example DICOM file", task_id)
+
+    rule_names = ", ".join(claim.triggered_rules)
+    monitor.send_register_series(tags_list)
+    monitor.send_task_event(monitor.task_event.REGISTER, task_id, len(file_list), rule_names, "Registered series")
+    monitor.send_register_task(claim.task_id, series_UID, task_id)
+    monitor.send_task_event(monitor.task_event.DELEGATE, task_id, len(file_list), claim.task_id, rule_names)
+    monitor.send_task_event(monitor.task_event.MOVE, task_id, len(file_list), str(target_folder), "Moved files")
+    for rule in claim.triggered_rules:
+        trigger_serieslevel_notification(rule, tags_list, mercure_events.RECEIVED, task_id)
+
+    return unlock_moved_folder(task_id, target_folder)
+
+
 def push_series_studylevel(
     task_id: str,
     triggered_rules: Dict[str, Literal[True]],
@@ -283,56 +468,133 @@ def push_series_studylevel(
     # Move series into individual study-level folder for every rule
     for current_rule in triggered_rules:
         if config.mercure.rules[current_rule].get("action_trigger", "series") == mercure_options.STUDY:
-            first_series = False
-
             # Check if folder exists for buffering series until study completion. If not, create it
             study_UID = tags_list["StudyInstanceUID"]
             target_folder = Path(config.mercure.studies_folder) / (study_UID + mercure_defs.SEPARATOR + current_rule)
 
-            if not target_folder.exists():
-                try:
-                    target_folder.mkdir()
-                    first_series = True
-                except Exception:
-                    logger.error(f"Unable to create study folder {target_folder}", task_id)  # handle_error
-                    continue
+            # Series of the same study might be routed in parallel by other worker threads
+            with study_folder_guard(str(target_folder)):
+                push_series_studyfolder(task_id, triggered_rules, current_rule, file_list, series_UID,
+                                        tags_list, study_UID, target_folder)
 
-            lock_file = target_folder / mercure_names.LOCK
-            try:
-                lock = helper.FileLock(lock_file)
-            except Exception:
-                # Can't create lock file, so something must be seriously wrong
-                logger.error(f"Unable to create lock file {lock_file}", task_id)  # handle_error
-                continue
 
-            if first_series:
-                # Create task file with information on complete criteria
-                new_task_id = generate_task_id()
-                result = create_study_task(new_task_id, target_folder, triggered_rules,
-                                           current_rule, study_UID, tags_list)
-                monitor.send_task_event(monitor.task_event.ASSIGN, task_id, len(file_list),
-                                        current_rule, "Created study task")
-                monitor.send_task_event(monitor.task_event.DELEGATE, task_id, len(file_list),
-                                        new_task_id, current_rule)
-                monitor.send_task_event(monitor.task_event.ASSIGN, new_task_id, len(file_list),
-                                        task_id, "Added series to study")
-            else:
-                # Add data from latest series to task file
-                result, new_task_id = update_study_task(task_id, target_folder, triggered_rules,
-                                                        current_rule, study_UID, tags_list)
-                monitor.send_task_event(monitor.task_event.ASSIGN, task_id, len(file_list),
-                                        current_rule, "Added to study task")
-                monitor.send_task_event(monitor.task_event.DELEGATE, task_id, len(file_list),
-                                        new_task_id, current_rule)
-                monitor.send_task_event(monitor.task_event.ASSIGN, new_task_id, len(file_list),
-                                        task_id, "Added series to study")
-
-            if not result:
-                logger.error("Problem assigning series to study", task_id)
-
-            # Copy (or move) the files into the study folder
-            push_files(task_id, series_UID, file_list, target_folder, (len(triggered_rules) > 1))
-            lock.free()
+def push_series_studyfolder(
+    task_id: str,
+    triggered_rules: Dict[str, Literal[True]],
+    current_rule: str,
+    file_list: List[str],
+    series_UID: str,
+    tags_list: Dict[str, str],
+    study_UID: str,
+    target_folder: Path,
+) -> None:
+    """
+    Pushes the series into the study folder of the given rule, creating the folder and study task if needed.
+    """
+    first_series = False
+    if not target_folder.exists():
+        try:
+            target_folder.mkdir()
+            first_series = True
+        except Exception:
+            logger.error(f"Unable to create study folder {target_folder}", task_id)  # handle_error
+            return
+
+    lock_file = target_folder / mercure_names.LOCK
+    try:
+        lock = helper.FileLock(lock_file)
+    except Exception:
+        # Can't create lock file, so something must be seriously wrong
+        logger.error(f"Unable to create lock file {lock_file}", task_id)  # handle_error
+        return
+
+    if first_series:
+        # Create task file with information on complete criteria
+        new_task_id = generate_task_id()
+        result = create_study_task(new_task_id, target_folder, triggered_rules,
+                                   current_rule, study_UID, tags_list)
+        monitor.send_task_event(monitor.task_event.ASSIGN, task_id, len(file_list),
+                                current_rule, "Created study task")
+        monitor.send_task_event(monitor.task_event.DELEGATE, task_id, len(file_list),
+                                new_task_id, current_rule)
+        monitor.send_task_event(monitor.task_event.ASSIGN, new_task_id, len(file_list),
+                                task_id, "Added series to study")
+    else:
+        # Add data from latest series to task file
+        result, new_task_id = update_study_task(task_id, target_folder, triggered_rules,
+                                                current_rule, study_UID, tags_list)
+        monitor.send_task_event(monitor.task_event.ASSIGN, task_id, len(file_list),
+                                current_rule, "Added to study task")
+        monitor.send_task_event(monitor.task_event.DELEGATE, task_id, len(file_list),
+                                new_task_id, current_rule)
+        monitor.send_task_event(monitor.task_event.ASSIGN, new_task_id, len(file_list),
+                                task_id, "Added series to study")
+
+    if not result:
+        logger.error("Problem assigning series to study", task_id)
+
+    # Copy (or move) the files into the study folder. Studies that will be processed must not share files via hardlinks
+    processing_rule = config.mercure.rules[current_rule].action in (mercure_actions.PROCESS, mercure_actions.BOTH)
+    pushed = push_files(task_id, series_UID, file_list, target_folder, (len(triggered_rules) > 1),
+                        allow_hardlink=not processing_rule)
+
+    # Dispatch the series right away to the targets that accept the series of the study one at a time
+    incremental_targets, _ = get_incremental_targets(config.mercure.rules[current_rule])
+    if pushed and result and incremental_targets:
+        forward_series_incrementally(task_id, file_list, series_UID, tags_list, target_folder, incremental_targets)
+    lock.free()
+
+
+def forward_series_incrementally(
+    task_id: str,
+    file_list: List[str],
+    series_UID: str,
+    tags_list: Dict[str, str],
+    study_folder: Path,
+    targets: List[str],
+) -> bool:
+    """
+    Creates an outgoing task for a series that has been added to a study folder, so that the series is dispatched
+    while the rest of the study is still being received. The series is recorded in the study journal, so that it is
+    not dispatched again to these targets once the study is complete. The study folder must be locked.
+    """
+    new_task_id = generate_task_id()
+    target_folder = Path(config.mercure.outgoing_folder) / new_task_id
+    try:
+        target_folder.mkdir()
+    except Exception:
+        logger.error(f"Unable to create outgoing folder {target_folder}", task_id)  # handle_error
+        return False
+
+    lock_file = target_folder / mercure_names.LOCK
+    try:
+        lock = helper.FileLock(lock_file)
+    except Exception:
+        logger.error(f"Unable to create lock file {lock_file}", task_id)  # handle_error
+        return False
+
+    # No rules are assigned to the task, as the notifications are triggered for the complete study
+    if not create_series_task(new_task_id, target_folder, {}, "", series_UID, tags_list, targets):
+        shutil.rmtree(target_folder, ignore_errors=True)
+        return False
+
+    operation = get_copy_operation()
+    try:
+        for entry in file_list:
+            operation(study_folder / (entry + mercure_names.DCM), target_folder / (entry + mercure_names.DCM))
+            operation(study_folder / (entry + mercure_names.TAGS), target_folder / (entry + mercure_names.TAGS))
+        append_study_journal(study_folder, {mercure_study.FORWARDED_SERIES_UID: series_UID})
+    except Exception:
+        logger.error(f"Unable to forward series {series_UID} to outgoing folder {target_folder}", task_id)  # handle_error
+        # The series will be dispatched together with the rest of the study
+        shutil.rmtree(target_folder, ignore_errors=True)
+        return False
+
+    monitor.send_register_task(new_task_id, series_UID, task_id)
+    monitor.send_task_event(monitor.task_event.DELEGATE, task_id, len(file_list), new_task_id, ", ".join(targets))
+    monitor.send_task_event(monitor.task_event.COPY, task_id, len(file_list), str(target_folder), "Copied files")
+    lock.free()
+    return True
 
 
 def push_series_serieslevel(
@@ -411,6 +673,24 @@ def push_serieslevel_processing(
 
                 folder_name = config.mercure.processing_folder + "/" + new_task_id
                 target_folder = Path(folder_name)
+                source_folder = Path(config.mercure.incoming_folder) / series_UID
+
+                # If this is the only destination of the series, hand over the complete incoming folder
+                # (including the task file) as processing folder
+                if not copy_files and create_series_task(
+                    new_task_id, source_folder, triggered_rules, current_rule, series_UID, tags_list, ""
+                ):
+                    if move_series_folder(task_id, series_UID, file_list, target_folder):
+                        monitor.send_task_event(monitor.task_event.DELEGATE, task_id, len(file_list), new_task_id,
+                                                current_rule)
+                        monitor.send_register_task(new_task_id, series_UID, task_id)
+                        monitor.send_task_event(monitor.task_event.MOVE, task_id, len(file_list), str(target_folder),
+                                                "Moved files")
+                        if not unlock_moved_folder(task_id, target_folder):
+                            return False
+                        trigger_serieslevel_notification(current_rule, tags_list, mercure_events.RECEIVED, task_id)
+                        continue
+                    (source_folder / mercure_names.TASKFILE).unlink(missing_ok=True)
 
                 # Create processing folder
                 try:
@@ -442,7 +722,8 @@ def push_serieslevel_processing(
                 else:
                     return False
 
-                if not push_files(task_id, series_UID, file_list, target_folder, copy_files):
+                # Processing modules might modify the input files, so the files must not be shared via hardlinks
+                if not push_files(task_id, series_UID, file_list, target_folder, copy_files, allow_hardlink=False):
                     logger.error(
                         f"Unable to push files into processing folder {target_folder}", task_id
                     )  # handle_error
@@ -517,6 +798,25 @@ def push_serieslevel_outgoing(
         folder_name = config.mercure.outgoing_folder + "/" + new_task_id
         target_folder = Path(folder_name)
 
+        # Collect the rules that triggered the dispatching to the current target
+        target_rules: Dict[str, Literal[True]] = {}
+        for rule in selected_targets[target]:
+            target_rules[rule] = True
+
+        # If the series has only this one destination, write the task file into the (locked) incoming folder
+        # and hand over the complete folder as task folder
+        if move_operation and len(selected_targets) == 1:
+            if create_series_task(new_task_id, source_folder, target_rules, "", series_UID, tags_list, target):
+                if move_series_folder(task_id, series_UID, file_list, target_folder):
+                    monitor.send_register_task(new_task_id, series_UID, task_id)
+                    monitor.send_task_event(monitor.task_event.DELEGATE, task_id, len(file_list),
+                                            new_task_id, ", ".join(selected_targets[target]))
+                    monitor.send_task_event(monitor.task_event.MOVE, task_id, len(file_list), str(target_folder),
+                                            "Moved files")
+                    unlock_moved_folder(task_id, target_folder)
+                    continue
+                (source_folder / mercure_names.TASKFILE).unlink(missing_ok=True)
+
         try:
             os.mkdir(folder_name)
         except Exception:
@@ -533,11 +833,6 @@ def push_serieslevel_outgoing(
             logger.error(f"Unable to create lock file {lock_file}", task_id)  # handle_error
             return
 
-        # Collect the rules that triggered the dispatching to the current target
-        target_rules: Dict[str, Literal[True]] = {}
-        for rule in selected_targets[target]:
-            target_rules[rule] = True
-
         # Generate task file with dispatch information
         if create_series_task(new_task_id, target_folder, target_rules, "", series_UID, tags_list, target):
             monitor.send_register_task(new_task_id, series_UID, task_id)
@@ -556,9 +851,9 @@ def push_serieslevel_outgoing(
                 operation = shutil.move
                 is_operation_move = True
             else:
-                operation = shutil.copy
+                operation = get_copy_operation()
         else:
-            operation = shutil.copy
+            operation = get_copy_operation()
 
         for entry in file_list:
             try:
@@ -585,7 +880,8 @@ def push_serieslevel_outgoing(
             return
 
 
-def push_files(task_id: str, series_uid: str, file_list: List[str], target_folder: Path, copy_files: bool) -> bool:
+def push_files(task_id: str, series_uid: str, file_list: List[str], target_folder: Path, copy_files: bool,
+               allow_hardlink: bool = True) -> bool:
     """
     Copies or moves the given files to the target path. If copy_files is True, files are copied, otherwise moved.
     Note that this function does not create a lock file (this needs to be done by the calling function).
@@ -594,7 +890,7 @@ def push_files(task_id: str, series_uid: str, file_list: List[str], target_folde
     if copy_files is False:
         operation = shutil.move
     else:
-        operation = shutil.copy
+        operation = get_copy_operation(allow_hardlink)
 
     source_folder = Path(config.mercure.incoming_folder) / series_uid
 
@@ -619,6 +915,92 @@ def push_files(task_id: str, series_uid: str, file_list: List[str], target_folde
     return True
 
 
+def move_series_folder(task_id: str, series_uid: str, file_list: List[str], target_folder: Path) -> bool:
+    """
+    Moves the incoming folder of the series as a whole to the target folder, which takes a single rename instead
+    of moving every file. The lock file of the series is moved along, so the target folder stays locked until
+    unlock_moved_folder() is called. Returns False if the folder cannot be renamed (e.g., if it contains other
+    files or if the target is located on a different file system). In this case, the files need to be moved
+    individually and the incoming folder is left untouched.
+    """
+    source_folder = Path(config.mercure.incoming_folder) / series_uid
+
+    expected_files = {mercure_names.LOCK, mercure_names.TASKFILE}
+    for entry in file_list:
+        expected_files.add(entry + mercure_names.DCM)
+        expected_files.add(entry + mercure_names.TAGS)
+    try:
+        if not set(os.listdir(source_folder)) <= expected_files:
+            # Files that are not part of the series (e.g., files that are still being received) must not be moved
+            return False
+        os.rename(source_folder, target_folder)
+    except OSError:
+        logger.debug(f"Unable to rename {source_folder} to {target_folder}, moving files individually")
+        return False
+
+    logger.debug(f"Moved folder {source_folder} to {target_folder}")
+    return True
+
+
+def unlock_moved_folder(task_id: str, target_folder: Path) -> bool:
+    """
+    Removes the lock file of a task folder that has been handed over as a whole (e.g., the lock file that has been
+    moved along with the incoming folder of the series).
+    """
+    lock_file = target_folder / mercure_names.LOCK
+    try:
+        lock_file.unlink()
+    except Exception:
+        # Can't delete lock file, so something must be seriously wrong
+        logger.error(f"Unable to remove lock file {lock_file}", task_id)  # handle_error
+        return False
+    return True
+
+
+def get_copy_operation(allow_hardlink: bool = True) -> Callable:
+    """
+    Returns the function for copying files when a series is sent to multiple destinations. Depending on the
+    setting router_fanout_mode, the copies are created as reflinks (copy-on-write clones) or hardlinks, so that
+    no file data needs to be copied. Hardlinks are only used if the destination does not modify the files.
+    """
+    mode = config.mercure.router_fanout_mode
+    if mode == "copy":
+        return shutil.copy
+
+    def link_or_copy(source: Path, target: Path) -> None:
+        if clone_file(source, target):
+            return
+        if mode == "link" and allow_hardlink:
+            try:
+                os.link(source, target)
+                return
+            except OSError:
+                # Hardlinks not supported or folders on different devices
+                pass
+        shutil.copy(source, target)
+
+    return link_or_copy
+
+
+def clone_file(source: Path, target: Path) -> bool:
+    """
+    Creates a copy-on-write clone of the source file. Returns False if the file system does not support it.
+    """
+    if fcntl is None:
+        return False
+    try:
+        with open(source, "rb") as source_file, open(target, "wb") as target_file:
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+    except OSError:
+        try:
+            os.unlink(target)
+        except OSError:
+            pass
+        return False
+    shutil.copymode(source, target)
+    return True
+
+
 def remove_series(task_id: str, file_list: List[str], series_UID: str) -> bool:
     """
     Deletes the given files from the incoming folder.
@@ -4,45 +4,118 @@ route_studies.py
 Provides functions for routing and processing of studies (consisting of multiple series).
 """
 
-import json
 # Standard python includes
 import os
 import shutil
+import time
 import uuid
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, Optional, Union
+from typing import Dict, Optional, Set, Union, cast
 
 # App-specific includes
+import common.completion_series as completion_series
 import common.config as config
+import common.json_codec as json_codec
 import common.helper as helper
 import common.log_helpers as log_helpers
 import common.monitor as monitor
 import common.notification as notification
-import common.rule_evaluation as rule_evaluation
-from common.constants import mercure_actions, mercure_events, mercure_names, mercure_rule
-from common.types import StudyTriggerCondition, Task, TaskHasStudy, TaskInfo
+import routing.generate_taskfile as generate_taskfile
+from routing.common import get_incremental_targets
+from common.constants import mercure_actions, mercure_defs, mercure_events, mercure_names, mercure_rule
+from common.types import StudyTriggerCondition, Task, TaskDispatch, TaskDispatchStatus, TaskHasStudy, TaskInfo, TaskStudy
 
 # Create local logger instance
 logger = config.get_logger()
 
 
-def route_studies(pending_series: Dict[str, float]) -> None:
+# Study folders modified within this time before they have been indexed are read again on the next run, as further
+# changes within the same timestamp granularity would not be noticed
+RACY_SECONDS = 2
+
+
+@dataclass
+class StudyState:
+    """State of a study folder, valid as long as the modification times of the folder and of its task file do not
+    change (study folders are only modified while they are locked, which changes the folder's modification time)."""
+    mtime_ns: int
+    indexed_at: float
+    locked: bool
+    task: Optional[TaskHasStudy]
+
+
+class StudyIndex:
     """
-    Searches for completed studies and initiates the routing of the completed studies
+    Index of the study folders with their parsed task files, so that study folders that have not changed since the
+    last run only need to be stat'ed (instead of listing the folder and parsing the task file on every run).
+    """
+
+    def __init__(self) -> None:
+        self.studies: Dict[str, StudyState] = {}
+
+    def get_state(self, entry: os.DirEntry) -> StudyState:
+        # Files are added to the folder (changing its mtime), while the received series are appended to the journal
+        mtime_ns = entry.stat().st_mtime_ns
+        try:
+            mtime_ns = max(mtime_ns, os.stat(Path(entry.path) / mercure_names.STUDY_JOURNAL).st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        state = self.studies.get(entry.name)
+        if (
+            state is not None
+            and not state.locked
+            and state.mtime_ns == mtime_ns
+            and mtime_ns < (state.indexed_at - RACY_SECONDS) * 1e9
+        ):
+            return state
+
+        indexed_at = time.time()
+        locked = is_study_locked(entry.path)
+        task: Optional[TaskHasStudy] = None
+        if not locked:
+            try:
+                task = generate_taskfile.read_study_task(Path(entry.path))
+            except Exception:
+                # Reported by is_study_complete
+                task = None
+        state = StudyState(mtime_ns, indexed_at, locked, task)
+        self.studies[entry.name] = state
+        return state
+
+    def prune(self, folders: Set[str]) -> None:
+        for folder in list(self.studies.keys()):
+            if folder not in folders:
+                del self.studies[folder]
+
+
+study_index = StudyIndex()
+
+
+def route_studies(pending_studies: Set[str]) -> None:
+    """
+    Searches for completed studies and initiates the routing of the completed studies. The studies of the series
+    that are still being received are passed in pending_studies.
     """
     # TODO: Handle studies that exceed the "force completion" timeout in the "CONDITION_RECEIVED_SERIES" mode
     studies_ready = {}
+    folders = set()
     with os.scandir(config.mercure.studies_folder) as it:
         it = list(it)  # type: ignore
         for entry in it:
-            if entry.is_dir() and not is_study_locked(entry.path):
-                if is_study_complete(entry.path, pending_series):
+            if not entry.is_dir():
+                continue
+            folders.add(entry.name)
+            state = study_index.get_state(entry)
+            if not state.locked:
+                if is_study_complete(entry.path, pending_studies, state.task):
                     modificationTime = entry.stat().st_mtime
                     studies_ready[entry.name] = modificationTime
                 else:
-                    if not check_force_study_timeout(Path(entry.path)):
+                    if not check_force_study_timeout(Path(entry.path), state.task):
                         logger.error(f"Error during checking force study timeout for study {entry.path}")
+    study_index.prune(folders)
     logger.debug(f"Studies ready for processing: {studies_ready}")
     # Process all complete studies
     for dir_entry in sorted(studies_ready):
@@ -76,29 +149,40 @@ def is_study_locked(folder: str) -> bool:
     folder_status = (
         (path / mercure_names.LOCK).exists()
         or (path / mercure_names.PROCESSING).exists()
-        or len(list(path.glob(mercure_names.DCMFILTER))) == 0
+        or not has_dcm_files(path)
     )
     return folder_status
 
 
-def is_study_complete(folder: str, pending_series: Dict[str, float]) -> bool:
+def has_dcm_files(path: Path) -> bool:
+    """
+    Returns true if the folder contains at least one DICOM file (without listing the whole folder)
+    """
+    with os.scandir(path) as it:
+        return any(entry.name.endswith(mercure_names.DCM) for entry in it)
+
+
+def is_study_complete(folder: str, pending_studies: Set[str], task: Optional[TaskHasStudy] = None) -> bool:
     """
     Returns true if the study in the given folder is ready for processing,
     i.e. if the completeness criteria of the triggered rule has been met
     """
     try:
-        logger.debug(f"Checking completeness of study {folder}, with pending series: {pending_series}")
-        # Read stored task file to determine completeness criteria
-
-        with open(Path(folder) / mercure_names.TASKFILE, "r") as json_file:
-            task: TaskHasStudy = TaskHasStudy(**json.load(json_file))
+        logger.debug(f"Checking completeness of study {folder}, with pending studies: {pending_studies}")
+        # Read stored task file to determine completeness criteria (unless already read by the study index)
+        if task is None:
+            task = generate_taskfile.read_study_task(Path(folder))
 
         if task.study.complete_force is True:
             return True
         if (Path(folder) / mercure_names.FORCE_COMPLETE).exists():
             task.study.complete_force = True
+            # Only the flag is written, as the received series are kept in the study journal until completion
+            with open(Path(folder) / mercure_names.TASKFILE, "r") as json_file:
+                stored_task = TaskHasStudy(**json_codec.load(json_file))
+            stored_task.study.complete_force = True
             with open(Path(folder) / mercure_names.TASKFILE, "w") as json_file:
-                json.dump(task.dict(), json_file)
+                json_codec.dump(stored_task.dict(), json_file)
             return True
 
         study = task.study
@@ -122,7 +206,7 @@ def is_study_complete(folder: str, pending_series: Dict[str, float]) -> bool:
 
         # Check for trigger condition
         if complete_trigger == mercure_rule.STUDY_TRIGGER_CONDITION_TIMEOUT:
-            return check_study_timeout(task, pending_series)
+            return check_study_timeout(task, pending_studies)
         elif complete_trigger == mercure_rule.STUDY_TRIGGER_CONDITION_RECEIVED_SERIES:
             return check_study_series(task, complete_required_series)
         else:
@@ -133,7 +217,7 @@ def is_study_complete(folder: str, pending_series: Dict[str, float]) -> bool:
         return False
 
 
-def check_study_timeout(task: TaskHasStudy, pending_series: Dict[str, float]) -> bool:
+def check_study_timeout(task: TaskHasStudy, pending_studies: Set[str]) -> bool:
     """
     Checks if the duration since the last series of the study was received exceeds the study completion timeout
     """
@@ -148,16 +232,9 @@ def check_study_timeout(task: TaskHasStudy, pending_series: Dict[str, float]) ->
     if datetime.now() > last_receive_time + timedelta(seconds=config.mercure.study_complete_trigger):
         # Check if there is a pending series on this study.
         # If so, we need to wait for it to timeout before we can complete the study
-        for series_uid in pending_series.keys():
-            try:
-                example_file = next((Path(config.mercure.incoming_folder) / series_uid).glob(f"{series_uid}*.tags"))
-            except StopIteration:  # No tag file with this series UID was found
-                logger.error(f"No tag file for series UID {series_uid} was found")
-                raise
-            tags_list = json.loads(example_file.read_text())
-            if tags_list["StudyInstanceUID"] == study.study_uid:
-                logger.debug(f"Timeout met, but found a pending series ({series_uid}) in study {study.study_uid}")
-                return False
+        if study.study_uid in pending_studies:
+            logger.debug(f"Timeout met, but found a pending series in study {study.study_uid}")
+            return False
         logger.debug("Timeout met.")
         return True
     else:
@@ -165,15 +242,15 @@ def check_study_timeout(task: TaskHasStudy, pending_series: Dict[str, float]) ->
         return False
 
 
-def check_force_study_timeout(folder: Path) -> bool:
+def check_force_study_timeout(folder: Path, task: Optional[TaskHasStudy] = None) -> bool:
     """
     Checks if the duration since the creation of the study exceeds the force study completion timeout
     """
     try:
         logger.debug("Checking force study timeout")
 
-        with open(folder / mercure_names.TASKFILE, "r") as json_file:
-            task: TaskHasStudy = TaskHasStudy(**json.load(json_file))
+        if task is None:
+            task = generate_taskfile.read_study_task(folder)
 
         study = task.study
         creation_string = study.creation_time
@@ -223,8 +300,8 @@ def check_study_series(task: TaskHasStudy, required_series: str) -> bool:
     if (task.study.received_series) and (isinstance(task.study.received_series, list)):
         received_series = task.study.received_series
 
-    # Check if the completion criteria is fulfilled
-    return rule_evaluation.parse_completion_series(task.id, required_series, received_series)
+    # Check if the completion criteria is fulfilled (only the series added since the last check are searched)
+    return completion_series.check_completion_series(task.id, task.id, required_series, received_series)
 
 
 @log_helpers.clear_task_decorator
@@ -253,6 +330,10 @@ def route_study(study) -> bool:
             logger.error(f"Unable to create study lock file {lock_file}", None)  # handle_error
         return False
 
+    # Merge the received series into the task file, which is handed over with the study
+    if not generate_taskfile.compact_study_task(None, Path(study_folder)):
+        return False
+
     try:
         # Read stored task file to determine completeness criteria
         task = Task.from_file(Path(study_folder) / mercure_names.TASKFILE)
@@ -260,7 +341,7 @@ def route_study(study) -> bool:
         try:
             with open(Path(study_folder) / mercure_names.TASKFILE, "r") as json_file:
                 logger.error(
-                    f"Invalid task file in study folder {study_folder}", json.load(json_file)["id"]
+                    f"Invalid task file in study folder {study_folder}", json_codec.load(json_file)["id"]
                 )  # handle_error
         except Exception:
             logger.error(f"Invalid task file in study folder {study_folder}", None)  # handle_error
@@ -303,6 +384,53 @@ def push_studylevel_dispatch(study: str, task: Task) -> bool:
     Pushes the study folder to the dispatchter, including the generated task file containing the destination information
     """
     trigger_studylevel_notification(study, task, mercure_events.RECEIVED)
+    if task.study and task.study.forwarded_series_uid:
+        return push_studylevel_remainder(study, task)
+    return move_study_folder(task.id, study, "OUTGOING")
+
+
+def push_studylevel_remainder(study: str, task: Task) -> bool:
+    """
+    Dispatches the rest of a study after some series have been dispatched already while the study was received
+    (incremental dispatch). The targets that received these series only get the remaining series, unless the
+    complete study needs to be sent to other targets anyway.
+    """
+    study_folder = Path(config.mercure.studies_folder) / study
+    incremental_targets, other_targets = get_incremental_targets(config.mercure.rules[task.info.applied_rule or ""])
+    study_info = cast(TaskStudy, task.study)
+    forwarded = set(study_info.forwarded_series_uid or [])
+    remaining = [uid for uid in (study_info.received_series_uid or []) if uid not in forwarded]
+
+    if other_targets:
+        targets = other_targets + incremental_targets if remaining else other_targets
+    else:
+        # Remove the series that have been dispatched already
+        targets = incremental_targets
+        remaining_files = 0
+        try:
+            for entry in list(os.scandir(study_folder)):
+                if entry.name.split(mercure_defs.SEPARATOR)[0] in forwarded:
+                    os.remove(entry.path)
+                elif entry.name.endswith(mercure_names.DCM):
+                    remaining_files += 1
+        except Exception:
+            logger.error(f"Unable to remove dispatched series from study folder {study_folder}", task.id)  # handle_error
+            return False
+        if remaining_files == 0:
+            # All series have been dispatched, so the study is complete
+            trigger_studylevel_notification(study, task, mercure_events.COMPLETED)
+            move_study_folder(task.id, study, "SUCCESS")
+            return True
+
+    task.dispatch = TaskDispatch(
+        target_name=targets,
+        status={target: TaskDispatchStatus(state="waiting", time=helper.get_now_str()) for target in targets},
+    )
+    try:
+        task.to_file(study_folder / mercure_names.TASKFILE)
+    except Exception:
+        logger.error(f"Unable to update task file in study folder {study_folder}", task.id)  # handle_error
+        return False
     return move_study_folder(task.id, study, "OUTGOING")
 
 
@@ -351,7 +479,8 @@ def push_studylevel_error(study: str) -> None:
 
 def move_study_folder(task_id: Union[str, None], study: str, destination: str) -> bool:
     """
-    Moves the study subfolder to the specified destination with proper locking of the folders
+    Moves the study subfolder to the specified destination with proper locking of the folders. The folder is
+    renamed as a whole if possible, otherwise the files are moved individually into a new destination folder.
     """
     logger.debug(f"Move_study_folder {study} to {destination}")
     source_folder = config.mercure.studies_folder + "/" + study
@@ -377,6 +506,18 @@ def move_study_folder(task_id: Union[str, None], study: str, destination: str) -
         # If a task ID exists, name the folder by it to ensure that the files can be found again.
         destination_folder += "/" + str(task_id)
 
+    if Path(destination_folder).exists():
+        logger.error(f"Study destination folder already exists {destination_folder}", task_id)  # handle_error
+        return False
+
+    # Merge the received series into the task file (if not done yet), so that the journal is not handed over
+    if not generate_taskfile.compact_study_task(task_id, Path(source_folder)):
+        return False
+
+    # Hand over the whole folder with a single rename if possible (i.e., if the destination is on the same file system)
+    if rename_study_folder(task_id, study, source_folder, destination_folder):
+        return True
+
     # Create the destination folder and validate that is has been created
     try:
         os.mkdir(destination_folder)
@@ -423,6 +564,39 @@ def move_study_folder(task_id: Union[str, None], study: str, destination: str) -
     return True
 
 
+def rename_study_folder(task_id: Union[str, None], study: str, source_folder: str, destination_folder: str) -> bool:
+    """
+    Moves the study folder as a whole to the destination folder. The folder is locked with the generic lock file
+    during the rename, so that the destination folder is not picked up before the lock of the study router has been
+    removed. Returns False if the folder cannot be renamed (e.g., if the destination is located on a different file
+    system), so that the files need to be moved individually.
+    """
+    # The generic lock file is either held by the caller already (if the study is being discarded or moved to the
+    # error folder) or acquired here for the handoff. The lock file of the study router is removed after the rename.
+    handoff_lock = Path(source_folder) / mercure_names.LOCK
+    created_lock = False
+    try:
+        if not handoff_lock.exists():
+            handoff_lock.touch(exist_ok=False)
+            created_lock = True
+        os.rename(source_folder, destination_folder)
+    except OSError:
+        logger.debug(f"Unable to rename {source_folder} to {destination_folder}, moving files individually")
+        if created_lock:
+            handoff_lock.unlink(missing_ok=True)
+        return False
+
+    logger.debug(f"Moved folder {source_folder} to {destination_folder}")
+    try:
+        (Path(destination_folder) / (study + mercure_names.LOCK)).unlink(missing_ok=True)
+        (Path(destination_folder) / mercure_names.LOCK).unlink()
+    except Exception:
+        # Can't delete lock file, so something must be seriously wrong
+        logger.error(f"Unable to remove lock file in {destination_folder}", task_id)  # handle_error
+        return False
+    return True
+
+
 def remove_study_folder(task_id: Union[str, None], study: str, lock: helper.FileLock) -> bool:
     """
     Removes a study folder containing nothing but the lock file (called during cleanup after all files have
@@ -436,7 +610,11 @@ def remove_study_folder(task_id: Union[str, None], study: str, lock: helper.File
         # Can't delete lock file, so something must be seriously wrong
         logger.error(f"Unable to remove lock file while removing study folder {study}", task_id)  # handle_error
         return False
-    # Remove the empty study folder
+    if task_id is not None:
+        completion_series.discard_study(task_id)
+    # Remove the empty study folder (unless it has been moved as a whole)
+    if not Path(study_folder).exists():
+        return True
     try:
         shutil.rmtree(study_folder)
     except Exception:
@@ -6,26 +6,34 @@ mercure's central router module that evaluates the routing rules and decides whi
 
 # Standard python includes
 import asyncio
+import itertools
 import os
+import re
 import signal
 import sys
 import time
 import typing
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import Dict
+from typing import Dict, Optional
 
 import common.config as config
 import common.helper as helper
 import common.influxdb
 import common.monitor as monitor
 import common.notification as notification
+import common.required_tags as required_tags
 import graphyte
 import hupper
 # App-specific includes
 from common.constants import mercure_defs
+from common.rule_index import rule_index
+from routing import backpressure, routing_order, speculative_routing
 from routing.common import SeriesItem, generate_task_id
+from routing.incoming_watcher import IncomingWatcher, SeriesIndex
 from routing.route_series import route_error_files, route_series
 from routing.route_studies import route_studies
+from routing.sharding import RouterShard
 
 
 @dataclass
@@ -40,6 +48,22 @@ class RouterState():
 logger = config.get_logger()
 main_loop = None  # type: helper.AsyncTimer  # type: ignore
 
+# Index of the series in the incoming folder, kept across runs of the router loop
+series_index = SeriesIndex()
+series_index.get_modification_time = speculative_routing.get_modification_time
+# Shard of the series routed by this instance (if multiple router instances are running)
+router_shard = RouterShard()
+incoming_watcher: Optional[IncomingWatcher] = None
+watcher_failed_at: Optional[float] = None
+
+# Pool of worker threads for routing series in parallel (only used if router_workers > 1)
+routing_pool: Optional[ThreadPoolExecutor] = None
+routing_pool_size = 0
+
+# Tags that have already been reported as not extracted by the receiver, and the configuration that was checked last
+reported_tags: typing.Set[str] = set()
+checked_configuration_timestamp: float = -1
+
 
 async def terminate_process(signalNumber, frame) -> None:
     """
@@ -75,60 +99,212 @@ def run_router() -> None:
         )
         return
 
-    r = RouterState()
-    error_files_found = False
-    for entry in os.scandir(config.mercure.incoming_folder):
-        if entry.name.endswith('.error'):
-            error_files_found = True
-            continue
-        if not entry.is_dir():
-            continue
-        if entry.name == "error":
-            error_files_found = True
-            continue
-        # if not entry.name.endswith(".received"):
-        #     continue
-        series_uid = entry.name
-        mtime = entry.stat().st_mtime
-        if series_uid not in r.series:
-            r.series[series_uid] = SeriesItem(mtime)
-        elif mtime > r.series[series_uid].modification_time:
-            r.series[series_uid].modification_time = mtime
-
-    # Check if any of the series exceeds the "series complete" threshold
-    for series_uid, series_item in r.series.items():
-        if (time.time() - series_item.modification_time) > config.mercure.series_complete_trigger:
-            r.complete_series.add(series_uid)
-            logger.debug("Complete series: " + str(series_uid))
-        else:
-            r.pending_series[series_uid] = series_item.modification_time
-            logger.debug("Pending series: " + str(series_uid))
+    # Set the trigger before updating the index, so that new series are scheduled with the current value
+    series_index.completion.set_trigger(config.mercure.series_complete_trigger)
+    series_index.estimator.configure(
+        config.mercure.router_adaptive_completion,
+        config.mercure.router_adaptive_percentile,
+        config.mercure.router_adaptive_min_trigger,
+        config.mercure.incoming_folder,
+    )
+    series_index.counter.configure(config.mercure.router_count_completion, config.mercure.incoming_folder)
+    series_index.counter.prune(time.time())
+    check_required_tags()
+    # Signal that this instance is alive and take over the series of instances that have gone down
+    if router_shard.heartbeat(config.mercure.incoming_folder, config.mercure.router_takeover_timeout, time.time()):
+        series_index.reassign(config.mercure.incoming_folder)
+    update_series_index()
+    error_files_found = series_index.error_files_found
+
+    # Check which series have exceeded the "series complete" threshold. Only series whose deadline
+    # has passed are touched here
+    for series_uid in series_index.completion.update(time.time()):
+        logger.debug("Complete series: " + str(series_uid))
+    r = RouterState(
+        series=series_index.series,
+        complete_series=series_index.completion.complete,
+        pending_series=series_index.completion.pending,
+    )
 
     # logger.info(f'Files found     = {filecount}')
     # logger.info(f'Series found    = {len(series)}')
     # logger.info(f'Complete series = {len(complete_series)}')
     helper.g_log("incoming.files", r.filecount)
     helper.g_log("incoming.series", len(r.series))
+    if config.mercure.router_adaptive_completion:
+        log_completion_estimates()
+
+    # Measure the downstream queues, so that non-urgent series are neither prepared nor routed while they are full
+    throttled_queues: typing.Set[str] = set()
+    if (r.complete_series or config.mercure.router_speculative_routing) and backpressure.is_enabled():
+        throttled_queues = backpressure.update_queues()
+
+    # Prepare the destinations of series that are still being received
+    if config.mercure.router_speculative_routing:
+        pending_series = r.pending_series
+        if router_shard.enabled:
+            pending_series = {uid: mtime for uid, mtime in pending_series.items() if router_shard.owns(uid)}
+        speculative_routing.update_series(pending_series, throttled_queues)
 
     # Process all complete series
-    for series_uid in sorted(r.complete_series):
-        task_id = generate_task_id()
-        try:
-            route_series(task_id, series_uid)
-            del r.series[series_uid]
-            r.complete_series.remove(series_uid)
-        except Exception:
-            logger.error(f"Problems while routing series {series_uid}", task_id)  # handle_error
-        # If termination is requested, stop processing series after the active one has been completed
-        if helper.is_terminated():
-            return
+    deferred_series = route_complete_series(r.complete_series, throttled_queues)
+    helper.g_log("rules.evaluations", rule_index.evaluated)
+    helper.g_log("rules.skipped_evaluations", rule_index.skipped)
+    # If termination is requested, stop processing after the active series have been completed
+    if helper.is_terminated():
+        return
 
     if error_files_found:
         logger.warning("Error files found during routing")
         route_error_files()
+        series_index.error_files_found = False
+
+    # Now, check if studies in the studies folder are ready for routing/processing. The pending series include the
+    # series of the other router instances, but only one instance routes the studies. Deferred series have not been
+    # added to their study folders yet, so their studies must not be completed either
+    if router_shard.routes_studies():
+        route_studies(series_index.get_pending_studies(itertools.chain(r.pending_series, deferred_series)))
+
+
+def check_required_tags() -> None:
+    """
+    Warns about tags that are used by the rules but not extracted by the receiver. Every tag is only reported once.
+    """
+    global checked_configuration_timestamp
+    if checked_configuration_timestamp == config.configuration_timestamp:
+        return
+    checked_configuration_timestamp = config.configuration_timestamp
+    try:
+        result = required_tags.analyze_config(config.mercure)
+    except Exception as e:
+        logger.info(e)
+        logger.info("Unable to determine the tags used by the rules.")
+        return
+    for tag, users in sorted(result.unavailable.items()):
+        if tag not in reported_tags:
+            reported_tags.add(tag)
+            logger.warning(f"Tag {tag} is used by {', '.join(sorted(users))} but cannot be extracted by the receiver")
+    missing = sorted(set(result.receiver_tags) - set(config.mercure.dicom_receiver.rule_tags) - reported_tags)
+    if missing:
+        reported_tags.update(missing)
+        logger.warning(f"Tags {', '.join(missing)} are used by the rules but not extracted by the receiver. "
+                       "Save the configuration to update the receiver's tag list.")
+
+
+def log_completion_estimates() -> None:
+    """
+    Sends the learned series completion triggers and the time saved compared to the configured trigger to graphite.
+    """
+    for (sender_aet, modality), trigger in series_index.estimator.get_estimates().items():
+        # AETs can contain characters that are not allowed in metric names
+        sender_aet = re.sub(r"[^A-Za-z0-9_-]", "_", sender_aet)
+        modality = re.sub(r"[^A-Za-z0-9_-]", "_", modality)
+        helper.g_log(f"completion.trigger.{sender_aet}.{modality}", trigger)
+    helper.g_log("completion.saved_seconds", series_index.completion.saved_time)
+
+
+def route_complete_series(complete_series: typing.Set[str], throttled_queues: typing.Set[str] = set()) -> typing.Set[str]:
+    """
+    Routes the complete series, either one after the other or in parallel by a pool of worker threads. Mutual
+    exclusion between the workers (and other router instances) is ensured by the lock files of the series. Urgent
+    series are routed first, and series of different senders are interleaved (see routing_order). Non-urgent series
+    are deferred while the queues that they would be added to are above their high watermark. Returns the deferred
+    series.
+    """
+    global routing_pool, routing_pool_size
+    workers = config.mercure.router_workers
+    # Defer non-urgent series if the downstream queues are too full
+    ordered_series = routing_order.order_series(complete_series, series_index.series, throttled_queues)
+    deferred_series = complete_series.difference(ordered_series)
+    if throttled_queues:
+        logger.debug(f"Deferred {len(deferred_series)} series because of full queues: "
+                     f"{', '.join(sorted(throttled_queues))}")
+        helper.g_log("backpressure.deferred_series", len(deferred_series))
+
+    if workers <= 1:
+        for series_uid in ordered_series:
+            if route_complete(series_uid):
+                series_index.remove(series_uid)
+            # If termination is requested, stop processing series after the active one has been completed
+            if helper.is_terminated():
+                break
+        return deferred_series
+
+    if routing_pool is None or routing_pool_size != workers:
+        if routing_pool is not None:
+            routing_pool.shutdown(wait=True)
+        routing_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="router")
+        routing_pool_size = workers
+
+    futures = {series_uid: routing_pool.submit(route_complete, series_uid) for series_uid in ordered_series}
+    # Wait until all series have been routed. Series that have not been started before termination
+    # was requested are skipped by the workers
+    for series_uid, future in futures.items():
+        if future.result():
+            series_index.remove(series_uid)
+    return deferred_series
+
+
+def route_complete(series_uid: str) -> bool:
+    """
+    Routes a single complete series. Returns True if the series has been handled.
+    """
+    if helper.is_terminated():
+        return False
+    task_id = generate_task_id()
+    try:
+        route_series(task_id, series_uid)
+        return True
+    except Exception:
+        logger.error(f"Problems while routing series {series_uid}", task_id)  # handle_error
+        return False
 
-    # Now, check if studies in the studies folder are ready for routing/processing
-    route_studies(r.pending_series)
+
+def update_series_index() -> None:
+    """
+    Updates the index of series in the incoming folder. If watching is enabled, only the changes reported by the
+    watcher are applied (with periodic full scans for reconciliation). Otherwise, the incoming folder is scanned.
+    """
+    global incoming_watcher, watcher_failed_at
+    incoming_folder = config.mercure.incoming_folder
+
+    if incoming_watcher is not None:
+        if not config.mercure.router_watch_incoming:
+            stop_incoming_watcher()
+        elif incoming_watcher.folder != incoming_folder or not incoming_watcher.is_alive:
+            logger.warning("Restarting watcher for incoming folder")
+            stop_incoming_watcher()
+
+    # If the watcher could not be started, retry only after the reconciliation interval
+    retry_watcher = (watcher_failed_at is None
+                     or time.monotonic() - watcher_failed_at > config.mercure.router_reconcile_interval)
+    if config.mercure.router_watch_incoming and incoming_watcher is None and retry_watcher:
+        watcher = IncomingWatcher(incoming_folder, series_index)
+        if watcher.start():
+            incoming_watcher = watcher
+            watcher_failed_at = None
+            return
+        watcher_failed_at = time.monotonic()
+
+    if incoming_watcher is not None:
+        incoming_watcher.update(config.mercure.router_reconcile_interval)
+    else:
+        # Fallback: scan the full incoming folder
+        series_index.rescan(incoming_folder)
+
+
+def stop_routing_pool() -> None:
+    global routing_pool
+    if routing_pool is not None:
+        routing_pool.shutdown(wait=True)
+        routing_pool = None
+
+
+def stop_incoming_watcher() -> None:
+    global incoming_watcher
+    if incoming_watcher is not None:
+        incoming_watcher.stop()
+        incoming_watcher = None
 
 
 def exit_router(args) -> None:
@@ -200,6 +376,13 @@ def main(args=sys.argv[1:]) -> None:
         Processing folder: {config.mercure.processing_folder}"""
     )
 
+    # Only route the series of this instance's shard if multiple router instances are running
+    global router_shard
+    router_shard = RouterShard.from_environment()
+    series_index.is_owned = router_shard.owns
+    if router_shard.enabled:
+        logger.info(f"Router instance {router_shard.index} of {router_shard.count} instances")
+
     # Start the timer that will periodically trigger the scan of the incoming folder
     global main_loop
     main_loop = helper.AsyncTimer(config.mercure.router_scan_interval, run_router)
@@ -214,6 +397,8 @@ def main(args=sys.argv[1:]) -> None:
         monitor.send_event(monitor.m_events.SHUTDOWN, monitor.severity.ERROR, str(e))
         logger.exception(e)
     finally:
+        stop_incoming_watcher()
+        stop_routing_pool()
         # Finish all asyncio tasks that might be still pending
         remaining_tasks = helper.asyncio.all_tasks(helper.loop)  # type: ignore[attr-defined]
         if remaining_tasks:
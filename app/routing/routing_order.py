@@ -0,0 +1,136 @@
+"""
+routing_order.py
+================
+Determines the order in which the complete series are routed. Series that trigger an urgent rule are routed first
+and series that only trigger offpeak rules last. Within each priority, the series are routed round-robin per sender
+AET, so that a sender delivering many series cannot delay the series of the other senders. If downstream queues are
+throttled (see backpressure), non-urgent series that would add to these queues are deferred. The rules triggered by
+a series are evaluated once without logging and are reused by route_series.
+"""
+
+# Standard python includes
+import os
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Deque, Dict, Iterable, List, Optional, Set
+
+# App-specific includes
+import common.config as config
+import common.json_codec as json_codec
+from common.constants import mercure_defs, mercure_names, mercure_options
+from routing import backpressure, route_series
+from routing.common import SeriesItem, SpeculativeClaim
+
+URGENT = 0
+NORMAL = 1
+OFFPEAK = 2
+
+priority_ranks = {"urgent": URGENT, "normal": NORMAL, "offpeak": OFFPEAK}
+
+
+@dataclass
+class SeriesClass:
+    priority: int
+    sender_aet: str
+    # Downstream queues that the series is added to (only determined if backpressure is enabled)
+    queues: Set[str] = field(default_factory=set)
+
+
+# Classification of the complete series that have not been routed yet, so that the rules are only evaluated once
+classified_series: Dict[str, SeriesClass] = {}
+
+
+def order_series(complete_series: Iterable[str], series: Dict[str, SeriesItem],
+                 throttled_queues: Set[str] = set()) -> List[str]:
+    """
+    Returns the complete series in the order in which they should be routed. Series of the same sender AET and
+    priority are routed in the order in which they have been received. Series that are deferred because of
+    throttled queues are not included.
+    """
+    complete = set(complete_series)
+    for series_uid in list(classified_series.keys()):
+        if series_uid not in complete:
+            del classified_series[series_uid]
+            route_series.classified_rules.pop(series_uid, None)
+
+    queues: Dict[int, Dict[str, List[str]]] = {}
+    for series_uid in complete:
+        series_class = classified_series.get(series_uid)
+        if series_class is None:
+            series_class = classify_series(series_uid)
+            classified_series[series_uid] = series_class
+        if series_class.priority != URGENT and series_class.queues & throttled_queues:
+            continue
+        queues.setdefault(series_class.priority, {}).setdefault(series_class.sender_aet, []).append(series_uid)
+
+    def received(series_uid: str) -> float:
+        item = series.get(series_uid)
+        return item.modification_time if item is not None else 0
+
+    ordered: List[str] = []
+    for priority in sorted(queues.keys()):
+        senders: Deque[Deque[str]] = deque(
+            deque(sorted(uids, key=lambda uid: (received(uid), uid)))
+            for uids in sorted(queues[priority].values(), key=lambda uids: min((received(uid), uid) for uid in uids))
+        )
+        # Take one series from every sender in turn
+        while senders:
+            sender_queue = senders.popleft()
+            ordered.append(sender_queue.popleft())
+            if sender_queue:
+                senders.append(sender_queue)
+    return ordered
+
+
+def classify_series(series_uid: str) -> SeriesClass:
+    """
+    Reads the tags of the first instance of the series and determines the priority of the series from the rules
+    that it triggers. Errors are ignored here, as they are reported when the series is routed.
+    """
+    tags = read_first_tags(series_uid)
+    if tags is None:
+        return SeriesClass(NORMAL, mercure_options.MISSING)
+    sender_aet = str(tags.get("SenderAET", mercure_options.MISSING))
+    rules = config.mercure.rules
+    check_queues = backpressure.is_enabled()
+    if not check_queues and all(rule.priority == "normal" for rule in rules.values()):
+        # Nothing to distinguish, so the rules don't need to be evaluated
+        return SeriesClass(NORMAL, sender_aet)
+
+    claim_file = Path(config.mercure.incoming_folder) / series_uid / mercure_names.SPECULATIVE
+    queues: Set[str] = set()
+    try:
+        # The task folder of the series exists already, so it doesn't add to the queues
+        triggered_rules = list(SpeculativeClaim.from_file(claim_file).triggered_rules)
+    except Exception:
+        triggered_rules = list(route_series.classify_rules(series_uid, tags)[0])
+        queues = backpressure.get_queues(triggered_rules)
+
+    ranks = [priority_ranks.get(rules[rule].priority, NORMAL) for rule in triggered_rules if rule in rules]
+    return SeriesClass(min(ranks, default=NORMAL), sender_aet, queues)
+
+
+def read_first_tags(series_uid: str) -> Optional[Dict[str, str]]:
+    """
+    Returns the tags of the first instance found for the series, either in its incoming folder or in the task
+    folder that has been prepared for the series by speculative routing.
+    """
+    folder = Path(config.mercure.incoming_folder) / series_uid
+    folders = [folder]
+    try:
+        folders.append(Path(SpeculativeClaim.from_file(folder / mercure_names.SPECULATIVE).target_folder))
+    except Exception:
+        pass
+
+    series_prefix = series_uid + mercure_defs.SEPARATOR
+    for current_folder in folders:
+        try:
+            for entry in os.scandir(current_folder):
+                if entry.name.endswith(mercure_names.TAGS) and entry.name.startswith(series_prefix):
+                    with open(entry.path, "r", encoding="utf-8", errors="surrogateescape") as json_file:
+                        tags: Dict[str, str] = json_codec.load(json_file)
+                    return tags
+        except (OSError, ValueError):
+            continue
+    return None
@@ -0,0 +1,117 @@
+"""
+sharding.py
+===========
+Coordination of multiple router instances. Every instance is given its index and the number of instances (via the
+environment variables MERCURE_ROUTER_INSTANCE and MERCURE_ROUTER_INSTANCES) and only routes the series whose UID
+hashes to its shard. The instances signal that they are alive by touching a heartbeat file in the incoming folder.
+If an instance stops doing so, its series are taken over by the next live instance. The studies in the studies
+folder are only routed by one instance, the live instance with the lowest index.
+"""
+
+# Standard python includes
+import os
+import zlib
+from pathlib import Path
+from typing import Optional, Set
+
+# App-specific includes
+import common.config as config
+
+# Create local logger instance
+logger = config.get_logger()
+
+HEARTBEAT_PREFIX = ".router-"
+
+
+class RouterShard:
+    """
+    Shard of the incoming series that belongs to one router instance. With a single instance, all series belong
+    to the instance and no heartbeat files are written.
+    """
+
+    def __init__(self, index: int = 0, count: int = 1) -> None:
+        self.index = index
+        self.count = count
+        # Instances that have touched their heartbeat file within the takeover timeout
+        self.alive: Set[int] = set(range(count))
+        self.started: Optional[float] = None
+
+    @classmethod
+    def from_environment(cls) -> "RouterShard":
+        try:
+            count = int(os.getenv("MERCURE_ROUTER_INSTANCES", "1"))
+            index = int(os.getenv("MERCURE_ROUTER_INSTANCE", "0"))
+        except ValueError:
+            logger.error("Invalid router instance settings. Routing all series.")  # handle_error
+            return cls()
+        if count < 1 or not 0 <= index < count:
+            logger.error(f"Invalid router instance {index} of {count}. Routing all series.")  # handle_error
+            return cls()
+        return cls(index, count)
+
+    @property
+    def enabled(self) -> bool:
+        return self.count > 1
+
+    def routes_studies(self) -> bool:
+        """
+        Returns True if this instance routes the studies. Studies are not sharded, as the series of a study can belong
+        to different shards, so they are routed by the live instance with the lowest index.
+        """
+        return not self.enabled or self.index == min(self.alive)
+
+    def owns(self, series_uid: str) -> bool:
+        return self.get_owner(series_uid) == self.index
+
+    def get_owner(self, series_uid: str) -> int:
+        """
+        Returns the instance that routes the series. If the instance of the series' shard is down, the series
+        belongs to the next live instance.
+        """
+        if not self.enabled:
+            return self.index
+        shard = zlib.crc32(series_uid.encode("utf-8", errors="surrogateescape")) % self.count
+        for offset in range(self.count):
+            instance = (shard + offset) % self.count
+            if instance in self.alive:
+                return instance
+        return self.index
+
+    def heartbeat(self, folder: str, timeout: float, now: float) -> bool:
+        """
+        Touches the heartbeat file of this instance and checks which instances are alive. Returns True if the
+        set of live instances (and thus the assignment of series) has changed.
+        """
+        if not self.enabled:
+            return False
+        try:
+            (Path(folder) / f"{HEARTBEAT_PREFIX}{self.index}").touch()
+        except OSError:
+            logger.error(f"Unable to write heartbeat file of router instance {self.index}")  # handle_error
+
+        if self.started is None:
+            self.started = now
+        alive = {self.index}
+        for instance in range(self.count):
+            if instance == self.index:
+                continue
+            # Instances that have not written a heartbeat yet are given the timeout to start up
+            last_seen = self._get_last_seen(folder, instance) or self.started
+            if now - last_seen <= timeout:
+                alive.add(instance)
+
+        if alive == self.alive:
+            return False
+        for instance in sorted(self.alive - alive):
+            logger.warning(f"Router instance {instance} is down. Its series are taken over by the other instances.")
+        for instance in sorted(alive - self.alive):
+            logger.info(f"Router instance {instance} is up")
+        self.alive = alive
+        return True
+
+    @staticmethod
+    def _get_last_seen(folder: str, instance: int) -> Optional[float]:
+        try:
+            return os.stat(Path(folder) / f"{HEARTBEAT_PREFIX}{instance}").st_mtime
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,249 @@
+"""
+speculative_routing.py
+======================
+Speculative routing of series that are still being received. The routing rules are evaluated on the first instance
+of a series. If the series has a single destination, the task folder is prepared right away and the instances are
+moved into it while the series is arriving. Once the series is complete, route_series only moves the remaining
+instances and releases the task folder.
+
+Moving instances out of the incoming folder updates the modification time of the folder, although nothing has
+arrived. The timestamps written by the receiver are never changed. Instead, the modification time of the folder
+after the last sweep is remembered, and the series index asks get_modification_time() for the time of the last
+arrival as long as the folder has not been modified since.
+"""
+
+# Standard python includes
+import os
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
+# App-specific includes
+import common.config as config
+import common.json_codec as json_codec
+from common.constants import mercure_actions, mercure_defs, mercure_names, mercure_options
+from routing import backpressure
+from routing.common import SpeculativeClaim, generate_task_id
+from routing.generate_taskfile import create_series_task
+from routing.route_series import get_triggered_rules
+from typing_extensions import Literal
+
+# Create local logger instance
+logger = config.get_logger()
+
+
+@dataclass
+class SpeculativeSeries:
+    # Prepared task folder, or None if the series is routed when complete
+    target_folder: Optional[Path]
+    # Modification time of the series when it was last swept
+    swept_time: float = 0
+    # Modification time of the incoming folder right after the last sweep (0 if the folder has not been touched)
+    folder_time: float = 0
+    # Newest modification time of the instances moved by the last sweep
+    moved_time: float = 0
+    # Time of the last arrival, determined when first needed after the sweep
+    arrival_time: Optional[float] = None
+
+    def record_sweep(self, folder: Path, moved_time: float) -> None:
+        """Remembers the modification time that the sweep has left on the incoming folder."""
+        try:
+            self.folder_time = os.stat(folder).st_mtime
+        except FileNotFoundError:
+            self.folder_time = 0
+        self.moved_time = moved_time
+        self.arrival_time = None
+
+
+# Series that have been evaluated by this router instance while being received
+speculative_series: Dict[str, SpeculativeSeries] = {}
+
+
+def update_series(pending_series: Dict[str, float], throttled_queues: Set[str] = set()) -> None:
+    """
+    Prepares the destinations of newly arrived series and moves the instances that have been received since
+    the last call into the prepared task folders. Non-urgent series that would be added to one of the throttled
+    queues are not prepared, but routed once complete (where they are deferred until the queue has drained).
+    """
+    for series_uid in list(speculative_series.keys()):
+        if series_uid not in pending_series:
+            del speculative_series[series_uid]
+
+    for series_uid, modification_time in pending_series.items():
+        series = speculative_series.get(series_uid)
+        if series is None:
+            series = prepare_series(series_uid, throttled_queues)
+            if series is None:
+                # No instance has been received completely yet, try again during the next run
+                continue
+            speculative_series[series_uid] = series
+        if series.target_folder is not None and modification_time > series.swept_time:
+            sweep_series(series_uid, series, modification_time)
+
+
+def get_modification_time(series_uid: str, folder_time: float) -> float:
+    """
+    Returns the time at which the last file of the series has arrived, given the modification time of its incoming
+    folder. If the folder has not been modified since it was last swept, the modification time reflects the sweep
+    and not an arrival, so the newest modification time of the files in the folder and of the moved instances is
+    returned instead. This is evaluated on the first call after the sweep (i.e., during the next router run), so
+    that instances arriving within the timestamp granularity of the sweep are taken into account as well.
+    """
+    series = speculative_series.get(series_uid)
+    if series is None or not series.folder_time or folder_time != series.folder_time:
+        return folder_time
+    if series.arrival_time is None:
+        newest = series.moved_time
+        try:
+            for entry in os.scandir(Path(config.mercure.incoming_folder) / series_uid):
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    newest = max(newest, entry.stat().st_mtime)
+                except FileNotFoundError:
+                    continue
+        except FileNotFoundError:
+            return folder_time
+        series.arrival_time = min(newest, folder_time)
+    return series.arrival_time
+
+
+def get_single_destination(
+    triggered_rules: Dict[str, Literal[True]], discard_rule: str
+) -> Optional[Tuple[str, str, str]]:
+    """
+    Returns the base folder, the applied rule, and the target if the triggered rules send the series to exactly
+    one destination. Returns None if the series needs to be routed by route_series once complete.
+    """
+    if discard_rule or len(triggered_rules) != 1:
+        return None
+    rule_name = next(iter(triggered_rules))
+    rule = config.mercure.rules[rule_name]
+    if rule.get("action_trigger", mercure_options.SERIES) != mercure_options.SERIES:
+        return None
+
+    action = rule.get("action", "")
+    if action in (mercure_actions.PROCESS, mercure_actions.BOTH):
+        return config.mercure.processing_folder, rule_name, ""
+    if action == mercure_actions.ROUTE:
+        targets = rule.get("target")
+        if isinstance(targets, str):
+            targets = [targets] if targets else []
+        if targets and len(targets) == 1 and targets[0] in config.mercure.targets:
+            return config.mercure.outgoing_folder, "", targets[0]
+    return None
+
+
+def prepare_series(series_uid: str, throttled_queues: Set[str] = set()) -> Optional[SpeculativeSeries]:
+    """
+    Evaluates the routing rules on the first received instance of the series and, if the series has a single
+    destination, creates the locked task folder and stores the claim in the incoming folder of the series.
+    """
+    folder = Path(config.mercure.incoming_folder) / series_uid
+    claim_file = folder / mercure_names.SPECULATIVE
+    series_prefix = series_uid + mercure_defs.SEPARATOR
+
+    try:
+        if claim_file.exists():
+            # Prepared by another router instance or before the router has been restarted
+            return SpeculativeSeries(Path(SpeculativeClaim.from_file(claim_file).target_folder))
+        if (folder / mercure_names.LOCK).exists():
+            # Series is already being routed
+            return SpeculativeSeries(None)
+        tags_file = next((entry.path for entry in os.scandir(folder)
+                          if entry.name.endswith(mercure_names.TAGS) and entry.name.startswith(series_prefix)), None)
+        if tags_file is None:
+            return None
+        with open(tags_file, "r", encoding="utf-8", errors="surrogateescape") as json_file:
+            tags_list: Dict[str, str] = json_codec.load(json_file)
+    except (FileNotFoundError, ValueError):
+        # Folder has been removed or the tags file is still being written
+        return None
+    except Exception:
+        logger.exception(f"Unable to evaluate series {series_uid} for speculative routing")
+        return SpeculativeSeries(None)
+
+    triggered_rules, discard_rule = get_triggered_rules(None, tags_list)
+    destination = get_single_destination(triggered_rules, discard_rule)
+    if destination is None:
+        return SpeculativeSeries(None)
+    rule_name = next(iter(triggered_rules))
+    if config.mercure.rules[rule_name].priority != "urgent" and backpressure.get_queues([rule_name]) & throttled_queues:
+        logger.debug(f"Not preparing series {series_uid} because of full queues")
+        return SpeculativeSeries(None)
+    base_folder, applied_rule, target = destination
+
+    new_task_id = generate_task_id()
+    target_folder = Path(base_folder) / new_task_id
+    try:
+        target_folder.mkdir()
+        (target_folder / mercure_names.LOCK).touch(exist_ok=False)
+    except Exception:
+        logger.error(f"Unable to create task folder {target_folder}")  # handle_error
+        return SpeculativeSeries(None)
+
+    if not create_series_task(new_task_id, target_folder, triggered_rules, applied_rule, series_uid, tags_list, target):
+        shutil.rmtree(target_folder, ignore_errors=True)
+        return SpeculativeSeries(None)
+
+    # Claim the series by linking the claim file into place, which fails if another router instance has been faster
+    claim = SpeculativeClaim(new_task_id, str(target_folder), applied_rule, dict(triggered_rules))
+    temp_file = folder / f"{mercure_names.SPECULATIVE}-{new_task_id}"
+    series = SpeculativeSeries(None)
+    try:
+        claim.to_file(temp_file)
+        os.link(temp_file, claim_file)
+        series.target_folder = target_folder
+    except FileExistsError:
+        shutil.rmtree(target_folder, ignore_errors=True)
+        return None
+    except Exception:
+        logger.exception(f"Unable to store claim for series {series_uid}")
+        shutil.rmtree(target_folder, ignore_errors=True)
+    finally:
+        temp_file.unlink(missing_ok=True)
+
+    # Writing the claim has modified the incoming folder
+    series.record_sweep(folder, 0)
+    if series.target_folder is not None:
+        logger.info(f"Prepared task folder {target_folder} for series {series_uid}")
+    return series
+
+
+def sweep_series(series_uid: str, series: SpeculativeSeries, modification_time: float) -> None:
+    """
+    Moves the instances that have been received completely (i.e., for which the tags file exists) into the
+    prepared task folder. modification_time is the modification time of the series that has triggered the sweep.
+    """
+    folder = Path(config.mercure.incoming_folder) / series_uid
+    series_prefix = series_uid + mercure_defs.SEPARATOR
+    target_folder = series.target_folder
+    if target_folder is None or (folder / mercure_names.LOCK).exists():
+        return
+
+    moved_time: float = 0
+    try:
+        for entry in list(os.scandir(folder)):
+            if not entry.name.endswith(mercure_names.TAGS) or not entry.name.startswith(series_prefix):
+                continue
+            stem = entry.name[: -len(mercure_names.TAGS)]
+            try:
+                # The tags file is written after the DICOM file, so its modification time is the arrival time
+                moved_time = max(moved_time, entry.stat().st_mtime)
+                os.rename(folder / (stem + mercure_names.DCM), target_folder / (stem + mercure_names.DCM))
+                os.rename(entry.path, target_folder / entry.name)
+            except FileNotFoundError:
+                # Moved by another router instance in the meantime
+                continue
+    except FileNotFoundError:
+        # Folder has been removed in the meantime (e.g., routed by another router instance)
+        return
+    except OSError:
+        # E.g., if the task folder is located on a different file system
+        logger.warning(f"Unable to move instances of series {series_uid} into {target_folder}. "
+                       "Remaining instances will be moved when the series is complete.")
+        series.target_folder = None
+    series.swept_time = max(modification_time, moved_time)
+    if moved_time:
+        series.record_sweep(folder, moved_time)
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+"""
+benchmark_json_codec.py
+=======================
+Measures the time needed for parsing and serializing the JSON files that mercure exchanges between its modules
+(task files, tags files and the configuration), for every available backend of common.json_codec. The
+serialization times are compared against json.dump, which was used before the codec was introduced.
+
+Usage: python tests/benchmark_json_codec.py [repetitions]
+"""
+
+# Standard python includes
+import io
+import json
+import sys
+import timeit
+from pathlib import Path
+from typing import Any, Callable, Dict
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# App-specific includes
+import common.json_codec as json_codec  # noqa: E402
+
+
+def sample_task() -> Dict[str, Any]:
+    return {
+        "info": {"action": "route", "uid": "1.2.826.0.1.3680043.8.498.1", "uid_type": "study",
+                 "triggered_rules": {f"rule_{i}": True for i in range(5)}, "applied_rule": "rule_0",
+                 "patient_name": "Test^Patient", "mrn": "12345", "acc": "A123456", "sender_address": "10.0.0.1",
+                 "mercure_version": "0.4.0", "mercure_appliance": "master", "mercure_server": "mercure",
+                 "device_serial_number": None, "fail_stage": None, "sender_aet": "MODALITY",
+                 "receiver_aet": "MERCURE"},
+        "id": "e1b4a0a2-6b0a-4f8e-9a53-0c2b8b5b1a10",
+        "dispatch": {"target_name": ["pacs", "archive"], "status": {}, "retries": 0, "next_retry_at": 0,
+                     "series_uid": None},
+        "process": {},
+        "study": {"study_uid": "1.2.826.0.1.3680043.8.498.1", "complete_trigger": "timeout",
+                  "complete_required_series": "", "creation_time": "2024-01-01 10:00:00",
+                  "last_receive_time": "2024-01-01 10:05:00",
+                  "received_series": [f"Series {i}" for i in range(20)],
+                  "received_series_uid": [f"1.2.826.0.1.3680043.8.498.1.{i}" for i in range(20)],
+                  "complete_force": False},
+        "nomad_info": None,
+    }
+
+
+def sample_tags() -> Dict[str, Any]:
+    tags: Dict[str, Any] = {f"Tag{i:04d}": f"Value of tag {i} äöü" for i in range(250)}
+    tags.update({"SeriesInstanceUID": "1.2.826.0.1.3680043.8.498.1.1", "Modality": "CT",
+                 "SeriesDescription": "Thorax 1.0 B70f", "NumberOfFrames": "1"})
+    return tags
+
+
+def sample_config() -> Dict[str, Any]:
+    with open(Path(__file__).resolve().parent / "data" / "test_config.json", "r") as json_file:
+        config: Dict[str, Any] = json.load(json_file)
+    rule = {"rule": "True", "target": "target_0", "disabled": "False", "fallback": "False", "contact": "",
+            "comment": "", "tags": "", "action": "route", "action_trigger": "series",
+            "study_trigger_condition": "timeout", "study_trigger_series": "", "priority": "normal",
+            "processing_module": "", "processing_settings": "", "notification_webhook": "",
+            "notification_payload": "", "notification_trigger_reception": "False",
+            "notification_trigger_completion": "False", "notification_trigger_error": "False"}
+    target = next(iter(config["targets"].values()))
+    config["rules"] = {f"rule_{i}": {**rule, "rule": f'@Modality@ == "CT" and @StationName@ == "Station{i}"'}
+                       for i in range(100)}
+    config["targets"] = {f"target_{i}": {**target, "ip": f"10.0.0.{i}"} for i in range(50)}
+    return config
+
+
+def measure(function: Callable[[], Any], repetitions: int) -> float:
+    """Returns the best time of a single call in microseconds."""
+    return min(timeit.repeat(function, number=repetitions, repeat=5)) / repetitions * 1e6
+
+
+def run(repetitions: int) -> None:
+    backends = [json_codec.BACKEND_STDLIB] + ([json_codec.BACKEND_ORJSON] if json_codec.orjson is not None else [])
+    samples = {"task": (sample_task(), None), "tags": (sample_tags(), None), "config": (sample_config(), 4)}
+
+    print(f"{'file':<8}{'size':>10}  {'operation':<22}{'time (us)':>12}")
+    for name, (document, indent) in samples.items():
+        content = json.dumps(document, indent=indent).encode("utf-8")
+        assert json_codec.dumps(document, indent=indent).encode("utf-8") == content
+
+        for backend in backends:
+            json_codec.set_backend(backend)
+            elapsed = measure(lambda: json_codec.loads(content), repetitions)
+            print(f"{name:<8}{len(content):>10}  {'parse ' + backend:<22}{elapsed:>12.1f}")
+
+        elapsed = measure(lambda: json.dump(document, io.StringIO(), indent=indent), repetitions)
+        print(f"{name:<8}{len(content):>10}  {'serialize json.dump':<22}{elapsed:>12.1f}")
+        elapsed = measure(lambda: json_codec.dump(document, io.StringIO(), indent=indent), repetitions)
+        print(f"{name:<8}{len(content):>10}  {'serialize json_codec':<22}{elapsed:>12.1f}")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -121,6 +121,8 @@ def mercure_config(fs, bookkeeper_port) -> Callable[[Dict], Config]:
     config_path = os.path.realpath(os.path.dirname(os.path.realpath(__file__)) + "/data/test_config.json")
 
     fs.add_real_file(config_path, target_path=config.configuration_filename, read_only=False)
+    # The app folder is needed when the configuration is saved (e.g., getdcmtags' data dictionary)
+    fs.add_real_directory(os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + '/..'))
     for k in ["incoming", "studies", "outgoing", "success", "error", "discard", "processing", "jobs"]:
         fs.create_dir(f"/var/{k}")
 
@@ -140,7 +142,6 @@ HOST=0.0.0.0
 DATABASE_URL={config.mercure.bookkeeper}"""
     fs.create_file(bookkeeper.bk_config.config_filename, contents=bookkeeper_env)
 
-    fs.add_real_directory(os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + '/..'))
     # fs.add_real_file(os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + '/..'), read_only=True)
     return set_config
 
@@ -198,9 +198,9 @@ def create_and_route(fs, mocked, task_id, config, uid="TESTFAKEUID") -> Tuple[Li
     routing.route_series.push_serieslevel_outgoing.assert_called_once_with(  # type: ignore
         task_id, {"catchall": True}, [f"{uid}#bar"], uid, unittest.mock.ANY, {})
 
-    assert ["task.json", f"{uid}#bar.dcm", f"{uid}#bar.tags"] == [
+    assert sorted(["task.json", f"{uid}#bar.dcm", f"{uid}#bar.tags"]) == sorted(
         k.name for k in Path("/var/processing").glob("**/*") if k.is_file()
-    ]
+    )
 
     # mocked.patch("process.processor.process_series", new=mocked.spy(processor, "process_series"))
     return ["task.json", f"{uid}#bar.dcm", f"{uid}#bar.tags"], new_task_id
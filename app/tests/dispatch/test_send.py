@@ -1,5 +1,6 @@
 import json
 import time
+from datetime import timedelta
 from pathlib import Path
 from subprocess import CalledProcessError
 from unittest.mock import call
@@ -7,7 +8,9 @@ from unittest.mock import call
 import common
 from common.constants import mercure_names
 from common.monitor import m_events, severity, task_event
+from common.types import TaskCache
 from dispatch.send import execute, is_ready_for_sending
+from freezegun import freeze_time
 from tests.testing_common import fake_check_output
 
 dummy_info = {
@@ -49,6 +52,32 @@ def test_execute_successful_case(fs, mocked):
     assert (Path(success) / "a" / "one.dcm").exists()
 
 
+def test_execute_keeps_cached_task(fs, mocked):
+    """The dispatch status is updated on a copy of the task, as the task from the task cache is shared."""
+    source = "/var/data/source/a"
+    success = "/var/data/success/"
+    error = "/var/data/error"
+    task_cache = mocked.patch("dispatch.status.task_cache", TaskCache())
+
+    with freeze_time("2020-01-01 00:00:00") as frozen_time:
+        fs.create_dir(success)
+        fs.create_dir(error)
+        fs.create_file("/var/data/source/a/one.dcm")
+        target = {"id": "task_id", "info": dummy_info, "dispatch": {"target_name": "test_target"}}
+        fs.create_file("/var/data/source/a/" + mercure_names.TASKFILE, contents=json.dumps(target))
+        frozen_time.tick(delta=timedelta(seconds=5))
+        cached = task_cache.get("/var/data/source/a/" + mercure_names.TASKFILE)
+
+        mocked.patch("dispatch.target_types.base.check_output", side_effect=CalledProcessError(1, cmd="None"))
+        execute(Path(source), Path(success), Path(error), 10, 1)
+
+    assert task_cache.hits == 1
+    with open("/var/data/source/a/" + mercure_names.TASKFILE, "r") as f:
+        assert json.load(f)["dispatch"]["retries"] == 1
+    assert cached.dispatch.target_name == "test_target"  # type: ignore
+    assert cached.dispatch.retries == 0  # type: ignore
+
+
 def test_execute_error_case(fs, mocked):
     """This case simulates a dcmsend error. After that the retry counter
     gets increased but the data stays in the folder."""
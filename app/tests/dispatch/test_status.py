@@ -1,7 +1,12 @@
 import json
+from datetime import timedelta
+from pathlib import Path
+from typing import Any, Dict
 
 from common.constants import mercure_names
+from common.types import TaskCache
 from dispatch.status import is_ready_for_sending, is_target_json_valid
+from freezegun import freeze_time
 
 pytest_plugins = ("pyfakefs",)
 dummy_info = {
@@ -53,3 +58,32 @@ def test_read_target(fs):
     read_dispatch = task_content.dispatch
     assert read_dispatch
     assert "target_name" in read_dispatch.dict()
+
+
+def test_task_cache(fs):
+    target: Dict[str, Any] = {"id": "task_id", "info": dummy_info, "dispatch": {"target_name": "test_target"}}
+    task_file = "/var/data/" + mercure_names.TASKFILE
+    cache = TaskCache()
+    with freeze_time("2020-01-01 00:00:00") as frozen_time:
+        fs.create_file(task_file, contents=json.dumps(target))
+        # Files that have just been modified are parsed again, as a further change might not be visible
+        first = cache.get(task_file)
+        assert cache.get(task_file) is not first
+        assert (cache.hits, cache.misses) == (0, 2)
+
+        frozen_time.tick(delta=timedelta(seconds=5))
+        second = cache.get(task_file)
+        assert cache.get(task_file) is second
+        assert cache.get(Path(task_file)) is second
+        assert (cache.hits, cache.misses) == (2, 3)
+
+        # Changed files are parsed again
+        target["dispatch"]["target_name"] = "other_target"
+        with open(task_file, "w") as f:
+            json.dump(target, f)
+        frozen_time.tick(delta=timedelta(seconds=5))
+        third = cache.get(task_file)
+        assert third.dispatch.target_name == "other_target"  # type: ignore
+        assert cache.get(task_file) is third
+        assert (cache.hits, cache.misses) == (3, 4)
+        assert cache.hit_rate == 3 / 7
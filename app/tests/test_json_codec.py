@@ -0,0 +1,80 @@
+"""
+test_json_codec.py
+==================
+"""
+import dataclasses
+import json
+from pathlib import Path
+
+import common.json_codec as json_codec
+import pytest
+from common.types import Task, TaskDispatch, TaskInfo
+from routing.common import SpeculativeClaim
+
+backends = [
+    json_codec.BACKEND_STDLIB,
+    pytest.param(json_codec.BACKEND_ORJSON,
+                 marks=pytest.mark.skipif(json_codec.orjson is None, reason="orjson is not installed")),
+]
+
+
+@pytest.fixture(params=backends)
+def backend(request, monkeypatch):
+    monkeypatch.setattr(json_codec, "backend", request.param)
+    return request.param
+
+
+def test_output_is_stable(backend):
+    folder = Path("/var/incoming")
+    task = Task(
+        id="task-äöü",
+        info=TaskInfo(action="route", uid="1.2.3", uid_type="series", triggered_rules={"rule": True},
+                      mrn="12345", acc="A’B", mercure_version="0.0.0", mercure_appliance="master",
+                      mercure_server="server"),
+        dispatch=TaskDispatch(target_name=["target"], retries=0, next_retry_at=1.5),
+    )
+    task.to_file(folder / "task.json")
+    assert (folder / "task.json").read_text() == json.dumps(task.dict())
+    assert Task.from_file(folder / "task.json") == task
+
+    config = {"appliance_name": "master", "rules": {"catchall": {"rule": "True"}}, "port": 11112}
+    with open(folder / "mercure.json", "w") as json_file:
+        json_codec.dump(config, json_file, indent=4)
+    assert (folder / "mercure.json").read_text() == json.dumps(config, indent=4)
+    with open(folder / "mercure.json", "r") as json_file:
+        assert json_codec.load(json_file) == config
+
+
+def test_speculative_claim(backend):
+    folder = Path("/var/incoming")
+    claim = SpeculativeClaim(task_id="task", target_folder="/var/outgoing/task", applied_rule="rule_ä",
+                             triggered_rules={"rule_ä": True})
+    claim.to_file(folder / ".claim")
+    assert (folder / ".claim").read_text() == json.dumps(dataclasses.asdict(claim))
+    assert SpeculativeClaim.from_file(folder / ".claim") == claim
+
+
+def test_fallback_to_stdlib(backend):
+    folder = Path("/var/incoming")
+    assert json_codec.loads(b'{"value": 1.0}') == {"value": 1.0}
+    assert json_codec.loads('{"value": NaN}')["value"] != json_codec.loads('{"value": NaN}')["value"]
+    assert json_codec.loads('{"value": "\\ud800"}') == json.loads('{"value": "\\ud800"}')
+
+    # Tags files with invalid UTF-8 are read with errors="surrogateescape"
+    (folder / "series.tags").write_bytes(b'{"PatientName": "M\xfcller"}')
+    with open(folder / "series.tags", "r", encoding="utf-8", errors="surrogateescape") as json_file:
+        assert json_codec.load(json_file) == {"PatientName": "M\udcfcller"}
+
+    with pytest.raises(json.JSONDecodeError):
+        json_codec.loads('{"value": ')
+
+
+def test_set_backend(monkeypatch):
+    monkeypatch.setattr(json_codec, "backend", json_codec.backend)
+    json_codec.set_backend(json_codec.BACKEND_STDLIB)
+    assert json_codec.get_backend() == json_codec.BACKEND_STDLIB
+    with pytest.raises(ValueError):
+        json_codec.set_backend("simplejson")
+    monkeypatch.setattr(json_codec, "orjson", None)
+    with pytest.raises(ValueError):
+        json_codec.set_backend(json_codec.BACKEND_ORJSON)
@@ -86,9 +86,9 @@ def create_and_route(fs, mocked, task_id, config, uid="TESTFAKEUID") -> Tuple[Li
     routing.route_series.push_serieslevel_outgoing.assert_called_once_with(  # type: ignore
         task_id, {"catchall": True}, [f"{uid}#bar"], uid, unittest.mock.ANY, {})
 
-    assert ["task.json", f"{uid}#bar.dcm", f"{uid}#bar.tags"] == [
+    assert sorted(["task.json", f"{uid}#bar.dcm", f"{uid}#bar.tags"]) == sorted(
         k.name for k in Path("/var/processing").glob("**/*") if k.is_file()
-    ]
+    )
 
     # mocked.patch("process.processor.process_series", new=mocked.spy(processor, "process_series"))
     return ["task.json", f"{uid}#bar.dcm", f"{uid}#bar.tags"], new_task_id
@@ -108,9 +108,9 @@ def create_and_route_priority(fs, mocked, task_id, config, uid="TESTFAKEUID") ->
     for case in Path("/var/processing").iterdir():
         if not case.is_dir():
             continue
-        assert ["task.json", f"{uid}#bar.dcm", f"{uid}#bar.tags"] == [
+        assert sorted(["task.json", f"{uid}#bar.dcm", f"{uid}#bar.tags"]) == sorted(
             k.name for k in case.iterdir() if k.is_file()
-        ]
+        )
 
     created_tasks = [k.name for k in Path("/var/processing").iterdir() if k.is_dir()]
     assert set(created_tasks).issubset(set(new_task_ids))
@@ -168,7 +168,7 @@ async def test_process_series_nomad(fs, mercure_config: Callable[[Dict], Config]
     # processor.run_processor()
 
     assert (Path("/var/success") / processor_path.name).exists(), f"{processor_path.name} missing from success dir"
-    assert files == [k.name for k in (Path("/var/success") / processor_path.name).glob("*") if k.is_file()]
+    assert sorted(files) == sorted(k.name for k in (Path("/var/success") / processor_path.name).glob("*") if k.is_file())
     with open(Path("/var/success") / processor_path.name / "task.json") as t:
         task = json.load(t)
     assert task == {
@@ -217,9 +217,9 @@ async def test_process_series_nomad(fs, mercure_config: Callable[[Dict], Config]
     await processor.run_processor()
 
     assert (Path("/var/error") / processor_path.name).exists()
-    assert ["task.json", "FAILEDFAILED#bar.dcm", "FAILEDFAILED#bar.tags"] == [
+    assert sorted(["task.json", "FAILEDFAILED#bar.dcm", "FAILEDFAILED#bar.tags"]) == sorted(
         k.name for k in (Path("/var/error") / processor_path.name / "in").rglob("*") if k.is_file()
-    ]
+    )
     assert ["task.json"] == [
         k.name for k in (Path("/var/error") / processor_path.name / "out").rglob("*") if k.is_file()
     ]
@@ -293,7 +293,7 @@ async def test_process_series(fs, mercure_config: Callable[[Dict], Config], mock
     )
     print("FAKE RUN RESULT FILES", list((Path("/var/success")).glob("**/*")))
     assert [] == [k.name for k in Path("/var/processing").glob("**/*")]
-    assert files + ["result.json"] == [k.name for k in (Path("/var/success")).glob("**/*") if k.is_file()]
+    assert sorted(files + ["result.json"]) == sorted(k.name for k in (Path("/var/success")).glob("**/*") if k.is_file())
 
     common.monitor.send_task_event.assert_has_calls(  # type: ignore
         [
@@ -394,7 +394,8 @@ async def test_multi_process_series(fs, mercure_config: Callable[[Dict], Config]
         )
 
     assert [] == [k.name for k in Path("/var/processing").glob("**/*")]
-    assert [*files, 'result.json'] == [k.name for k in (Path("/var/success") / processor_path.name).glob("*") if k.is_file()]
+    success_folder = Path("/var/success") / processor_path.name
+    assert sorted([*files, 'result.json']) == sorted(k.name for k in success_folder.glob("*") if k.is_file())
 
     with open(Path("/var/success") / processor_path.name / "task.json") as t:
         task = json.load(t)
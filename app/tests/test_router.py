@@ -2,8 +2,11 @@
 test_router.py
 ==============
 """
+import asyncio
 import json
 import os
+import shutil
+import time
 import unittest
 import uuid
 from pathlib import Path
@@ -11,15 +14,33 @@ from typing import Tuple
 from unittest.mock import call
 
 import common
+import common.required_tags as required_tags
+import common.rule_evaluation as rule_evaluation
+import common.rule_index as rule_index
+import pytest
 import routing.generate_taskfile
+from common.constants import mercure_names
 from common.monitor import m_events, severity, task_event
+from common.tags_rule_interface import get_lowercase_index
 from common.types import Rule, Task, TaskStudy
 from dispatch import dispatcher
 from pyfakefs.fake_filesystem import FakeFilesystem
 from routing import router
+from routing.completion_estimator import MIN_SAMPLES, CompletionEstimator
+from routing import backpressure
+from routing.completion_scheduler import CompletionScheduler
+from routing.duplicate_filter import RecentInstances
+from routing.expected_instances import EXPECTED_MAX_AGE, ExpectedInstances, write_expected_instances
+from routing.incoming_watcher import IncomingEventHandler, SeriesIndex
+from routing.route_series import get_triggered_rules
+import routing.route_series as route_series_module
+from routing.routing_order import order_series
+from routing.sharding import RouterShard
 from subprocess import check_output
+from watchdog.events import DirCreatedEvent, DirDeletedEvent, FileClosedEvent, FileCreatedEvent, FileMovedEvent
 
-from .testing_common import generate_uid, mock_incoming_uid, mock_task_ids, process_dicom, fake_check_output
+from .testing_common import (create_minimal_dicom, generate_uid, mock_incoming_uid, mock_task_ids, process_dicom,
+                             fake_check_output)
 
 rules = {
     "rules": {
@@ -93,6 +114,10 @@ def test_route_series_fail2(fs: FakeFilesystem, mercure_config, mocked):
         "Invalid rule encountered:  1/0 ",
     )
     common.monitor.send_task_event.assert_any_call(task_event.DISCARD, task_id, 1, "", "Discard by default.")  # type: ignore
+    # The incoming folder is handed over by rename, which must be reported only once
+    move_events = [c for c in common.monitor.send_task_event.call_args_list  # type: ignore
+                   if c.args[0] == task_event.MOVE and c.args[1] == task_id]
+    assert move_events == [call(task_event.MOVE, task_id, 1, f"{config.discard_folder}/{task_id}", "Moved files")]
     common.monitor.send_task_event.reset_mock()  # type: ignore
 
 
@@ -111,6 +136,8 @@ def test_route_series_fail3(fs: FakeFilesystem, mercure_config, mocked):
             real_mkdir(dest)
 
     mocked.patch("os.mkdir", new=no_create_destination)
+    # Force moving the files individually instead of handing over the incoming folder
+    mocked.patch("routing.route_series.move_series_folder", return_value=False)
     router.run_router()
     common.monitor.send_task_event.assert_any_call(  # type: ignore
         task_event.ERROR,
@@ -145,6 +172,7 @@ def test_route_series_fail4(fs: FakeFilesystem, mercure_config, mocked):
 
     mocked.patch("shutil.move", side_effect=Exception("no moving"))
     mocked.patch("shutil.copy", side_effect=Exception("no copying"))
+    mocked.patch("routing.route_series.move_series_folder", return_value=False)
     router.run_router()
     common.monitor.send_task_event.assert_any_call(  # type: ignore
         task_event.ERROR,
@@ -282,9 +310,9 @@ def test_route_series_success(fs: FakeFilesystem, mercure_config, mocked, fake_p
     )
     out_path = next(Path("/var/outgoing").iterdir())
     try:
-        assert ["task.json", f"{series_uid}#bar.dcm", f"{series_uid}#bar.tags"] == [
+        assert sorted(["task.json", f"{series_uid}#bar.dcm", f"{series_uid}#bar.tags"]) == sorted(
             k.name for k in Path("/var/outgoing").glob("**/*") if k.is_file()
-        ]
+        )
     except AssertionError as k:
         message = f"Expected results are missing: {k.args[0]}"
         k.args = (message,)  # wrap it up in new tuple
@@ -307,6 +335,386 @@ def test_route_series_success(fs: FakeFilesystem, mercure_config, mocked, fake_p
     # common.monitor.send_event.assert_not_called()
 
 
+def test_route_series_folder_handover(fs: FakeFilesystem, mercure_config, mocked):
+    config = mercure_config(rules)
+    task_id = "test_task_" + str(uuid.uuid1())
+    series_uid = str(uuid.uuid4())
+    new_task_id = "new-task-" + str(uuid.uuid1())
+    mock_incoming_uid(config, fs, series_uid, {"SeriesDescription": "foo"})
+    mock_task_ids(mocked, task_id, new_task_id)
+
+    # A file without tags file (e.g., still being received) prevents handing over the incoming folder
+    fs.create_file(Path(config.incoming_folder) / series_uid / f"{series_uid}#late.dcm")
+    router.run_router()
+
+    out_path = Path(config.outgoing_folder) / new_task_id
+    assert sorted(k.name for k in out_path.iterdir()) == sorted(
+        ["task.json", f"{series_uid}#bar.dcm", f"{series_uid}#bar.tags"])
+    assert not (Path(config.incoming_folder) / series_uid).exists()
+
+    # Without the extra file, the incoming folder itself becomes the task folder and no lock file is left behind
+    task_id = "test_task_" + str(uuid.uuid1())
+    series_uid = str(uuid.uuid4())
+    new_task_id = "new-task-" + str(uuid.uuid1())
+    dcm_file, _ = mock_incoming_uid(config, fs, series_uid, {"SeriesDescription": "foo"})
+    inode = os.stat(dcm_file).st_ino
+    mock_task_ids(mocked, task_id, new_task_id)
+    mocked.patch("shutil.move", side_effect=Exception("no moving"))
+    router.run_router()
+
+    out_path = Path(config.outgoing_folder) / new_task_id
+    assert sorted(k.name for k in out_path.iterdir()) == sorted(
+        ["task.json", f"{series_uid}#bar.dcm", f"{series_uid}#bar.tags"])
+    assert os.stat(out_path / f"{series_uid}#bar.dcm").st_ino == inode
+    assert not (Path(config.incoming_folder) / series_uid).exists()
+    common.monitor.send_task_event.assert_any_call(  # type: ignore
+        task_event.MOVE, task_id, 1, str(out_path), "Moved files")
+
+
+def test_route_series_duplicates(fs: FakeFilesystem, mercure_config, mocked):
+    config = mercure_config({**rules, "router_duplicate_window": 3600})
+    mocked.patch("routing.duplicate_filter.recent_instances", RecentInstances())
+    series_uid = str(uuid.uuid4())
+    incoming = Path(config.incoming_folder)
+    create_minimal_dicom("/var/source/first.dcm", series_uid, {"SeriesDescription": "foo"})
+    create_minimal_dicom("/var/source/second.dcm", series_uid, {"SeriesDescription": "foo"})
+
+    def receive(name: str) -> None:
+        shutil.copy(f"/var/source/{name}.dcm", incoming / f"{name}.dcm")
+        process_dicom(str(incoming / f"{name}.dcm"), "0.0.0.0", "mercure", "mercure")
+
+    receive("first")
+    router.run_router()
+    assert len(list(Path(config.outgoing_folder).iterdir())) == 1
+
+    # The modality sends the series again, together with an instance that has not been received before
+    task_id = "test_task_" + str(uuid.uuid1())
+    new_task_id = "new-task-" + str(uuid.uuid1())
+    receive("first")
+    receive("second")
+    mock_task_ids(mocked, task_id, new_task_id)
+    router.run_router()
+
+    out_path = Path(config.outgoing_folder) / new_task_id
+    assert sorted(k.name for k in out_path.iterdir()) == sorted(
+        ["task.json", f"{series_uid}#second.dcm", f"{series_uid}#second.tags"])
+    common.monitor.send_task_event.assert_any_call(  # type: ignore
+        task_event.REMOVE, task_id, 1, "", "Removed duplicate instances")
+
+    # A series that only consists of duplicates is removed without creating a task
+    receive("second")
+    router.run_router()
+    assert len(list(Path(config.outgoing_folder).iterdir())) == 2
+    assert list(incoming.iterdir()) == []
+
+
+def test_route_series_duplicates_failed(fs: FakeFilesystem, mercure_config, mocked):
+    config = mercure_config({**rules, "router_duplicate_window": 3600})
+    mocked.patch("routing.duplicate_filter.recent_instances", RecentInstances())
+    series_uid = str(uuid.uuid4())
+    incoming = Path(config.incoming_folder)
+    create_minimal_dicom("/var/source/first.dcm", series_uid, {"SeriesDescription": "foo"})
+
+    def receive(name: str) -> None:
+        shutil.copy(f"/var/source/{name}.dcm", incoming / f"{name}.dcm")
+        process_dicom(str(incoming / f"{name}.dcm"), "0.0.0.0", "mercure", "mercure")
+
+    # Routing fails, so the instance must not be remembered as routed
+    real_mkdir = os.mkdir
+
+    def no_create_destination(dest, *args, **kwargs):
+        if config.outgoing_folder in str(dest):
+            raise Exception("no")
+        real_mkdir(dest, *args, **kwargs)
+
+    receive("first")
+    mkdir_mock = mocked.patch("os.mkdir", new=no_create_destination)
+    mocked.patch("routing.route_series.move_series_folder", return_value=False)
+    router.run_router()
+    assert list(Path(config.outgoing_folder).iterdir()) == []
+    mocked.stop(mkdir_mock)
+
+    # The re-sent instance is routed
+    task_id = "test_task_" + str(uuid.uuid1())
+    new_task_id = "new-task-" + str(uuid.uuid1())
+    receive("first")
+    mock_task_ids(mocked, task_id, new_task_id)
+    router.run_router()
+    out_path = Path(config.outgoing_folder) / new_task_id
+    assert sorted(k.name for k in out_path.iterdir()) == sorted(
+        ["task.json", f"{series_uid}#first.dcm", f"{series_uid}#first.tags"])
+
+
+def test_route_series_backpressure(fs: FakeFilesystem, mercure_config, mocked):
+    config = mercure_config({
+        "rules": {
+            **rules["rules"],
+            "stroke": Rule(rule="@SeriesDescription@ == 'stroke'", target="test_target", priority="urgent").dict(),
+        },
+        "router_backpressure": {"outgoing": {"high_tasks": 2, "low_tasks": 1}},
+    })
+    mocked.patch("routing.backpressure.queues", {queue: backpressure.QueueState() for queue in backpressure.queues})
+    outgoing = Path(config.outgoing_folder)
+    for i in range(2):
+        (outgoing / f"pending_{i}").mkdir()
+    routine_uid = str(uuid.uuid4())
+    mock_incoming_uid(config, fs, routine_uid, {"SeriesDescription": "foo"}, "routine")
+    mock_incoming_uid(config, fs, str(uuid.uuid4()), {"SeriesDescription": "stroke"}, "stroke")
+
+    # The outgoing queue is full, so only the urgent series is routed
+    router.run_router()
+    assert len(list(outgoing.iterdir())) == 3
+    assert [p.name for p in Path(config.incoming_folder).iterdir()] == [routine_uid]
+
+    # Routing is only resumed once the queue has dropped to the low watermark
+    (outgoing / "pending_0").rmdir()
+    router.run_router()
+    assert [p.name for p in Path(config.incoming_folder).iterdir()] == [routine_uid]
+    (outgoing / "pending_1").rmdir()
+    router.run_router()
+    assert list(Path(config.incoming_folder).iterdir()) == []
+    assert len(list(outgoing.iterdir())) == 2
+
+
+def test_route_series_backpressure_study(fs: FakeFilesystem, mercure_config, mocked):
+    config = mercure_config({**rules, "router_backpressure": {"outgoing": {"high_tasks": 1, "low_tasks": 0}}})
+    mocked.patch("routing.backpressure.queues", {queue: backpressure.QueueState() for queue in backpressure.queues})
+    route_studies = mocked.patch("routing.router.route_studies")
+    (Path(config.outgoing_folder) / "pending").mkdir()
+    study_uid = generate_uid()
+    series_uid = str(uuid.uuid4())
+    # The series triggers a study-level and a series-level rule, and the series-level rule adds to the full queue
+    mock_incoming_uid(config, fs, series_uid,
+                      {"StudyInstanceUID": study_uid, "StudyDescription": "foo", "SeriesDescription": "foo"})
+    mercure_config({**rules, "router_backpressure": {"outgoing": {"high_tasks": 1, "low_tasks": 0}},
+                    "series_complete_trigger": -60})
+
+    # The deferred series has not been added to the study folder yet, so the study must keep waiting for it
+    router.run_router()
+    assert [p.name for p in Path(config.incoming_folder).iterdir()] == [series_uid]
+    assert series_uid in router.series_index.completion.complete
+    route_studies.assert_called_once_with({study_uid})
+
+
+def test_compiled_rules(fs: FakeFilesystem, mercure_config):
+    mercure_config()
+    tags = {"SeriesDescription": "Foo", "SeriesNumber": "3"}
+    test_rules = ['@SeriesDescription@ == "Foo"', '"oo" in tags.SeriesDescription and int(@SeriesNumber@) > 2',
+                  'tags.Missing == "x"', 'x = 1', '1 +', 'open("x")', 'sqrt(4) == 2']
+    # The compiled rules give the same results (and errors) as a fresh interpreter, also when evaluated repeatedly
+    for rule in test_rules:
+        try:
+            expected = rule_evaluation._eval_safe(rule_evaluation.replace_tags(rule, tags), rule_evaluation.Tags(tags))
+        except Exception as e:
+            expected = type(e)
+        for _ in range(2):
+            try:
+                result, _ = rule_evaluation.eval_rule(rule, tags)
+            except Exception as e:
+                result = type(e)
+            assert result == expected, rule
+    with pytest.raises(rule_evaluation.TagNotFoundException):
+        rule_evaluation.eval_rule('@Missing@ == "x"', tags)
+
+    # Rules are compiled once and the cache is cleared when a new configuration is loaded
+    compiled = rule_evaluation.get_compiled_rule(test_rules[0], tags)
+    assert rule_evaluation.get_compiled_rule(test_rules[0], tags) is compiled
+    common.config.configuration_timestamp += 1
+    assert rule_evaluation.get_compiled_rule(test_rules[0], tags) is not compiled
+
+
+def test_compile_rules_on_load(fs: FakeFilesystem, mercure_config, mocker):
+    mercure_config({
+        "rules": {
+            "valid": Rule(rule='@Modality@ == "CT"', target="test_target").dict(),
+            "unknown": Rule(rule='lower(@Modality@) == "ct"', target="test_target").dict(),
+            "syntax": Rule(rule='@Modality@ ==', target="test_target").dict(),
+            "disabled": Rule(rule='open("x")', target="test_target", disabled=True).dict(),
+        }
+    })
+    error = mocker.patch.object(common.config.logger, "error")
+    mocker.patch.object(common.config, "configuration_timestamp", 0)
+    common.config.read_config()
+    # Invalid rules are reported when the configuration is loaded, not when the first series arrives
+    assert sorted(c.args[0] for c in error.call_args_list) == [
+        "Invalid rule syntax: Invalid syntax: invalid syntax", "Invalid rule unknown: Unknown names: lower"]
+
+    # The rules have been compiled already, so they are not parsed again
+    parse = mocker.spy(rule_evaluation.Interpreter, "parse")
+    assert rule_evaluation.eval_rule('@Modality@ == "CT"', {"Modality": "CT"})[0]
+    parse.assert_not_called()
+
+
+def test_tags_lowercase_index():
+    tags_dict = {"SeriesDescription": "foo", "seriesdescription": "bar"}
+    tags = rule_evaluation.Tags(tags_dict)
+    assert tags.SERIESDESCRIPTION == "foo"
+    assert tags.seriesdescription == "bar"
+    assert tags.tags_accessed() == {"SeriesDescription", "seriesdescription"}
+    with pytest.raises(rule_evaluation.TagNotFoundException):
+        tags.Missing
+    # The index is shared by all Tags objects of the same dictionary, until tags are added to the dictionary
+    index = get_lowercase_index(tags_dict)
+    assert rule_evaluation.Tags(tags_dict).seriesDescription == "foo"
+    assert get_lowercase_index(tags_dict) is index
+    tags_dict["Missing"] = "x"
+    assert rule_evaluation.Tags(tags_dict).missing == "x"
+
+
+def test_required_tags(fs: FakeFilesystem, mercure_config, mocker):
+    config = mercure_config({
+        "rules": {
+            "orientation": Rule(rule="@Modality@ == 'MR' and tags.patientorientation == 'L'", target="test_target",
+                                notification_payload_body="{{ acc }} {{ DeviceSerialNumber }}").dict(),
+            "typo": Rule(rule="'HEAD' in @StudyDescripton@", target="test_target").dict(),
+            "study": Rule(rule="tags['ContrastBolusRoute'] == 'IV'", target="test_target",
+                          action_trigger="study").dict(),
+            "disabled": Rule(rule="@PatientWeight@ == '80'", target="test_target", disabled=True).dict(),
+            "sequence": Rule(rule="tags.ReferencedImageSequence != ''", target="test_target").dict(),
+        },
+        "dicom_receiver": {"additional_tags": {"ContrastBolusRoute": "IV"}},
+    })
+    result = required_tags.analyze_config(config)
+    assert result.tags["AccessionNumber"] == {"orientation"}
+    assert result.tags["SeriesDescription"] == {"study"}
+    assert "PatientWeight" not in result.tags
+    # Only tags that are not extracted anyway are added for the receiver
+    assert result.receiver_tags == ["PatientOrientation"]
+    # Misspelled tags and sequences cannot be read by getdcmtags
+    assert result.unavailable == {"StudyDescripton": {"typo"}, "ReferencedImageSequence": {"sequence"}}
+    # The receiver's tag list is updated when the configuration is saved
+    with open(common.config.configuration_filename) as json_file:
+        assert json.load(json_file)["dicom_receiver"]["rule_tags"] == ["PatientOrientation"]
+
+    # The router reports every tag only once, also if the configuration is loaded again
+    warning = mocker.patch.object(router.logger, "warning")
+    mocker.patch.object(router, "reported_tags", set())
+    mocker.patch.object(common.config, "mercure", config)
+    for timestamp in (1, 2):
+        mocker.patch.object(common.config, "configuration_timestamp", timestamp)
+        router.check_required_tags()
+    assert sorted(c.args[0].split()[1] for c in warning.call_args_list) == ["ReferencedImageSequence", "StudyDescripton"]
+
+
+def test_required_tags_missing_dictionary(fs: FakeFilesystem, mocker):
+    mocker.patch.object(required_tags, "_dictionary", None)
+    mocker.patch.object(common.config, "app_basepath", Path("/nonexistent"))
+    read_dictionary = mocker.spy(required_tags, "read_dictionary")
+    warning = mocker.patch.object(required_tags.logger, "warning")
+    # A missing dictionary is reported and read only once
+    for _ in range(3):
+        assert required_tags.get_dictionary() == {}
+    assert read_dictionary.call_count == 1
+    assert warning.call_count == 1
+
+
+def test_rule_index(fs: FakeFilesystem, mercure_config, mocked):
+    assert rule_index.extract_predicates("@Modality@ == 'MR' and tags.bodypart in ('HEAD', 'BRAIN') and 1/0") == [
+        rule_index.TagPredicate("Modality", False, frozenset(["MR"])),
+        rule_index.TagPredicate("bodypart", True, frozenset(["HEAD", "BRAIN"])),
+    ]
+    # Only leading conditions of a conjunction are used
+    assert rule_index.extract_predicates("'x' in @SeriesDescription@ and @Modality@ == 'MR'") == []
+    assert rule_index.extract_predicates("@Modality@ == 'MR' or @Modality@ == 'CT'") == []
+    assert rule_index.extract_predicates("@Modality@ ==") == []
+
+    rules_config = mercure_config({
+        "rules": {
+            "head": Rule(rule="@Modality@ == 'MR' and tags.bodypart in ('HEAD', 'BRAIN')", target="test_target").dict(),
+            "ct": Rule(rule="tags.modality == 'CT'", target="test_target").dict(),
+            "reports": Rule(rule="'SR' == @Modality@", action="discard").dict(),
+            "contains": Rule(rule="'foo' in @SeriesDescription@", target="test_target").dict(),
+            "other": Rule(rule="@Modality@ == 'OT'", target="test_target", fallback=True).dict(),
+        }
+    })
+    test_cases = [
+        ({"Modality": "MR", "BodyPart": "HEAD", "SeriesDescription": "foo"}, ["head", "contains"]),
+        ({"Modality": "MR", "BodyPart": "KNEE", "SeriesDescription": "bar"}, []),
+        ({"Modality": "CT", "SeriesDescription": "bar"}, ["ct"]),
+        ({"Modality": "SR", "SeriesDescription": "foo"}, ["reports"]),
+        ({"Modality": "OT", "SeriesDescription": "bar"}, ["other"]),
+        ({"SeriesDescription": "bar"}, []),
+    ]
+    # The index gives the same results as the evaluation of all rules
+    with unittest.mock.patch.object(rule_index.rule_index, "get_candidates", return_value=set(rules_config.rules)):
+        for tags, expected in test_cases:
+            assert list(get_triggered_rules(None, tags)[0]) == expected, tags
+
+    mocked.patch.object(rule_index.rule_index, "evaluated", 0)
+    mocked.patch.object(rule_index.rule_index, "skipped", 0)
+    for tags, expected in test_cases:
+        assert list(get_triggered_rules(None, tags)[0]) == expected, tags
+    # The contains rule is evaluated for every series (unless a discard rule has triggered before), the other rules
+    # only if their tag conditions are met
+    assert rule_index.rule_index.evaluated == 9
+    assert rule_index.rule_index.skipped == 17
+
+
+def test_evaluate_batch(fs: FakeFilesystem):
+    rules = {
+        "mr": Rule(rule="@Modality@ == 'MR'", target="test_target"),
+        "head": Rule(rule="tags.Modality == 'CT' and 'HEAD' in @StudyDescription@", target="test_target"),
+        "broken": Rule(rule="@Modality@ == 'CT' and 1/0", target="test_target"),
+        "other": Rule(rule="True", target="test_target", fallback=True),
+    }
+    baseline_rules = {
+        "mr": Rule(rule="@Modality@ in ('MR', 'CT')", target="test_target"),
+        "other": Rule(rule="True", target="test_target", fallback=True),
+    }
+    for i, (modality, description) in enumerate([("MR", "HEAD"), ("CT", "HEAD"), ("CT", "KNEE"), ("OT", "")]):
+        series_uid = f"series_{i}"
+        tags = {"SeriesInstanceUID": series_uid, "Modality": modality, "StudyDescription": description}
+        for instance in range(2):
+            fs.create_file(f"/var/incoming/{series_uid}/{series_uid}#{instance}.tags", contents=json.dumps(tags))
+    tag_sets = sorted(rule_evaluation.read_series_tags("/var/incoming"), key=lambda tags: tags["SeriesInstanceUID"])
+    assert [tags["SeriesInstanceUID"] for tags in tag_sets] == ["series_0", "series_1", "series_2", "series_3"]
+
+    for chunk_size in (1, 3):
+        result = rule_evaluation.evaluate_batch(rules, tag_sets, baseline_rules, chunk_size=chunk_size, max_diffs=1)
+        assert result.series == 4
+        assert result.hits == {"mr": 1, "head": 1, "other": 2}
+        assert result.errors == {"broken": 2}
+        assert result.baseline_hits == {"mr": 3, "other": 1}
+        assert result.changed == 2
+        assert [(diff.before, diff.after) for diff in result.diffs] == [(["mr"], ["head"])]
+
+
+def test_evaluate_rule_change(fs: FakeFilesystem, mercure_config, mocker):
+    from bookkeeping.query import get_series_tags
+    from webinterface.rules import evaluate_rule_change
+
+    mercure_config({
+        "rules": {
+            "ct": Rule(rule="@Modality@ == 'CT'", target="test_target").dict(),
+            "other": Rule(rule="True", target="test_target", fallback=True).dict(),
+        }
+    })
+    rows = [
+        {"id": i, "series_uid": f"series_{i}", "study_uid": "study", "tag_modality": modality,
+         "tag_studydescription": description, "tag_protocolname": None}
+        for i, (modality, description) in enumerate([("CT", "HEAD"), ("CT", "KNEE"), ("MR", "HEAD")])
+    ]
+    # The series stored by the bookkeeper are converted into the tags used by the routing rules
+    tag_sets = [get_series_tags(row) for row in rows]
+    assert tag_sets[0] == {"SeriesInstanceUID": "series_0", "StudyInstanceUID": "study", "Modality": "CT",
+                           "StudyDescription": "HEAD"}
+
+    get = mocker.patch("common.monitor.get", new=mocker.AsyncMock(return_value=tag_sets))
+    # Use a separate event loop, as the event loop of the other tests must not be closed
+    loop = asyncio.new_event_loop()
+    try:
+        result = loop.run_until_complete(
+            evaluate_rule_change("ct", "@Modality@ == 'CT' and 'HEAD' in @StudyDescription@", 100))
+    finally:
+        loop.close()
+    get.assert_called_once_with("query/series_tags", {"limit": 100})
+    assert result.series == 3
+    assert result.hits == {"ct": 1, "other": 2}
+    assert result.baseline_hits == {"ct": 2, "other": 1}
+    assert result.changed == 1
+    assert [(diff.series, diff.before, diff.after) for diff in result.diffs] == [("series_1", ["ct"], ["other"])]
+
+
 def test_route_series_new_rule(fs: FakeFilesystem, mercure_config, mocked, fake_process):
     config = mercure_config(rules)
     # attach_spies(mocker)
@@ -463,3 +871,453 @@ def test_route_series_multiple_rules(fs: FakeFilesystem, mercure_config, mocked,
 
     for path in Path(config.outgoing_folder).iterdir():
         assert (path / Path(dcm_file).name).exists()
+
+
+def test_series_index_events(fs: FakeFilesystem, mercure_config):
+    config = mercure_config()
+    incoming = Path(config.incoming_folder)
+    index = SeriesIndex()
+    handler = IncomingEventHandler(config.incoming_folder, index)
+
+    series_uid = "1.2.3.4"
+    fs.create_dir(incoming / series_uid)
+    fs.create_file(incoming / series_uid / f"{series_uid}#bar.dcm")
+    handler.on_created(DirCreatedEvent(str(incoming / series_uid)))
+    handler.on_moved(FileMovedEvent(str(incoming / "bar"), str(incoming / series_uid / f"{series_uid}#bar.dcm")))
+    handler.on_closed(FileClosedEvent(str(incoming / series_uid / f"{series_uid}#bar.tags")))
+    # Lock files created by the router should not count as changes
+    handler.on_created(FileCreatedEvent(str(incoming / "other" / mercure_names.LOCK)))
+    index.apply_changes(config.incoming_folder)
+    assert list(index.series.keys()) == [series_uid]
+    assert index.series[series_uid].modification_time == (incoming / series_uid).stat().st_mtime
+    assert not index.error_files_found
+
+    handler.on_created(FileCreatedEvent(str(incoming / "error" / "baz.error")))
+    index.apply_changes(config.incoming_folder)
+    assert index.error_files_found
+
+    handler.on_deleted(DirDeletedEvent(str(incoming / series_uid)))
+    index.apply_changes(config.incoming_folder)
+    assert index.series == {}
+
+
+def test_series_index_studies(fs: FakeFilesystem, mercure_config, mocked):
+    config = mercure_config()
+    index = SeriesIndex()
+    study_uid = str(uuid.uuid4())
+    series_uid = str(uuid.uuid4())
+    mock_incoming_uid(config, fs, series_uid, {"StudyInstanceUID": study_uid})
+    no_tags = Path(config.incoming_folder) / "no_tags"
+    fs.create_dir(no_tags)
+    index.rescan(config.incoming_folder)
+    # A series without tags file does not hold back the other studies
+    assert index.get_pending_studies([series_uid, "no_tags"]) == {study_uid}
+
+    # The study is only read once from the tags files. A folder without tags file is searched again after it changed
+    read_tags = mocked.patch("routing.incoming_watcher.read_first_tags", return_value=None)
+    assert index.get_pending_studies([series_uid, "no_tags"]) == {study_uid}
+    read_tags.assert_not_called()
+    os.utime(no_tags, (time.time() + 10, time.time() + 10))
+    assert index.get_pending_studies([series_uid, "no_tags"]) == {study_uid}
+    read_tags.assert_called_once_with("no_tags")
+    index.remove(series_uid)
+    index.remove("no_tags")
+    assert index.study_uids == {}
+    assert index.unknown_studies == {}
+
+
+def test_route_series_with_watcher(fs: FakeFilesystem, mercure_config, mocked):
+    config = mercure_config({**rules, "router_watch_incoming": True})
+
+    class FakeObserver:
+        handler = None
+
+        def schedule(self, handler, path, recursive=False):
+            FakeObserver.handler = handler
+
+        def start(self):
+            pass
+
+        def stop(self):
+            pass
+
+        def join(self, timeout=None):
+            pass
+
+        def is_alive(self):
+            return True
+
+    mocked.patch("routing.incoming_watcher.InotifyObserver", new=FakeObserver)
+    try:
+        # Series received before the watcher was started are found by the initial scan
+        task_id, series_uid = create_series(mocked, fs, config, {"SeriesDescription": "foo"})
+        router.run_router()
+        router.route_series.assert_called_once_with(task_id, series_uid)  # type: ignore
+        assert FakeObserver.handler is not None
+        assert len(list(Path(config.outgoing_folder).iterdir())) == 1
+
+        # Series received afterwards are only picked up from the reported events
+        task_id, series_uid = create_series(mocked, fs, config, {"SeriesDescription": "foo"})
+        router.run_router()
+        router.route_series.assert_called_once()  # type: ignore
+        FakeObserver.handler.on_created(DirCreatedEvent(str(Path(config.incoming_folder) / series_uid)))
+        router.run_router()
+        router.route_series.assert_called_with(task_id, series_uid)  # type: ignore
+        assert len(list(Path(config.outgoing_folder).iterdir())) == 2
+        assert router.series_index.series == {}
+    finally:
+        router.stop_incoming_watcher()
+
+
+def test_completion_scheduler():
+    scheduler = CompletionScheduler()
+    scheduler.set_trigger(60)
+    scheduler.schedule("a", 1000)
+    scheduler.schedule("b", 1010)
+    scheduler.schedule("c", 1020)
+
+    assert scheduler.update(1059) == set()
+    assert scheduler.pending == {"a": 1000, "b": 1010, "c": 1020}
+    assert scheduler.update(1061) == {"a"}
+    assert scheduler.complete == {"a"}
+    assert scheduler.pending == {"b": 1010, "c": 1020}
+
+    # New instances arrived for series b, so its old deadline is skipped
+    scheduler.schedule("b", 1030)
+    assert scheduler.update(1075) == set()
+    scheduler.discard("c")
+    assert scheduler.update(1085) == set()
+    assert scheduler.update(1091) == {"b"}
+    assert scheduler.complete == {"a", "b"}
+    assert scheduler.pending == {}
+
+    # Changing the trigger recalculates the deadlines of the pending series
+    scheduler.schedule("d", 2000)
+    scheduler.set_trigger(10)
+    assert scheduler.update(2011) == {"d"}
+
+
+def test_completion_estimator(fs: FakeFilesystem):
+    for series_uid, sender in [("ct", "CT_SCANNER"), ("ct2", "CT_SCANNER"), ("pacs", "PACS.FORWARDER")]:
+        fs.create_file(f"/var/incoming/{series_uid}/{series_uid}#1.tags",
+                       contents=json.dumps({"SenderAET": sender, "Modality": "CT"}))
+    estimator = CompletionEstimator()
+    estimator.configure(True, 90, 5, "/var/incoming")
+    scheduler = CompletionScheduler(estimator)
+    scheduler.set_trigger(60)
+
+    # Not enough observations yet, so the configured trigger is used
+    scheduler.schedule("ct", 1000)
+    scheduler.schedule("pacs", 1000)
+    assert scheduler.update(1059) == set()
+
+    # The scanner sends instances every 2 seconds (with a few longer gaps), the PACS only every 40 seconds
+    arrival = 1000
+    for i in range(1, MIN_SAMPLES + 1):
+        arrival += 8 if i % 5 == 0 else 2
+        scheduler.schedule("ct", arrival)
+        scheduler.schedule("pacs", 1000 + 40 * i)
+    assert estimator.get_estimates() == {("CT_SCANNER", "CT"): 8, ("PACS.FORWARDER", "CT"): 40}
+
+    # New series from the scanner are completed after the learned trigger, the PACS series is still pending
+    scheduler.schedule("ct2", 1801)
+    assert scheduler.update(1810) == {"ct", "ct2"}
+    assert "pacs" in scheduler.pending
+    assert scheduler.saved_time == 2 * (60 - 8)
+
+    # The learned trigger never exceeds the configured trigger
+    scheduler.set_trigger(30)
+    assert scheduler.update(1831) == {"pacs"}
+
+
+def test_expected_instances(fs: FakeFilesystem):
+    # ImagesInAcquisition only counts the instances of one acquisition, so it is not used as expected number
+    fs.create_file("/var/incoming/acq/acq#1.tags", contents=json.dumps({"ImagesInAcquisition": "1"}))
+    fs.create_file("/var/incoming/other/other#1.tags", contents=json.dumps({"SeriesDescription": "foo"}))
+    fs.create_dir("/var/incoming/retrieved")
+    write_expected_instances("/var/incoming", "retrieved", 1)
+    counter = ExpectedInstances()
+    counter.configure(True, "/var/incoming")
+    scheduler = CompletionScheduler(counter=counter)
+    scheduler.set_trigger(60)
+
+    # No tags file has been written yet for the retrieved series, but its expected count is known already
+    scheduler.schedule("acq", 1000)
+    scheduler.schedule("other", 1000)
+    scheduler.schedule("retrieved", 1000)
+    assert scheduler.update(1002) == set()
+
+    # Once the expected number of instances has arrived, the series is completed without waiting for the trigger
+    fs.create_file("/var/incoming/retrieved/retrieved#1.tags", contents="{}")
+    scheduler.schedule("retrieved", 1010)
+    assert scheduler.update(1012) == {"retrieved"}
+
+    # Series without expected count are completed by the trigger
+    assert scheduler.update(1061) == {"acq", "other"}
+
+    scheduler.discard("retrieved")
+    assert not Path("/var/incoming/retrieved" + mercure_names.EXPECTED).exists()
+
+    # Expected numbers of series that never arrive are removed after EXPECTED_MAX_AGE
+    write_expected_instances("/var/incoming", "never", 3)
+    write_expected_instances("/var/incoming", "acq", 2)
+    written = Path("/var/incoming/never" + mercure_names.EXPECTED).stat().st_mtime
+    counter.prune(written + 10)
+    assert Path("/var/incoming/never" + mercure_names.EXPECTED).exists()
+    counter.prune(written + EXPECTED_MAX_AGE + 1)
+    assert not Path("/var/incoming/never" + mercure_names.EXPECTED).exists()
+    # The series folder exists, so the series is still being received
+    assert Path("/var/incoming/acq" + mercure_names.EXPECTED).exists()
+
+
+def test_expected_instances_events(fs: FakeFilesystem, mercure_config):
+    config = mercure_config({"router_count_completion": True})
+    incoming = Path(config.incoming_folder)
+    index = SeriesIndex()
+    index.counter.configure(True, config.incoming_folder)
+    index.counter.counting = True
+    index.completion.set_trigger(60)
+    handler = IncomingEventHandler(config.incoming_folder, index)
+    write_expected_instances(config.incoming_folder, "series", 3)
+    fs.create_file(incoming / "series" / "series#1.tags", contents="{}")
+    fs.create_file(incoming / "series" / "series#1.dcm")
+    handler.on_created(DirCreatedEvent(str(incoming / "series")))
+    handler.on_closed(FileClosedEvent(str(incoming / "series" / "series#1.tags")))
+    index.apply_changes(config.incoming_folder)
+    assert index.completion.update(time.time() + 2) == set()
+
+    # The folder is only listed once, afterwards the instances are counted from the events (also if reported twice)
+    scandir = unittest.mock.patch("routing.expected_instances.os.scandir", side_effect=AssertionError)
+    scandir.start()
+    try:
+        for name in ("series#2.tags", "series#2.tags", "series#3.dcm"):
+            handler.on_created(FileCreatedEvent(str(incoming / "series" / name)))
+        index.apply_changes(config.incoming_folder)
+        assert index.completion.update(time.time() + 2) == set()
+        handler.on_closed(FileClosedEvent(str(incoming / "series" / "series#3.tags")))
+        # The fake file system does not update the modification time of a folder when files are added
+        os.utime(incoming / "series", (time.time() + 1, time.time() + 1))
+        index.apply_changes(config.incoming_folder)
+    finally:
+        scandir.stop()
+    assert index.completion.update(time.time() + 2) == {"series"}
+
+
+def test_routing_order(fs: FakeFilesystem, mercure_config):
+    mercure_config({
+        "rules": {
+            "stroke": Rule(rule="@SeriesDescription@ == 'stroke'", target="test_target", priority="urgent").dict(),
+            "research": Rule(rule="@SeriesDescription@ == 'research'", target="test_target", priority="offpeak").dict(),
+            "routine": Rule(rule="@SeriesDescription@ == 'routine'", target="test_target").dict(),
+        }
+    })
+    received = [
+        ("pacs_1", "PACS", "routine"), ("pacs_2", "PACS", "routine"), ("pacs_3", "PACS", "research"),
+        ("pacs_4", "PACS", "routine"), ("ct_1", "CT", "routine"), ("ct_2", "CT", "stroke"), ("mr_1", "MR", "routine"),
+    ]
+    series = {}
+    for i, (series_uid, sender, description) in enumerate(received):
+        fs.create_file(f"/var/incoming/{series_uid}/{series_uid}#1.tags",
+                       contents=json.dumps({"SenderAET": sender, "SeriesDescription": description}))
+        series[series_uid] = router.SeriesItem(1000 + i)
+
+    # The urgent series goes first, the offpeak series last, and the senders take turns in between
+    assert order_series(series.keys(), series) == ["ct_2", "pacs_1", "ct_1", "mr_1", "pacs_2", "pacs_4", "pacs_3"]
+
+
+def test_route_series_classified_rules(fs: FakeFilesystem, mercure_config, mocked):
+    config = mercure_config({
+        "rules": {
+            **rules["rules"],
+            "stroke": Rule(rule="@SeriesDescription@ == 'stroke'", target="test_target", priority="urgent").dict(),
+        },
+    })
+    series_uid = str(uuid.uuid4())
+    mock_incoming_uid(config, fs, series_uid, {"SeriesDescription": "stroke"})
+    parse_rule = mocked.spy(rule_evaluation, "parse_rule")
+
+    # The rules are evaluated silently once to determine the priority, and route_series reuses the result
+    router.run_router()
+    parse_rule.assert_not_called()
+    assert list(Path(config.incoming_folder).iterdir()) == []
+    task_folder = next(Path(config.outgoing_folder).iterdir())
+    with open(task_folder / "task.json") as task_file:
+        assert Task(**json.load(task_file)).info.triggered_rules == {"stroke": True}
+    assert route_series_module.classified_rules == {}
+
+
+def test_router_sharding(fs: FakeFilesystem):
+    series_uids = [f"1.2.3.{i}" for i in range(20)]
+    for series_uid in series_uids:
+        fs.create_dir(f"/var/incoming/{series_uid}")
+    shards = [RouterShard(0, 2), RouterShard(1, 2)]
+    owned = [{uid for uid in series_uids if shard.owns(uid)} for shard in shards]
+    assert owned[0] and owned[1]
+    assert owned[0] | owned[1] == set(series_uids) and not owned[0] & owned[1]
+
+    index = SeriesIndex()
+    index.is_owned = shards[0].owns
+    index.completion.set_trigger(60)
+    index.rescan("/var/incoming")
+    # All series count as pending (e.g., for the study completion), but only the own shard is scheduled
+    assert set(index.completion.pending) == set(series_uids)
+    assert {uid for uid in series_uids if index.completion.is_scheduled(uid)} == owned[0]
+
+    # Both instances are alive
+    now = time.time()
+    assert not shards[1].heartbeat("/var/incoming", 60, now)
+    assert not shards[0].heartbeat("/var/incoming", 60, now)
+
+    # Instance 1 stops, so instance 0 takes over its series
+    assert shards[0].heartbeat("/var/incoming", 60, now + 61)
+    assert shards[0].alive == {0}
+    index.reassign("/var/incoming")
+    assert all(index.completion.is_scheduled(uid) for uid in series_uids)
+
+    # Instance 1 is back
+    os.utime("/var/incoming/.router-1", (now + 62, now + 62))
+    assert shards[0].heartbeat("/var/incoming", 60, now + 62)
+    index.reassign("/var/incoming")
+    assert {uid for uid in series_uids if index.completion.is_scheduled(uid)} == owned[0]
+
+    # The studies are only routed by the live instance with the lowest index
+    assert shards[0].routes_studies() and not shards[1].routes_studies()
+    assert shards[1].heartbeat("/var/incoming", 60, now + 130)
+    assert shards[1].alive == {1}
+    assert shards[1].routes_studies()
+
+
+def test_route_series_parallel(fs: FakeFilesystem, mercure_config, mocked):
+    config = mercure_config({**rules, "router_workers": 3})
+    study_uid = generate_uid()
+    for i in range(3):
+        mock_incoming_uid(config, fs, generate_uid(), {"SeriesDescription": "foo"}, f"series_{i}")
+    for i in range(2):
+        mock_incoming_uid(config, fs, generate_uid(),
+                          {"StudyInstanceUID": study_uid, "StudyDescription": "foo", "SeriesDescription": f"s{i}"},
+                          f"study_{i}")
+    try:
+        router.run_router()
+    finally:
+        router.stop_routing_pool()
+
+    assert router.route_series.call_count == 5  # type: ignore
+    assert list(Path(config.incoming_folder).iterdir()) == []
+    assert router.series_index.series == {}
+    # Three series-level tasks and one study-level task containing both series of the study
+    out_folders = list(Path(config.outgoing_folder).iterdir())
+    assert len(out_folders) == 4
+    assert sorted(len(list(folder.glob("*.dcm"))) for folder in out_folders) == [1, 1, 1, 2]
+
+
+def test_route_series_multiple_rules_linked(fs: FakeFilesystem, mercure_config, mocked):
+    config = mercure_config({
+        "rules": {
+            "rule1": Rule(rule="@SeriesDescription@ == 'Test'", target="test_target", action="route").dict(),
+            "rule2": Rule(rule="@Modality@ == 'CT'", target="test_target_2", action="route").dict()
+        },
+        "router_fanout_mode": "link",
+    })
+    # Copy-on-write clones are not available in the fake filesystem
+    mocked.patch("routing.route_series.clone_file", return_value=False)
+    mocked.patch("shutil.copy", side_effect=Exception("no copying"))
+
+    tags = {"SeriesDescription": "Test", "Modality": "CT"}
+    dcm_file, _ = mock_incoming_uid(config, fs, generate_uid(), tags, "test")
+    router.run_router()
+
+    out_files = [path / Path(dcm_file).name for path in Path(config.outgoing_folder).iterdir()]
+    assert len(out_files) == 2
+    assert out_files[0].stat().st_ino == out_files[1].stat().st_ino
+    assert not Path(dcm_file).exists()
+
+
+def test_route_series_speculative_backpressure(fs: FakeFilesystem, mercure_config, mocked):
+    config = mercure_config({
+        "rules": {
+            **rules["rules"],
+            "stroke": Rule(rule="@SeriesDescription@ == 'stroke'", target="test_target", priority="urgent").dict(),
+        },
+        "router_speculative_routing": True,
+        "series_complete_trigger": 600,
+        "router_backpressure": {"outgoing": {"high_tasks": 1, "low_tasks": 0}},
+    })
+    mocked.patch("routing.backpressure.queues", {queue: backpressure.QueueState() for queue in backpressure.queues})
+    outgoing = Path(config.outgoing_folder)
+    (outgoing / "pending").mkdir()
+    routine_uid = str(uuid.uuid4())
+    stroke_uid = str(uuid.uuid4())
+    mock_incoming_uid(config, fs, routine_uid, {"SeriesDescription": "foo"}, "routine")
+    mock_incoming_uid(config, fs, stroke_uid, {"SeriesDescription": "stroke"}, "stroke")
+
+    # The outgoing queue is full, so only the urgent series is prepared while it is still being received
+    router.run_router()
+    assert len(list(outgoing.iterdir())) == 2
+    assert sorted(k.name for k in (Path(config.incoming_folder) / routine_uid).iterdir()) == [
+        f"{routine_uid}#routine.dcm", f"{routine_uid}#routine.tags"]
+    assert [k.name for k in (Path(config.incoming_folder) / stroke_uid).iterdir()] == [mercure_names.SPECULATIVE]
+
+
+def test_route_series_speculative(fs: FakeFilesystem, mercure_config, mocked):
+    config = mercure_config({**rules, "router_speculative_routing": True, "series_complete_trigger": 600})
+    task_id = "test_task_" + str(uuid.uuid1())
+    new_task_id = "new-task-" + str(uuid.uuid1())
+    series_uid = str(uuid.uuid4())
+    incoming = Path(config.incoming_folder) / series_uid
+    out_path = Path(config.outgoing_folder) / new_task_id
+
+    # The task folder is prepared and the received instance moved into it while the series is still pending
+    mock_incoming_uid(config, fs, series_uid, {"SeriesDescription": "foo"}, "first")
+    mock_task_ids(mocked, new_task_id, [])
+    modification_time = max(path.stat().st_mtime for path in [incoming, *incoming.iterdir()])
+    swept_time = modification_time + 30
+    real_rename = os.rename
+
+    def rename(source, destination):
+        # The fake file system does not update the modification time of a folder when files are moved out of it
+        real_rename(source, destination)
+        os.utime(os.path.dirname(source), (swept_time, swept_time))
+
+    rename_mock = mocked.patch("routing.speculative_routing.os.rename", side_effect=rename)
+    router.run_router()
+    router.route_series.assert_not_called()  # type: ignore
+    assert sorted(k.name for k in out_path.iterdir()) == sorted(
+        [mercure_names.LOCK, "task.json", f"{series_uid}#first.dcm", f"{series_uid}#first.tags"])
+    assert [k.name for k in incoming.iterdir()] == [mercure_names.SPECULATIVE]
+    mocked.stop(rename_mock)
+    # The timestamps of the incoming folder are left alone, but moving the files out of it must not delay the
+    # series completion
+    assert incoming.stat().st_mtime == swept_time
+    router.run_router()
+    assert router.series_index.completion.pending[series_uid] == modification_time
+
+    mock_incoming_uid(config, fs, series_uid, {"SeriesDescription": "foo"}, "second")
+    # The fake file system does not update the modification time of a folder when files are added
+    os.utime(incoming, (swept_time + 1, swept_time + 1))
+    router.run_router()
+    assert router.series_index.completion.pending[series_uid] == swept_time + 1
+    assert (out_path / f"{series_uid}#second.dcm").exists()
+    assert (out_path / mercure_names.LOCK).exists()
+
+    # Once the series is complete, the remaining instance is moved and the task folder is released
+    mock_incoming_uid(config, fs, series_uid, {"SeriesDescription": "foo"}, "third")
+    mercure_config({**rules, "router_speculative_routing": True, "series_complete_trigger": -60})
+    mock_task_ids(mocked, task_id, [])
+    router.run_router()
+    router.route_series.assert_called_once_with(task_id, series_uid)  # type: ignore
+    assert sorted(k.name for k in out_path.iterdir()) == sorted(
+        ["task.json"] + [f"{series_uid}#{name}{ext}" for name in ("first", "second", "third") for ext in (".dcm", ".tags")])
+    assert not incoming.exists()
+
+    with open(out_path / "task.json") as e:
+        task: Task = Task(**json.load(e))
+    assert task.id == new_task_id
+    assert task.dispatch.target_name == ["test_target"]  # type: ignore
+    common.monitor.send_register_task.assert_any_call(new_task_id, series_uid, task_id)  # type: ignore
+    common.monitor.send_task_event.assert_has_calls(  # type: ignore
+        [
+            call(task_event.REGISTER, task_id, 3, "route_series", "Registered series"),
+            call(task_event.DELEGATE, task_id, 3, new_task_id, "route_series"),
+            call(task_event.MOVE, task_id, 3, str(out_path), "Moved files"),
+        ]
+    )
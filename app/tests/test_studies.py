@@ -1,11 +1,16 @@
 import asyncio
+import errno
+import json
+import os
 import shutil
 import unittest
 import uuid
 from datetime import timedelta
 from pathlib import Path
-from typing import Tuple
+from typing import Any, Dict, Tuple
 
+import common.completion_series as completion_series
+import common.rule_evaluation as rule_evaluation
 import pytest
 from common import notification
 from common.constants import mercure_events, mercure_names
@@ -15,7 +20,8 @@ from nomad.api.job import Job
 from nomad.api.jobs import Jobs
 from process import processor
 from pyfakefs.fake_filesystem import FakeFilesystem
-from routing import router
+import routing.generate_taskfile as generate_taskfile
+from routing import route_studies, router
 
 from .testing_common import mock_incoming_uid
 
@@ -134,6 +140,130 @@ def test_route_study_simple(fs: FakeFilesystem, mercure_config, mocked, action,
                 ])
 
 
+@pytest.mark.parametrize("cross_device", [False, True])
+def test_move_study_folder(fs: FakeFilesystem, mercure_config, mocked, cross_device):
+    """
+    Test that a completed study folder is handed over as a whole, or file by file if it cannot be renamed.
+    """
+    config = mercure_config(
+        {
+            "series_complete_trigger": 10,
+            "study_complete_trigger": 30,
+            "rules": {
+                "route_study": Rule(
+                    rule="True",
+                    action="route",
+                    study_trigger_condition="timeout",
+                    target="test_target_2",
+                    action_trigger="study",
+                ).dict(),
+            },
+        }
+    )
+    study_uid = str(uuid.uuid4())
+    out_path = Path(config.outgoing_folder)
+    if cross_device:
+        def rename(source, destination):
+            if Path(source).is_dir():
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            return real_rename(source, destination)
+        real_rename = os.rename
+        mocked.patch("routing.route_studies.os.rename", new=rename)
+    rename_spy = mocked.spy(route_studies, "rename_study_folder")
+
+    with freeze_time("2020-01-01 00:00:00") as frozen_time:
+        create_series(mocked, fs, config, study_uid, str(uuid.uuid4()), "first")
+        create_series(mocked, fs, config, study_uid, str(uuid.uuid4()), "second")
+        frozen_time.tick(delta=timedelta(seconds=11))
+        router.run_router()
+        study_folder = next(Path(config.studies_folder).iterdir())
+        task_id = json.loads((study_folder / mercure_names.TASKFILE).read_text())["id"]
+        files = sorted(entry.name for entry in study_folder.iterdir() if entry.name != mercure_names.STUDY_JOURNAL)
+
+        frozen_time.tick(delta=timedelta(seconds=31))
+        router.run_router()
+
+    assert rename_spy.spy_return is (not cross_device)
+    assert list(Path(config.studies_folder).iterdir()) == []
+    assert [folder.name for folder in out_path.iterdir()] == [task_id]
+    # All files have been moved, and no lock files are left behind
+    assert sorted(entry.name for entry in (out_path / task_id).iterdir()) == files
+    assert not any(name.endswith(mercure_names.LOCK) for name in files)
+    # The study journal has been merged into the task file
+    task = json.loads((out_path / task_id / mercure_names.TASKFILE).read_text())
+    assert sorted(task["study"]["received_series"]) == ["first", "second"]
+
+
+def test_study_journal(fs: FakeFilesystem, mercure_config, mocked):
+    """
+    Test that the received series are appended to the study journal and merged into the task file on completion.
+    """
+    config = mercure_config(
+        {
+            "series_complete_trigger": 10,
+            "study_complete_trigger": 30,
+            "rules": {
+                "route_study": Rule(
+                    rule="True",
+                    action="route",
+                    study_trigger_condition="received_series",
+                    study_trigger_series="'first' and 'third'",
+                    target="test_target_2",
+                    action_trigger="study",
+                ).dict(),
+            },
+        }
+    )
+    study_uid = str(uuid.uuid4())
+    out_path = Path(config.outgoing_folder)
+
+    with freeze_time("2020-01-01 00:00:00") as frozen_time:
+        create_series(mocked, fs, config, study_uid, str(uuid.uuid4()), "first")
+        frozen_time.tick(delta=timedelta(seconds=11))
+        router.run_router()
+        study_folder = next(Path(config.studies_folder).iterdir())
+        task_file = study_folder / mercure_names.TASKFILE
+        stored_task = task_file.read_text()
+
+        create_series(mocked, fs, config, study_uid, str(uuid.uuid4()), "second")
+        frozen_time.tick(delta=timedelta(seconds=11))
+        router.run_router()
+        # The task file is not rewritten for further series
+        assert task_file.read_text() == stored_task
+        assert [entry["received_series"] for entry in generate_taskfile.read_study_journal(study_folder)] == ["second"]
+        # Updates of the study only parse the journal lines that have been appended since the last update
+        cached_task = generate_taskfile.study_task_cache.get(study_folder)
+        assert cached_task.study.received_series == ["first", "second"]
+        load = mocked.spy(generate_taskfile.json_codec, "load")
+        loads = mocked.spy(generate_taskfile.json_codec, "loads")
+        assert generate_taskfile.study_task_cache.get(study_folder) is cached_task
+        load.assert_not_called()
+        loads.assert_not_called()
+
+        # A line that is still being written is ignored by the readers
+        with open(study_folder / mercure_names.STUDY_JOURNAL, "a") as journal_file:
+            journal_file.write('{"last_receive_time": "2020-01-01 00:00:22", "received_series": "thi')
+        task = generate_taskfile.read_study_task(study_folder)
+        assert task.study.received_series == ["first", "second"]
+        assert task.study.last_receive_time == "2020-01-01 00:00:22"
+        loads.reset_mock()
+        assert generate_taskfile.study_task_cache.get(study_folder).study.received_series == ["first", "second"]
+        loads.assert_not_called()
+        router.run_router()
+        assert list(out_path.glob("**/*")) == []
+        with open(study_folder / mercure_names.STUDY_JOURNAL, "a") as journal_file:
+            journal_file.write('rd", "received_series_uid": "1.2.3"}\n')
+
+        frozen_time.tick(delta=timedelta(seconds=1))
+        router.run_router()
+        assert list(Path(config.studies_folder).iterdir()) == []
+        task_id = next(out_path.iterdir()).name
+        assert not (out_path / task_id / mercure_names.STUDY_JOURNAL).exists()
+        task = generate_taskfile.read_study_task(out_path / task_id)
+        assert task.study.received_series == ["first", "second", "third"]
+        assert task.study.received_series_uid is not None and task.study.received_series_uid[2] == "1.2.3"
+
+
 def test_route_study_error(fs: FakeFilesystem, mercure_config, mocked):
     """
     Test that a study with a pending series is not routed until the pending series itself times out.
@@ -284,6 +414,157 @@ def test_route_study_series_trigger(fs: FakeFilesystem, mercure_config, mocked):
         router.run_router()
         assert list(out_path.glob("**/*")) != []
 
+
+def test_study_index(fs: FakeFilesystem, mercure_config, mocked):
+    """
+    Test that unchanged study folders are not read again, and that changed study folders are.
+    """
+    config = mercure_config(
+        {
+            "series_complete_trigger": 10,
+            "study_complete_trigger": 300,
+            "rules": {
+                "route_study": Rule(
+                    rule="True",
+                    action="route",
+                    study_trigger_condition="timeout",
+                    target="test_target_2",
+                    action_trigger="study",
+                ).dict(),
+            },
+        }
+    )
+    study_uid = str(uuid.uuid4())
+    out_path = Path(config.outgoing_folder)
+    locked_spy = mocked.spy(route_studies, "is_study_locked")
+
+    with freeze_time("2020-01-01 00:00:00") as frozen_time:
+        create_series(mocked, fs, config, study_uid, str(uuid.uuid4()), "first")
+        frozen_time.tick(delta=timedelta(seconds=11))
+        router.run_router()
+        study_folders = list(Path(config.studies_folder).iterdir())
+        assert len(study_folders) == 1
+        assert locked_spy.call_count == 1
+
+        # The study folder has been modified too recently, so it is read again once
+        frozen_time.tick(delta=timedelta(seconds=5))
+        router.run_router()
+        assert locked_spy.call_count == 2
+        state = route_studies.study_index.studies[study_folders[0].name]
+        assert state.task is not None and state.task.study.received_series == ["first"]
+        frozen_time.tick(delta=timedelta(seconds=5))
+        router.run_router()
+        router.run_router()
+        assert locked_spy.call_count == 2
+
+        # A new series changes the study, so it is read again
+        create_series(mocked, fs, config, study_uid, str(uuid.uuid4()), "second")
+        frozen_time.tick(delta=timedelta(seconds=11))
+        router.run_router()
+        assert locked_spy.call_count == 3
+        state = route_studies.study_index.studies[study_folders[0].name]
+        assert state.task is not None and state.task.study.received_series == ["first", "second"]
+
+        # Once the study has been routed, it is removed from the index
+        frozen_time.tick(delta=timedelta(seconds=301))
+        router.run_router()
+        assert list(out_path.glob("**/*")) != []
+        router.run_router()
+        assert study_folders[0].name not in route_studies.study_index.studies
+
+
+@pytest.mark.parametrize("targets", [["test_target"], ["test_target", "sftp_target"]])
+def test_route_study_incremental(fs: FakeFilesystem, mercure_config, mocked, targets):
+    """
+    Test that the series of a study are dispatched while the study is received, and that only the rest of the study
+    is handled once the study is complete.
+    """
+    config = mercure_config(
+        {
+            "series_complete_trigger": 10,
+            "study_complete_trigger": 30,
+            "rules": {
+                "route_study": Rule(
+                    rule="True",
+                    action="route",
+                    study_trigger_condition="timeout",
+                    study_incremental_dispatch=True,
+                    target=targets,
+                    action_trigger="study",
+                ).dict(),
+            },
+        }
+    )
+    study_uid = str(uuid.uuid4())
+    series_uids = [str(uuid.uuid4()), str(uuid.uuid4())]
+    out_path = Path(config.outgoing_folder)
+
+    def get_outgoing_tasks() -> Dict[str, Dict[str, Any]]:
+        return {folder.name: json.loads((folder / mercure_names.TASKFILE).read_text()) for folder in out_path.iterdir()}
+
+    with freeze_time("2020-01-01 00:00:00") as frozen_time:
+        create_series(mocked, fs, config, study_uid, series_uids[0], "first")
+        frozen_time.tick(delta=timedelta(seconds=11))
+        router.run_router()
+        # The series has been dispatched to the DICOM target while the study is still incomplete
+        tasks = get_outgoing_tasks()
+        assert len(tasks) == 1
+        task_id, task = next(iter(tasks.items()))
+        assert task["dispatch"]["target_name"] == ["test_target"]
+        assert task["info"]["uid"] == series_uids[0]
+        assert task["info"]["triggered_rules"] == {}
+        assert [f.name.split("#")[0] for f in (out_path / task_id).glob("*.dcm")] == [series_uids[0]]
+
+        create_series(mocked, fs, config, study_uid, series_uids[1], "second")
+        frozen_time.tick(delta=timedelta(seconds=11))
+        router.run_router()
+        assert len(get_outgoing_tasks()) == 2
+        study_folder = next(Path(config.studies_folder).iterdir())
+        assert generate_taskfile.read_study_task(study_folder).study.forwarded_series_uid == series_uids
+
+        frozen_time.tick(delta=timedelta(seconds=31))
+        router.run_router()
+
+    assert list(Path(config.studies_folder).iterdir()) == []
+    study_tasks = {key: task for key, task in get_outgoing_tasks().items() if task["info"]["uid_type"] == "study"}
+    if targets == ["test_target"]:
+        # All series have been dispatched already, so the study is complete
+        assert study_tasks == {}
+        assert len(list(Path(config.success_folder).iterdir())) == 1
+        notification.trigger_notification_for_rule.assert_has_calls(  # type: ignore
+            [
+                unittest.mock.call("route_study", unittest.mock.ANY, mercure_events.RECEIVED, task=unittest.mock.ANY),
+                unittest.mock.call("route_study", unittest.mock.ANY, mercure_events.COMPLETED, task=unittest.mock.ANY)
+            ])
+    else:
+        # The complete study is dispatched to the other target
+        assert len(study_tasks) == 1
+        task_id, task = next(iter(study_tasks.items()))
+        assert task["dispatch"]["target_name"] == ["sftp_target"]
+        assert len(list((out_path / task_id).glob("*.dcm"))) == 2
+
+
+def test_completion_series_matcher():
+    """
+    Test that the compiled completion conditions give the same results as parse_completion_series, also when
+    the series of a study are added one after the other.
+    """
+    assert completion_series.SeriesMatcher(["he", "she", "his", "hers", ""]).find("ushers") == {0, 1, 3, 4}
+
+    received_series = ["T1 SAG", "ax t2", "DWI", "Cor Flair"]
+    for condition in ["'SAG' or ('COR' and 'AX')", "'t1' and not 'dwi'", "('cor') and 'flair' and ''", "'T2' AND 'x'"]:
+        study_key = str(uuid.uuid4())
+        for count in range(len(received_series) + 1):
+            expected = rule_evaluation.parse_completion_series("task", condition, received_series[:count])
+            result = completion_series.check_completion_series("task", study_key, condition, received_series[:count])
+            assert result == expected, (condition, count)
+        assert completion_series.get_condition(condition).tree is not None
+
+    # Conditions that cannot be compiled are evaluated as before
+    assert completion_series.get_condition("'sag' 'cor'").tree is None
+    assert completion_series.check_completion_series("task", "invalid", "'sag' 'cor'", received_series) is False
+
+
 # def test_route_study_multiple_series(fs: FakeFilesystem, mercure_config, mocked):
 #     config = mercure_config({
 #         "series_complete_trigger": 1,
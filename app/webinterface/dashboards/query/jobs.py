@@ -22,6 +22,7 @@ from common import helper
 from common.types import DicomTarget, DicomWebTarget
 from dispatch.target_types.base import ProgressInfo
 from dispatch.target_types.registry import get_handler
+from routing.expected_instances import write_expected_instances
 from redis import Redis
 from rq import Queue, get_current_job
 from rq.job import Dependency, Job, JobStatus
@@ -102,6 +103,26 @@ class GetAccessionTask(ClassBasedRQTask):
                       search_filters: Dict[str, List[str]], path) -> Generator[ProgressInfo, None, None]:
         yield from get_handler(node).get_from_target(node, accession, search_filters, path)
 
+    @staticmethod
+    def record_expected_instances(accession: str, node: Union[DicomTarget, DicomWebTarget],
+                                  search_filters: Dict[str, List[str]]) -> None:
+        """
+        Records the number of instances of the series that are about to be retrieved, so that the router can
+        route the series as soon as the last instance has arrived in the incoming folder.
+        """
+        config.read_config()
+        if not config.mercure.router_count_completion:
+            return
+        try:
+            for ds in get_handler(node).find_from_target(node, accession, search_filters):
+                count = ds.get("NumberOfSeriesRelatedInstances")
+                if not ds.get("SeriesInstanceUID") or not count:
+                    continue
+                write_expected_instances(config.mercure.incoming_folder, str(ds.SeriesInstanceUID), int(count))
+        except Exception:
+            # The series will be completed by the series completion trigger instead
+            logger.warning(f"Unable to record the expected number of instances for ACC {accession}")
+
     def execute(self, *, accession: str, node: Union[DicomTarget, DicomWebTarget],
                 search_filters: Dict[str, List[str]], path: str, force_rule: Optional[str] = None):
         logger.info(f"Getting ACC {accession}")
@@ -134,6 +155,8 @@ class GetAccessionTask(ClassBasedRQTask):
             if job_parent:
                 job_parent.meta['started'] = job_parent.meta.get('started', 0) + 1
                 job_parent.save_meta()  # type: ignore
+                if job_parent.kwargs.get("destination") is None:
+                    self.record_expected_instances(accession, node, search_filters)
 
             job.meta['started'] = 1
             job.meta['progress'] = "0 / Unknown"
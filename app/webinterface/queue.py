@@ -22,7 +22,7 @@ from common.constants import mercure_actions, mercure_names
 from common.event_types import FailStage
 # App-specific includes
 from common.helper import FileLock
-from common.types import EmptyDict, Task
+from common.types import EmptyDict, Task, task_cache
 from decoRouter import Router as decoRouter
 # Starlette-related includes
 from starlette.applications import Starlette
@@ -108,7 +108,7 @@ async def show_jobs_processing(request):
                 pass
 
             try:
-                task = Task.from_file(task_file)
+                task = task_cache.get(task_file)
                 if task.process:
                     if isinstance(task.process, list):
                         job_module = ", ".join([p.module_name for p in task.process])
@@ -169,7 +169,7 @@ async def show_jobs_routing(request):
 
             task_file = Path(entry.path) / mercure_names.TASKFILE
             try:
-                task = Task.from_file(task_file)
+                task = task_cache.get(task_file)
                 if task.dispatch and task.dispatch.target_name:
                     if isinstance(task.dispatch.target_name, str):
                         job_target = task.dispatch.target_name
@@ -240,10 +240,8 @@ async def show_jobs_studies(request):
         job_created = ""
         job_series = 0
 
-        task_file = Path(entry.path) / mercure_names.TASKFILE
-
         try:
-            task = Task.from_file(task_file)
+            task = generate_taskfile.read_study_task(Path(entry.path))
             if (not task.study) or (not task.info):
                 raise Exception("Task file does not contain study information")
             job_uid = task.info.uid
@@ -312,7 +310,7 @@ async def show_jobs_fail(request):
             task_file = Path(entry.path) / "in" / mercure_names.TASKFILE
 
         try:
-            task = Task.from_file(task_file)
+            task = task_cache.get(task_file)
             job_acc = task.info.acc
             job_mrn = task.info.mrn
             if task.info.uid_type == "series":
@@ -4,7 +4,11 @@ rules.py
 Rules page for the graphical user interface of mercure.
 """
 
+import asyncio
+import functools
+import html
 import json
+import os
 # Standard python includes
 import re
 from typing import Any, Dict, Set
@@ -28,6 +32,10 @@ router = decoRouter()
 
 logger = config.get_logger()
 
+# Settings for testing a rule against the recently received series (see rules_test_batch)
+BATCH_TEST_MAX_DIFFS = 20
+BATCH_TEST_CHUNK_SIZE = 1000
+
 
 ###################################################################################
 # Rules endpoints
@@ -207,6 +215,7 @@ async def rules_edit_post(request) -> Response:
         study_trigger_condition=form.get("study_trigger_condition", "timeout"),
         study_trigger_series=form.get("study_trigger_series", ""),
         study_force_completion_action=form.get("study_force_completion_action", ""),
+        study_incremental_dispatch=form.get("study_incremental_dispatch", "False"),
         priority=form.get("priority", "normal"),
         processing_module=processing_module,
         processing_settings=new_processing_settings,
@@ -312,6 +321,59 @@ async def rules_test(request) -> Response:
                              )
 
 
+async def evaluate_rule_change(rule: str, rule_text: str, series_count: int) -> rule_evaluation.BatchEvaluation:
+    """Evaluates the routing rules, with the given text for the given rule, against the tags of the most recently
+    received series (as stored by the bookkeeper). The current rules are used as baseline, so that the series for
+    which the triggered rules would change are reported."""
+    tag_sets = await monitor.get("query/series_tags", {"limit": series_count})
+    if tag_sets is None:
+        raise Exception("Unable to read the received series from the bookkeeper")
+
+    baseline_rules = {name: item.dict() for name, item in config.mercure.rules.items()}
+    changed_rules = {**baseline_rules, rule: {**baseline_rules.get(rule, {}), "rule": rule_text}}
+    workers = max(min(len(tag_sets) // BATCH_TEST_CHUNK_SIZE, os.cpu_count() or 1), 1)
+    evaluate = functools.partial(rule_evaluation.evaluate_batch, changed_rules, tag_sets, baseline_rules,
+                                 workers=workers, chunk_size=BATCH_TEST_CHUNK_SIZE, max_diffs=BATCH_TEST_MAX_DIFFS)
+    return await asyncio.get_running_loop().run_in_executor(None, evaluate)
+
+
+@router.post("/test_batch/{rule}")
+@requires(["authenticated", "admin"], redirect="login")
+async def rules_test_batch(request) -> Response:
+    """Evaluates the given routing rule against the recently received series and shows how the routing would change."""
+    rule = request.path_params["rule"]
+    try:
+        form = dict(await request.form())
+        testrule = form["rule"]
+        series_count = int(form.get("testseriescount", 10000))
+    except Exception:
+        return PlainTextResponse(
+            ('<span class="tag is-warning is-medium ruleresult">'
+             '<i class="fas fa-bug"></i>&nbsp;Error</span>&nbsp;&nbsp;Invalid test values')
+        )
+    try:
+        config.read_config()
+        result = await evaluate_rule_change(rule, testrule, series_count)
+    except Exception as e:
+        return PlainTextResponse(
+            ('<span class="tag is-danger is-medium ruleresult">'
+             f'<i class="fas fa-bug"></i>&nbsp;Error</span>&nbsp;&nbsp;{html.escape(str(e))}')
+        )
+
+    lines = [
+        f"Series evaluated: {result.series}",
+        f"Triggered by rule: {result.hits.get(rule, 0)} (currently {result.baseline_hits.get(rule, 0)})",
+        f"Routing changed: {result.changed}",
+    ]
+    if result.errors.get(rule):
+        lines.append(f"Evaluation errors: {result.errors[rule]}")
+    for diff in result.diffs:
+        lines.append(f"{diff.series}: {', '.join(diff.before) or '-'} -> {', '.join(diff.after) or '-'}")
+    style = "warning" if result.changed else "success"
+    return PlainTextResponse(f'<span class="tag is-{style} is-medium ruleresult"><i class="fas fa-history"></i>&nbsp;Recent Series</span>'  # noqa: E501
+                             + f'<pre style="margin: 1em">{html.escape(chr(10).join(lines))}</pre>')
+
+
 @router.post("/test_completionseries")
 @requires(["authenticated", "admin"], redirect="login")
 async def rules_test_completionseries(request) -> Response: